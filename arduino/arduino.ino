@@ -1,17 +1,48 @@
-// version 0.0.1
+// version 0.0.4
 
 const int STEP = 0.025; //mm; just for information
 const int STEP_DELAY = 500; //microseconds
 
+// Travel moves (same values as gamepad_measure.py)
+const float TRAVEL_START_SPEED = 1000.0; //steps/s, the speed of slide()
+const float TRAVEL_MAX_SPEED = 4000.0; //steps/s
+const float TRAVEL_ACCEL = 20000.0; //steps/s^2
+
 const int STEP_PIN = 2;
 const int DIRECTION_PIN = 5;
 
 const int DEFAULT_POS = 0;
 long current_pos = 0;
 
+// Serial Motion Protocol (same values as gamepad_measure.py)
+// host -> firmware: SYNC, VERSION, CMD, SEQ, int32 ARG, CHECKSUM
+// firmware -> host: ACK_SYNC, VERSION, STATUS, SEQ, int32 POS, uint32 micros(), CHECKSUM
+// Lines without SYNC are still taken as the legacy "{pos}\n" commands.
+const byte PROTOCOL_VERSION = 1;
+const byte PROTOCOL_SYNC = 0xA5;
+const byte PROTOCOL_ACK_SYNC = 0x5A;
+const int PROTOCOL_FRAME_SIZE = 9;
+const int PROTOCOL_ACK_FRAME_SIZE = 13;
+
+const byte PROTOCOL_CMD_MOVE = 'M';
+const byte PROTOCOL_CMD_HELLO = 'V';
+const byte PROTOCOL_CMD_STEP_DELAY = 'D';
+const byte PROTOCOL_CMD_SWEEP = 'S';
+const byte PROTOCOL_CMD_TRAVEL = 'T';
+const byte PROTOCOL_ACK_DONE = 'A';
+const byte PROTOCOL_ACK_HELLO = 'V';
+const byte PROTOCOL_ACK_ERROR = 'E';
+const byte PROTOCOL_ACK_PROGRESS = 'P';
+
+unsigned long sweep_step_delay = STEP_DELAY;
+
+int last_seq = -1;
+byte last_cmd = 0;
+byte last_status = 0;
+
 void setup() {
     Serial.begin(115200);
-    
+
     pinMode(STEP_PIN, OUTPUT);
     pinMode(DIRECTION_PIN, OUTPUT);
 
@@ -26,8 +57,165 @@ void slide() {
     delayMicroseconds(STEP_DELAY);
 }
 
+void move_to(long target_pos) {
+    long diff = 0;
+
+    if (target_pos < current_pos) {
+        diff = current_pos - target_pos;
+    } else if (target_pos > current_pos) {
+        diff = target_pos - current_pos;
+    }
+
+    for (long i = 0; i < diff; i++) {
+        if (target_pos < current_pos) {
+            digitalWrite(DIRECTION_PIN, LOW);
+        } else if (target_pos > current_pos) {
+            digitalWrite(DIRECTION_PIN, HIGH);
+        }
+        slide();
+    }
+
+    current_pos = target_pos;
+}
+
+// Moving at a constant speed and sending a progress ack with micros() on every step
+void sweep_to(long target_pos, byte seq) {
+    long dir = 1;
+    if (target_pos < current_pos) {
+        dir = -1;
+        digitalWrite(DIRECTION_PIN, LOW);
+    } else {
+        digitalWrite(DIRECTION_PIN, HIGH);
+    }
+
+    unsigned long next_step = micros() + 2 * sweep_step_delay;
+    while (current_pos != target_pos) {
+        while ((long)(micros() - next_step) < 0) {
+        }
+
+        digitalWrite(STEP_PIN, HIGH);
+        current_pos += dir;
+        send_ack(PROTOCOL_ACK_PROGRESS, seq);
+        delayMicroseconds(sweep_step_delay);
+        digitalWrite(STEP_PIN, LOW);
+
+        next_step += 2 * sweep_step_delay;
+    }
+}
+
+// Positioning without measuring: accelerating from TRAVEL_START_SPEED up to TRAVEL_MAX_SPEED and slowing down
+// the same way before the target, the ack is sent when the travel is done
+void travel_to(long target_pos) {
+    long dir = 1;
+    if (target_pos < current_pos) {
+        dir = -1;
+        digitalWrite(DIRECTION_PIN, LOW);
+    } else {
+        digitalWrite(DIRECTION_PIN, HIGH);
+    }
+
+    long steps = (target_pos - current_pos) * dir;
+    unsigned long next_step = micros();
+    for (long i = 0; i < steps; i++) {
+        long ramp = min(i, steps - 1 - i);
+        float speed = sqrt(TRAVEL_START_SPEED * TRAVEL_START_SPEED + 2.0 * TRAVEL_ACCEL * ramp);
+        if (speed > TRAVEL_MAX_SPEED) {
+            speed = TRAVEL_MAX_SPEED;
+        }
+        unsigned long period = 1000000.0 / speed;
+
+        while ((long)(micros() - next_step) < 0) {
+        }
+
+        digitalWrite(STEP_PIN, HIGH);
+        delayMicroseconds(period / 2);
+        digitalWrite(STEP_PIN, LOW);
+        current_pos += dir;
+
+        next_step += period;
+    }
+}
+
+byte checksum(const byte *data, int len) {
+    byte sum = 0;
+    for (int i = 0; i < len; i++) {
+        sum += data[i];
+    }
+    return sum;
+}
+
+void send_ack(byte status, byte seq) {
+    byte frame[PROTOCOL_ACK_FRAME_SIZE];
+    unsigned long t = micros();
+
+    frame[0] = PROTOCOL_ACK_SYNC;
+    frame[1] = PROTOCOL_VERSION;
+    frame[2] = status;
+    frame[3] = seq;
+    memcpy(frame + 4, &current_pos, 4); // little endian on AVR
+    memcpy(frame + 8, &t, 4);
+    frame[12] = checksum(frame, PROTOCOL_ACK_FRAME_SIZE - 1);
+
+    Serial.write(frame, PROTOCOL_ACK_FRAME_SIZE);
+}
+
+void handle_frame() {
+    byte frame[PROTOCOL_FRAME_SIZE];
+
+    if (Serial.readBytes(frame, PROTOCOL_FRAME_SIZE) < PROTOCOL_FRAME_SIZE) {
+        return;
+    }
+
+    byte cmd = frame[2];
+    byte seq = frame[3];
+
+    if (frame[1] != PROTOCOL_VERSION || checksum(frame, PROTOCOL_FRAME_SIZE - 1) != frame[PROTOCOL_FRAME_SIZE - 1]) {
+        send_ack(PROTOCOL_ACK_ERROR, seq);
+        return;
+    }
+
+    // Resent command, the ack was lost
+    if (seq == last_seq && cmd == last_cmd) {
+        send_ack(last_status, seq);
+        return;
+    }
+
+    long arg;
+    memcpy(&arg, frame + 4, 4);
+
+    byte status;
+    if (cmd == PROTOCOL_CMD_MOVE) {
+        move_to(arg);
+        status = PROTOCOL_ACK_DONE;
+    } else if (cmd == PROTOCOL_CMD_STEP_DELAY) {
+        sweep_step_delay = arg;
+        status = PROTOCOL_ACK_DONE;
+    } else if (cmd == PROTOCOL_CMD_SWEEP) {
+        sweep_to(arg, seq);
+        status = PROTOCOL_ACK_DONE;
+    } else if (cmd == PROTOCOL_CMD_TRAVEL) {
+        travel_to(arg);
+        status = PROTOCOL_ACK_DONE;
+    } else if (cmd == PROTOCOL_CMD_HELLO) {
+        status = PROTOCOL_ACK_HELLO;
+    } else {
+        send_ack(PROTOCOL_ACK_ERROR, seq);
+        return;
+    }
+
+    last_seq = seq;
+    last_cmd = cmd;
+    last_status = status;
+    send_ack(status, seq);
+}
+
 void loop() {
     if (Serial.available()) {
+        if (Serial.peek() == PROTOCOL_SYNC) {
+            handle_frame();
+            return;
+        }
+
         long target_pos;
 
         String line = Serial.readStringUntil('\n');
@@ -37,23 +225,6 @@ void loop() {
             return;
         }
 
-        long diff = 0;
-
-        if (target_pos < current_pos) {
-            diff = current_pos - target_pos;
-        } else if (target_pos > current_pos) {
-            diff = target_pos - current_pos;
-        }
-
-        for (long i = 0; i < diff; i++) {
-            if (target_pos < current_pos) {
-                digitalWrite(DIRECTION_PIN, LOW);
-            } else if (target_pos > current_pos) {
-                digitalWrite(DIRECTION_PIN, HIGH);
-            }
-            slide();
-        }
-
-        current_pos = target_pos;
+        move_to(target_pos);
     }
-}
\ No newline at end of file
+}
@@ -0,0 +1,265 @@
+import io
+import os
+import sys
+import time
+import json
+import glob
+import argparse
+import tempfile
+import subprocess
+import contextlib
+import statistics
+
+from threading import Event
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")    #no window is needed for benchmarking
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame
+
+import gamepad_measure as gm
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="GPSM benchmarks against the simulated rig")
+    parser.add_argument("-b", "--bench", help="benchmarks to run",
+                    nargs="+", choices=["sweep", "response_curve", "startup", "headless"], default=["sweep", "response_curve"])
+    parser.add_argument("-r", "--rounds", help="number of forward + reverse sweeps",
+                    type=int, default=3)
+    parser.add_argument("-a", "--axis", help="select joystick axis",
+                    default="rx")
+    parser.add_argument("--deadzone", help="virtual joystick deadzone",
+                    type=float, default=gm.SIM_DEADZONE)
+    parser.add_argument("--curve", help="virtual joystick response curve exponent",
+                    type=float, default=gm.SIM_CURVE)
+    parser.add_argument("--noise", help="virtual joystick noise",
+                    type=float, default=gm.SIM_NOISE)
+    parser.add_argument("--latency_ms", help="virtual joystick latency in ms",
+                    type=float, default=gm.SIM_LATENCY_MS)
+    parser.add_argument("--adaptive", help="use the adaptive sweep",
+                    action="store_true")
+    parser.add_argument("--sampling", help="fixed or converge sampling",
+                    choices=["fixed", "converge", "stream"], default=gm.DEFAULT_SAMPLING)
+    parser.add_argument("--frame_rate", help="measuring steps per second",
+                    type=float, default=gm.MEASURE_FRAME_RATE)
+    parser.add_argument("--before_sense_ms", help="settle time after a step before sampling",
+                    type=float, default=gm.DEFAULT_BEFORE_SENSE_MS)
+    parser.add_argument("--repeat_interval_ms", help="interval of the repeated reads",
+                    type=float, default=gm.DEFAULT_REPEAT_INTERVAL_MS)
+    parser.add_argument("--protocol", help="serial protocol",
+                    choices=["ack", "legacy"], default="legacy")
+    parser.add_argument("--drop_rate", help="rate of commands lost on the way to the simulated firmware",
+                    type=float, default=0.0)
+    parser.add_argument("--corrupt_rate", help="rate of commands garbled on the way to the simulated firmware",
+                    type=float, default=0.0)
+    parser.add_argument("--continuous", help="use the continuous sweep (needs --protocol ack)",
+                    action="store_true")
+    parser.add_argument("--curves", help="number of response curves to compute",
+                    type=int, default=1000)
+    parser.add_argument("--json", help="write the results to a json file",
+                    default=None)
+    return parser.parse_args()
+
+
+def run_sweep_pair(args, output_dir, seed):
+    ser, joystick = gm.open_simulated_rig(args.axis, args.deadzone, args.curve, args.noise, args.latency_ms, seed, args.drop_rate, args.corrupt_rate)
+    ser = gm.open_motion_link(ser, args.protocol)
+    timing = gm.gen_timing(args.sampling, frame_rate = args.frame_rate, before_sense_ms = args.before_sense_ms, repeat_interval_ms = args.repeat_interval_ms)
+    stop_event = Event()
+    change_event = Event()
+    if args.sampling == "stream" and not args.continuous:
+        joystick = gm.JoystickSampler(joystick)
+        joystick.start()
+
+    stats = gm.gen_stats()
+    response_curve_data = gm.gen_response_curve_data()
+    reverse_stats = gm.gen_stats()
+    reverse_response_curve_data = gm.gen_response_curve_data()
+
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    if args.continuous:
+        move_end_count = gm.measure_continuous_loop(joystick, args.axis, ser, stats, response_curve_data, stop_event, change_event, output_dir = output_dir, timing = timing)
+        gm.measure_continuous_loop(joystick, args.axis, ser, reverse_stats, reverse_response_curve_data, stop_event, change_event, True, move_end_count, output_dir = output_dir, timing = timing)
+    else:
+        move_end_count = gm.measure_main_loop(joystick, args.axis, ser, stats, response_curve_data, stop_event, change_event, output_dir = output_dir, adaptive = args.adaptive, timing = timing)
+        gm.measure_main_loop(joystick, args.axis, ser, reverse_stats, reverse_response_curve_data, stop_event, change_event, True, move_end_count, output_dir = output_dir, adaptive = args.adaptive, timing = timing)
+
+    wall_time = time.perf_counter() - wall_start
+    cpu_time = time.process_time() - cpu_start
+
+    if isinstance(joystick, gm.JoystickSampler):
+        joystick.stop()
+    ser.close()
+
+    result = {}
+    if isinstance(ser, gm.MotionLink):
+        result["link"] = dict(ser.counters)
+
+    samples = len(stats["motor_pos"]) + len(reverse_stats["motor_pos"])
+    result.update({
+        "samples": samples,
+        "axis_reads": sum(stats["samples"]) + sum(reverse_stats["samples"]),
+        "steps": samples - 2,    #the first sample of each sweep is taken before moving
+        "wall_time_s": wall_time,
+        "cpu_time_s": cpu_time,
+    })
+    return result
+
+
+def bench_sweep(args):
+    results = []
+    timing_reports = []
+    with tempfile.TemporaryDirectory() as output_dir:
+        for i in range(args.rounds):
+            results.append(run_sweep_pair(args, output_dir, i))
+
+        for filename in glob.glob(os.path.join(output_dir, "*_timing.json")):
+            with open(filename) as fd:
+                timing_reports.append(json.load(fd))
+
+    steps = sum(result["steps"] for result in results)
+    samples = sum(result["samples"] for result in results)
+    wall_times = [result["wall_time_s"] for result in results]
+
+    return {
+        "rounds": args.rounds,
+        "steps_per_second": steps / sum(wall_times),
+        "sweep_wall_time_s": statistics.mean(wall_times),
+        "sweep_wall_time_min_s": min(wall_times),
+        "sweep_wall_time_max_s": max(wall_times),
+        "cpu_time_per_sample_us": sum(result["cpu_time_s"] for result in results) / samples * 1000000,
+        "step_p99_us_max": max([report["phases"]["step"]["p99_us"] for report in timing_reports], default=0),
+        "overrun_steps": sum(report["overruns"] for report in timing_reports),
+        "deadline_misses": sum(report["deadline_misses"] for report in timing_reports),
+        "runs": results,
+        "timing": timing_reports,
+    }
+
+
+# Values of a simulated capture without moving the motor
+def gen_capture(args, samples = 600):
+    ser, joystick = gm.open_simulated_rig(args.axis, args.deadzone, args.curve, args.noise, 0, 0)
+    positions = [i * gm.STEP_DISTANCE_MM for i in range(samples)]
+    values = [joystick.value_at(pos) for pos in positions]
+    return values, positions
+
+
+def bench_response_curve(args):
+    values, positions = gen_capture(args)
+    report = {"curves": args.curves, "samples_per_curve": len(values)}
+
+    engines = [("python", False)]
+    if gm.np is not None:
+        engines.append(("numpy", True))
+
+    results = {}
+    for name, vectorized in engines:
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            for i in range(args.curves):
+                results[name] = gm.calc_response_curve(values, -1, 0, 0, 0, args.axis, gm.gen_response_curve_data(), False, positions, vectorized)
+            elapsed = time.perf_counter() - start
+        report[f"{name}_curves_per_second"] = args.curves / elapsed
+        report[f"{name}_us_per_sample"] = elapsed / args.curves / len(values) * 1000000
+
+    if "numpy" in results:
+        report["numpy_speedup"] = report["numpy_curves_per_second"] / report["python_curves_per_second"]
+        report["numpy_max_abs_error"] = max(abs(a - b) for row_a, row_b in zip(results["python"][1:], results["numpy"][1:]) for a, b in zip(row_a, row_b))
+
+    return report
+
+
+# Fresh interpreters, as every launch of gamepad_measure.exe pays for the imports and SDL init
+def time_command(command, rounds, stdin = "", cwd = None):
+    times = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        subprocess.run(command, input=stdin, capture_output=True, text=True, check=True, cwd=cwd)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def bench_startup(args):
+    script = os.path.abspath(gm.__file__)
+    commands = {
+        "python": [sys.executable, "-c", "pass"],
+        "import": [sys.executable, "-c", "import gamepad_measure"],
+        "sdl_full_init": [sys.executable, "-c", "import pygame; pygame.init()"],
+        "sdl_joystick_init": [sys.executable, "-c", "import pygame; pygame.joystick.init(); pygame.display.init()"],
+        "list": [sys.executable, script, "--list"],
+    }
+
+    report = {"rounds": args.rounds}
+    for name, command in commands.items():
+        times = time_command(command, args.rounds, "\n", os.path.dirname(script))    #the import needs the script next to it
+        report[f"{name}_s"] = statistics.mean(times)
+        report[f"{name}_min_s"] = min(times)
+    return report
+
+
+# A whole headless run of gamepad_measure.py against the simulated rig, nothing may wait for a window or input
+def bench_headless(args):
+    script = os.path.abspath(gm.__file__)
+    command = [sys.executable, script, "--simulate", "--headless", "--log", "run_log.jsonl", "-a", args.axis, "--protocol", args.protocol, "--sampling", args.sampling,
+               "--sim_deadzone", str(args.deadzone), "--sim_curve", str(args.curve), "--sim_noise", str(args.noise), "--sim_latency_ms", str(args.latency_ms)]
+    env = dict(os.environ)
+    env.pop("SDL_VIDEODRIVER", None)    #the headless mode has to pick the dummy driver by itself
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, text=True, check=True, cwd=output_dir, env=env, timeout=600)
+        wall_time = time.perf_counter() - start
+
+        with open(os.path.join(output_dir, "run_log.jsonl")) as fd:
+            events = [json.loads(line) for line in fd]
+        sweeps = [event for event in events if event["event"] == "sweep_done"]
+        results = [event["result"] for event in sweeps if event["result"] and os.path.exists(os.path.join(output_dir, event["result"]))]
+
+    return {
+        "wall_time_s": wall_time,
+        "events": len(events),
+        "sweeps": len(sweeps),
+        "results": len(results),
+        "status": events[-1].get("status") if events else None,
+    }
+
+
+def print_report(name, report):
+    print(f"\n -- {name} -- ")
+    for key, val in report.items():
+        if isinstance(val, float):
+            print(f"{key:>28}: {val:.3f}")
+        elif not isinstance(val, (list, dict)):
+            print(f"{key:>28}: {val}")
+
+
+def main():
+    args = parse_args()
+    pygame.init()
+
+    try:
+        reports = {}
+        if "response_curve" in args.bench:
+            reports["response_curve"] = bench_response_curve(args)
+        if "sweep" in args.bench:
+            reports["sweep"] = bench_sweep(args)
+        if "startup" in args.bench:
+            reports["startup"] = bench_startup(args)
+        if "headless" in args.bench:
+            reports["headless"] = bench_headless(args)
+    finally:
+        pygame.quit()
+
+    for name, report in reports.items():
+        print_report(name, report)
+
+    if args.json:
+        with open(args.json, 'w') as fd:
+            json.dump(reports, fd, indent=2)
+
+
+if __name__ == "__main__":
+
+    main()
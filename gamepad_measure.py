@@ -1,23 +1,72 @@
 import os
+import re
+import glob
+import hashlib
+import sqlite3
+import json
 import time
+import struct
+import bisect
+from array import array
+import random
 import datetime
 import argparse
+import tempfile
+import multiprocessing
 
-from threading import Thread, Event
+from threading import Thread, Event, Condition
+from collections import deque, namedtuple
 
 import serial
-from serial.tools import list_ports
 
 import pygame
-from pygame._sdl2 import Window
 
 import math
-from tqdm import tqdm
 import csv
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    #not on Windows, only the evdev input needs it
+
+START_TIME_NS = time.perf_counter_ns()
+
 WINDOW_SIZE = (800, 700)
 WINDOW_CAPTION = "GPSM: Game Pad Stats Measurer"
 
+GRAPH_BOX_TOP_LEFT = (100, 50)
+GRAPH_BOX_WIDTH = 600
+GRAPH_BOX_HEIGHT = 400
+GRAPH_BOX_BOTTOM_RIGHT = (GRAPH_BOX_TOP_LEFT[0] + GRAPH_BOX_WIDTH, GRAPH_BOX_TOP_LEFT[1] + GRAPH_BOX_HEIGHT)
+GRAPH_BOX_LINES = 20
+
+GRAPH_DIFF_BOX_TOP_LEFT = (GRAPH_BOX_TOP_LEFT[0], GRAPH_BOX_BOTTOM_RIGHT[1] + 50)
+GRAPH_DIFF_BOX_HEIGHT = 100
+GRAPH_DIFF_BOX_BOTTOM_RIGHT = (GRAPH_DIFF_BOX_TOP_LEFT[0] + GRAPH_BOX_WIDTH, GRAPH_DIFF_BOX_TOP_LEFT[1] + GRAPH_DIFF_BOX_HEIGHT)
+GRAPH_DIFF_BOX_LINES = 10
+
+GRAPH_MAIN_LINE_DELTA = 20
+GRAPH_STATS_MIN_DISTANCE_MM = 14.0
+
+SCREEN_COLOR = (60, 60, 60)
+GRAPH_MAIN_LINE_COLOR = (200, 200, 200)
+GRAPH_SUB_LINE_COLOR = (150, 150, 150)
+GRAPH_LINE_COLOR = (255, 128, 128)
+GRAPH_LINEAR_LINE_COLOR = (150, 150, 150)
+GRAPH_SECOND_LINE_COLOR = (128, 128, 255)
+
+# Renderer: a thread in the measurement process or its own process fed by a SampleRing
+DEFAULT_RENDERER = "thread"
+HEADLESS_LOG_SUFFIX = "_log.jsonl"
+RENDER_RING_CAPACITY = 65536
+RENDER_RING_HEADER = 4
+RENDER_RING_CURVE_COLUMNS = 6
+
 DEFAULT_SERIAL_BAUD_RATE = 115200
 
 REVERSE_MODE = True
@@ -44,6 +93,30 @@ ZD_ULTIMATE_LEGEND_STICK_HEIGHT_MM = 20
 GULIKIT_ES_PRO_STICK_HEIGHT_MM = 22.5
 FLYDIGI_APEX5_STICK_HEIGHT_MM = 21.5
 
+STICK_PROFILES = {
+    "sony_dualshock": SONY_DUALSHOCK_STICK_HEIGHT_MM,
+    "sony_dualshock2": SONY_DUALSHOCK2_STICK_HEIGHT_MM,
+    "sony_ds4": SONY_DS4_STICK_HEIGHT_MM,
+    "sony_ds_edge": SONY_DS_EDGE_STICK_HEIGHT_MM,
+    "mojhon_blitz2": MOJHON_BLITZ2_STICK_HEIGHT_MM,
+    "mojhon_rainbow_3": MOJHON_RAINBOW_3_STICK_HEIGHT_MM,
+    "gamesir_cylone_2": GAMESIR_CYLONE_2_STICK_HEIGHT_MM,
+    "gamesir_g7_se": GAMESIR_G7_SE_STICK_HEIGHT_MM,
+    "gamesir_g7_pro": GAMESIR_G7_PRO_STICK_HEIGHT_MM,
+    "gamesir_nova2_lite": GAMESIR_NOVA2_LITE_STICK_HEIGHT_MM,
+    "gamesir_tegenaria_lite": GAMESIR_TEGENARIA_LITE_STICK_HEIGHT_MM,
+    "8bitdo_ultimate2_wireless": E8BitDo_ULTIMATE2_WIRELESS_STICK_HEIGHT_MM,
+    "nacon_revolution_x_unlimited": NACON_REVOLUTION_X_UNLIMITED_STICK_HEIGHT_MM,
+    "zuiki_evotop": ZUIKI_EVOTOP_STICK_HEIGHT_MM,
+    "razer_wolverine_v3_pro": RAZER_WOLVERINE_V3_PRO_STICK_HEIGHT_MM,
+    "razer_wolverine_v3_te_8k": RAZER_WOLVERINE_V3_TE_8K_STICK_HEIGHT_MM,
+    "zd_o_plus": ZD_O_PLUS_STICK_HEIGHT_MM,
+    "zd_o_plus_low_profile": ZD_O_PLUS_LOW_PROFILE_STICK_HEIGHT_MM,
+    "zd_ultimate_legend": ZD_ULTIMATE_LEGEND_STICK_HEIGHT_MM,
+    "gulikit_es_pro": GULIKIT_ES_PRO_STICK_HEIGHT_MM,
+    "flydigi_apex5": FLYDIGI_APEX5_STICK_HEIGHT_MM,
+}
+
 # CHANGE THIS BEFORE USE
 STICK_HEIGHT_MM = GAMESIR_G7_PRO_STICK_HEIGHT_MM
 STICK_RADIUS_MM = 11
@@ -51,14 +124,80 @@ STICK_RADIUS_MM = 11
 
 MEASURE_FRAME_RATE = 100
 
+# Step scheduler: OS sleep until this close to the deadline, then spinning on perf_counter_ns
+SCHEDULER_SPIN_NS = 200000
+
 TIME_STICK_MOVEMENT_MS = 4
 DEFAULT_BEFORE_SENSE_MS = 4
 DEFAULT_REPEAT_TIMES = 10
 DEFAULT_REPEAT_INTERVAL_MS = 1
 
+# Convergence sampling: sample until the mean is known within +-CONFIDENCE
+DEFAULT_SAMPLING = "fixed"
+CONVERGE_CONFIDENCE = 0.002
+CONVERGE_Z = 1.96               #95%
+CONVERGE_MIN_SAMPLES = 3
+CONVERGE_MAX_SAMPLES = 50
+CONVERGE_SETTLE_THRESHOLD = 0.005
+CONVERGE_RESET_SIGMA = 4.0
+
+# Stream sampling: a thread records every axis change, the steps average over a time window
+SAMPLER_CAPACITY = 65536
+SAMPLER_POLL_INTERVAL_S = 0.0002
+
 DEFAULT_NUM_STEP = 1
 STEP_DISTANCE_MM = 0.025
 
+# Step timing: phases of a measure_main_loop step, histograms keep values within 1/2**(bits-1)
+STEP_PHASES = ("events", "serial", "move", "settle", "sampling", "tick")
+LATENCY_SUB_BUCKET_BITS = 8
+LATENCY_PERCENTILES = (50, 90, 99, 99.9)
+
+# Sweep batch: sweep, motor position and the stick value statistics over the sweeps
+BATCH_COLUMNS = ["sweep", "motor_pos", "n", "mean", "std", "ci_low", "ci_high"]
+BATCH_LEAD_IN_COUNTS = 20       #the next forward sweep starts this far before where the reverse one ended
+
+# Endurance: sweep pairs repeated for hours, rolling raw capture segments and a per-sweep time series to track drift
+ENDURANCE_INTERVAL_S = 600.0
+ENDURANCE_SEGMENT_MB = 64.0
+ENDURANCE_SEGMENT_MINUTES = 60.0
+ENDURANCE_KEEP_SEGMENTS = 4
+ENDURANCE_KEEP_RESULTS = 20     #newest per-sweep result CSVs kept, the older ones are deleted
+ENDURANCE_SUFFIX = "_endurance.csv"
+ENDURANCE_COLUMNS = ["time", "elapsed_s", "pair", "sweep", "rows", "center_mm", "deadzone_start_mm", "deadzone_end_mm", "min_value", "max_value", "result"]
+
+# Timing calibration: the fastest step timing that still reproduces a slow reference sweep, saved per controller
+TIMING_PROFILE_DIR = "timing_profiles"
+TIMING_OPTIONS = ("frame_rate", "before_sense_ms", "repeat_times", "repeat_interval_ms", "stick_movement_ms")
+CALIBRATE_TOLERANCE = 0.01                  #p95 of the value differences to the reference sweep
+CALIBRATE_MARGINS = (1.0, 1.5, 2.0, 3.0, 4.0)
+CALIBRATE_REFERENCE_BEFORE_SENSE_MS = 20.0
+CALIBRATE_REFERENCE_REPEAT_TIMES = 20
+CALIBRATE_REFERENCE_SETTLE_FACTOR = 4.0     #the reference waits at least this many settle times
+CALIBRATE_HOLD_S = 2.0
+CALIBRATE_SETTLE_STEPS = 40
+CALIBRATE_SETTLE_STEP_COUNTS = 8            #a single step can be within the noise
+CALIBRATE_SETTLE_WINDOW_MS = 100.0
+CALIBRATE_SETTLE_TAIL_MS = 20.0
+CALIBRATE_READS = 200
+CALIBRATE_MIN_MS = 0.25
+CALIBRATE_FRAME_MARGIN = 1.25
+
+# Checkpoint: resuming stepped sweeps after the controller was removed
+CHECKPOINT_FILENAME = "gpsm_checkpoint.json"
+CHECKPOINT_INTERVAL_STEPS = 50
+REATTACH_TIMEOUT_S = 120.0
+REATTACH_POLL_INTERVAL_S = 0.2
+
+# Adaptive sweep: coarse steps while the stick is pinned at -1/1 and through stretches where the value does not change
+ADAPTIVE_COARSE_STEPS = 8
+ADAPTIVE_FLAT_STEPS = 4         #unchanged values in a row after the movement started before stepping coarse
+
+# Continuous sweep: the motor runs through the range at a constant speed
+CONTINUOUS_RANGE_MM = 18.0
+CONTINUOUS_SPEED_MM_S = 10.0
+CONTINUOUS_EVENT_INTERVAL_S = 0.01
+
 LINEAR_CURVE_MAX_DEGREE = 21.1596 #21.1596
 LINEAR_CURVE_MAX_DISTANCE = 7.62
 LINEAR_CURVE_CENTER_MAX_DISTANCE = 6.782
@@ -67,6 +206,127 @@ STICK_THRESHOLD = 0.999
 STICK_END_THRESHOLD = 0.99
 
 BUTTONS_MAP = {'A': 0, 'B': 1, 'X': 2, 'Y': 3, 'SELECT': 4, 'HOME': 5, 'START': 6, 'LS': 7, 'RS': 8, 'LB': 9, 'RB': 10, 'UP': 11, 'DOWN': 12, 'LEFT': 13, 'RIGHT': 14, 'TOUCHPAD': 15}
+AXIS_INDEXES = {'lx': 0, 'ly': 1, 'rx': 2, 'ry': 3, 'lt': 4, 'rt': 5}
+ANOTHER_AXIS = {'lx': 'ly', 'ly': 'lx', 'rx': 'ry', 'ry': 'rx'}
+
+# Linux evdev input (linux/input.h)
+EVDEV_EVENT = struct.Struct("llHHi")        #struct input_event: timeval, type, code, value
+EVDEV_ABSINFO = struct.Struct("6i")         #value, minimum, maximum, fuzz, flat, resolution
+EVDEV_EV_SYN = 0x00
+EVDEV_EV_ABS = 0x03
+EVDEV_SYN_REPORT = 0
+EVDEV_SYN_DROPPED = 3
+EVDEV_IOC_WRITE = 1
+EVDEV_IOC_READ = 2
+EVDEV_IOCTL_CLOCKID = (EVDEV_IOC_WRITE << 30) | (4 << 16) | (ord('E') << 8) | 0xa0
+EVDEV_AXIS_CODES = {'lx': 0x00, 'ly': 0x01, 'rx': 0x03, 'ry': 0x04, 'lt': 0x02, 'rt': 0x05}   #ABS_X, ABS_Y, ABS_RX, ABS_RY, ABS_Z, ABS_RZ
+EVDEV_SDL_AXES = {idx: axis for axis, idx in AXIS_INDEXES.items()}
+EVDEV_READ_EVENTS = 256
+EVDEV_PENDING_REPORTS = 4096
+EVDEV_RECORD_INTERVAL_S = 0.001
+EVDEV_RECORDING_EXTENSION = ".evrec"
+
+# Simulated Rig (same values as arduino.ino)
+FIRMWARE_STEP_DELAY_US = 500
+FIRMWARE_STEP_MS = 2 * FIRMWARE_STEP_DELAY_US / 1000
+FIRMWARE_TRAVEL_START_SPEED = 1000      #steps/s, the speed of the measuring steps
+FIRMWARE_TRAVEL_MAX_SPEED = 4000        #steps/s
+FIRMWARE_TRAVEL_ACCEL = 20000           #steps/s^2
+SIM_JOYSTICK_NAME = "GPSM Virtual Joystick"
+SIM_STICK_CENTER_MM = 9.0       #motor position where the stick is neutral
+SIM_STICK_TRAVEL_MM = 7.0       #motor travel from neutral to full deflection
+SIM_DEADZONE = 0.05
+SIM_CURVE = 1.0                 #1.0 is linear, larger is flatter around the center
+SIM_NOISE = 0.0                 #standard deviation of the deflection noise
+SIM_LATENCY_MS = 0.0
+SIM_HISTORY_S = 1.0
+
+# Serial Motion Protocol (same values as arduino.ino)
+DEFAULT_PROTOCOL = "auto"
+PROTOCOL_VERSION = 1
+PROTOCOL_SYNC = 0xA5
+PROTOCOL_ACK_SYNC = 0x5A
+PROTOCOL_FRAME = struct.Struct("<BBBBi")
+PROTOCOL_FRAME_SIZE = PROTOCOL_FRAME.size + 1
+PROTOCOL_ACK_FRAME = struct.Struct("<BBBBiI")
+PROTOCOL_ACK_FRAME_SIZE = PROTOCOL_ACK_FRAME.size + 1
+PROTOCOL_CMD_MOVE = ord('M')
+PROTOCOL_CMD_HELLO = ord('V')
+PROTOCOL_CMD_STEP_DELAY = ord('D')
+PROTOCOL_CMD_SWEEP = ord('S')
+PROTOCOL_CMD_TRAVEL = ord('T')
+PROTOCOL_ACK_DONE = ord('A')
+PROTOCOL_ACK_HELLO = ord('V')
+PROTOCOL_ACK_ERROR = ord('E')
+PROTOCOL_ACK_PROGRESS = ord('P')
+PROTOCOL_ACK_TIMEOUT_S = 0.5
+PROTOCOL_READ_TIMEOUT_S = 0.1
+PROTOCOL_RETRIES = 3
+PROTOCOL_BOOT_TIMEOUT_S = 3.0           #opening the port resets the Arduino, the bootloader takes about 2s
+
+# Sample Store
+STATS_COLUMNS = [("timestamps", "q"), ("elapsed_time", "d"), ("motor_pos", "d"),
+                 ("lx", "d"), ("ly", "d"), ("rx", "d"), ("ry", "d"), ("lt", "d"), ("rt", "d"),
+                 ("samples", "l"), ("settle_ms", "d")]
+STATS_INITIAL_CAPACITY = 1024
+
+# Raw Capture
+RAW_CAPTURE_MAGIC = b"GPSMRAW\0"
+RAW_CAPTURE_VERSION = 1
+RAW_CAPTURE_EXTENSION = ".gpsmraw"
+RAW_CAPTURE_HEAD = struct.Struct("<HI")
+RAW_CAPTURE_RECORD = struct.Struct("<HB" + "".join(typecode for key, typecode in STATS_COLUMNS))
+RAW_CAPTURE_FLAG_REVERSE = 0x01
+RAW_CAPTURE_FLAG_DROP = 0x02
+
+# Batch Analysis
+ANALYZE_CACHE_FILENAME = "gpsm_analyze_cache.json"
+ANALYZE_CACHE_VERSION = 3               #the metrics of another version are computed again
+ANALYZE_SUMMARY_FILENAME = "gpsm_analyze_summary.csv"
+ANALYZE_DEADZONE_VALUE = 0.01           #values this close to 0 are in the deadzone
+ANALYZE_LINEARITY_RANGE = (0.1, 0.95)   #values where the linearity is measured
+ANALYZE_CHUNK_SIZE = 16
+ANALYZE_COLUMNS = ["file", "rows", "trend", "deadzone_mm", "deadzone_deg", "linearity_deg_mean_pct", "linearity_deg_max_pct",
+                   "linearity_dist_mean_pct", "linearity_dist_max_pct", "hysteresis_mean", "hysteresis_max"]
+
+# Off-screen rendering
+RENDER_FORMATS = ("png", "svg")
+RENDER_COLORS = [GRAPH_LINE_COLOR, GRAPH_SECOND_LINE_COLOR, (128, 220, 128), (240, 200, 90), (200, 128, 240), (90, 210, 220), (240, 150, 60), (200, 200, 200)]
+RENDER_LEGEND_TOP = GRAPH_DIFF_BOX_TOP_LEFT[1] + GRAPH_DIFF_BOX_HEIGHT * 3 // 2 + 10      #below a diff of -1
+RENDER_LEGEND_LINE_HEIGHT = 18
+RENDER_PAIR_SUFFIX = "_pair"
+RENDER_COMPARISON_NAME = "comparison"
+RENDER_CHUNK_SIZE = 4
+
+# Curve library
+CURVE_LIBRARY_FILENAME = "gpsm_curves.sqlite"
+CURVE_LIBRARY_VERSION = 1           #the grids below, the blobs of another version can not be compared
+CURVE_GRID_DISTANCE_MM = 8.0
+CURVE_GRID_DISTANCE_STEP_MM = 0.1
+CURVE_GRID_DEGREES = 22.0
+CURVE_GRID_DEGREE_STEP = 0.25
+CURVE_MATCH_MIN_OVERLAP = 0.5       #share of the measured grid points of the query another curve has to cover
+CURVE_MATCH_RESULTS = 5
+CURVE_QUERY_COLUMNS = ["id", "created", "controller", "joystick_axis", "stick_height_mm", "trend", "source"]
+CURVE_LIBRARY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS curves (
+    id INTEGER PRIMARY KEY,
+    sha256 TEXT UNIQUE NOT NULL,
+    source TEXT,
+    controller TEXT,
+    joystick_axis TEXT,
+    stick_height_mm REAL,
+    created TEXT,
+    trend INTEGER,
+    distances BLOB,
+    degrees BLOB
+);
+CREATE INDEX IF NOT EXISTS curves_controller ON curves (controller, joystick_axis, created);
+CREATE INDEX IF NOT EXISTS curves_axis ON curves (joystick_axis, created);
+CREATE INDEX IF NOT EXISTS curves_created ON curves (created);
+"""
+
+MotionAck = namedtuple("MotionAck", ["status", "seq", "pos", "t_us", "received_at"])
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -78,8 +338,182 @@ def parse_args():
                     type=int, default=0)
     parser.add_argument("-a", "--axis", help="select joystick axis",
                     default="rx")
+    parser.add_argument("--adaptive", help="take coarse steps while the stick is pinned at -1/1 and where the value does not change (deadzone)",
+                    action="store_true")
+    parser.add_argument("--continuous", help="move the motor at a constant speed and correlate the samples with the streamed steps (needs the acknowledged protocol)",
+                    action="store_true")
+    parser.add_argument("--sampling", help="fixed: read all axes DEFAULT_REPEAT_TIMES times, converge: read the measured axes until settled, stream: average what a sampler thread records (stepped sweeps)",
+                    choices=["fixed", "converge", "stream"], default=DEFAULT_SAMPLING)
+    parser.add_argument("--confidence", help="converge sampling target, half width of the confidence interval",
+                    type=float, default=CONVERGE_CONFIDENCE)
+    parser.add_argument("--frame_rate", help=f"measuring steps per second; defaults to the timing profile of the controller or {MEASURE_FRAME_RATE}",
+                    type=float, default=None)
+    parser.add_argument("--before_sense_ms", help=f"settle time after a step before sampling, can be fractional; defaults to the timing profile or {DEFAULT_BEFORE_SENSE_MS}",
+                    type=float, default=None)
+    parser.add_argument("--repeat_times", help=f"reads of the fixed and stream sampling; defaults to the timing profile or {DEFAULT_REPEAT_TIMES}",
+                    type=int, default=None)
+    parser.add_argument("--repeat_interval_ms", help=f"interval of the repeated reads, can be fractional; defaults to the timing profile or {DEFAULT_REPEAT_INTERVAL_MS}",
+                    type=float, default=None)
+    parser.add_argument("--stick_movement_ms", help=f"wait for a step with the legacy protocol, can be fractional; defaults to the timing profile or {TIME_STICK_MOVEMENT_MS}",
+                    type=float, default=None)
+    parser.add_argument("--no_profile", help="do not load the timing profile of the controller from " + TIMING_PROFILE_DIR,
+                    action="store_true")
+    parser.add_argument("--protocol", help="serial protocol, auto: acknowledged if the firmware answers, otherwise legacy",
+                    choices=["auto", "ack", "legacy"], default=DEFAULT_PROTOCOL)
+    parser.add_argument("--simulate", help="use the simulated stepper and virtual joystick instead of the rig",
+                    action="store_true")
+    parser.add_argument("--sim_deadzone", help="virtual joystick deadzone (0.0 - 1.0)",
+                    type=float, default=SIM_DEADZONE)
+    parser.add_argument("--sim_curve", help="virtual joystick response curve exponent",
+                    type=float, default=SIM_CURVE)
+    parser.add_argument("--sim_noise", help="virtual joystick noise (standard deviation)",
+                    type=float, default=SIM_NOISE)
+    parser.add_argument("--sim_latency_ms", help="virtual joystick latency in ms",
+                    type=float, default=SIM_LATENCY_MS)
+    parser.add_argument("--renderer", help="thread: draw the graph in the measurement process, process: draw it in its own process so it does not disturb the step timing",
+                    choices=["thread", "process"], default=DEFAULT_RENDERER)
+    parser.add_argument("--headless", help="no window (SDL dummy video driver), no graph and no prompts; the progress goes to a JSON lines log",
+                    action="store_true")
+    parser.add_argument("--log", help="JSON lines log of the headless mode; defaults to the start time + " + HEADLESS_LOG_SUFFIX,
+                    default=None)
+    parser.add_argument("--evdev", help="read the controller from a Linux event device (/dev/input/event*) or replay a recording (*" + EVDEV_RECORDING_EXTENSION + ") instead of SDL",
+                    default=None)
+    parser.add_argument("--no_capture", help="do not write the raw capture file",
+                    action="store_true")
+    parser.add_argument("-n", "--sweeps", help="number of sweep pairs run back to back without asking, the results are aggregated with confidence bands",
+                    type=int, default=1)
+    parser.add_argument("--endurance", help="repeat sweep pairs for this many hours to track drift, with rolling raw capture segments and a per-sweep summary time series (*" + ENDURANCE_SUFFIX + ")",
+                    type=float, default=None)
+    parser.add_argument("--endurance_interval_s", help="time from the start of one endurance sweep pair to the next",
+                    type=float, default=ENDURANCE_INTERVAL_S)
+    parser.add_argument("--segment_mb", help="size limit of an endurance raw capture segment",
+                    type=float, default=ENDURANCE_SEGMENT_MB)
+    parser.add_argument("--segment_minutes", help="time limit of an endurance raw capture segment",
+                    type=float, default=ENDURANCE_SEGMENT_MINUTES)
+    parser.add_argument("--keep_segments", help="newest endurance raw capture segments kept on disk",
+                    type=int, default=ENDURANCE_KEEP_SEGMENTS)
+    parser.add_argument("--library", help="add the curve of every sweep to a curve library with the controller, axis and stick height",
+                    nargs="?", const=CURVE_LIBRARY_FILENAME, default=None)
+    parser.add_argument("--resume", help="resume the sweep of a checkpoint file left by an interrupted run",
+                    nargs="?", const=CHECKPOINT_FILENAME, default=None)
+
+    subparsers = parser.add_subparsers(dest="command")
+    reanalyze_parser = subparsers.add_parser("reanalyze", help="recompute the response curves of a raw capture file")
+    reanalyze_parser.add_argument("capture", help="raw capture file (*" + RAW_CAPTURE_EXTENSION + ")")
+    reanalyze_parser.add_argument("-s", "--stick", help="stick height, a profile name (" + ", ".join(STICK_PROFILES) + ") or mm; defaults to the captured one",
+                    default=None)
+    reanalyze_parser.add_argument("-o", "--output_dir", help="directory of the result CSVs; defaults to the one of the capture",
+                    default=None)
+
+    multi_parser = subparsers.add_parser("multi", help="run sweeps on several rigs at once, the other options are taken from before the subcommand")
+    multi_parser.add_argument("rigs", help='rig assignments "port:controller:axis[:stick]", port is a device name, a com port index or "sim"',
+                    nargs="+")
+    multi_parser.add_argument("-o", "--output_dir", help="directory of the rig{n}_{port} result directories",
+                    default=".")
+
+    analyze_parser = subparsers.add_parser("analyze", help="summarize the result CSVs under a directory")
+    analyze_parser.add_argument("directory", help="directory searched for result CSVs, the cache and the summary are written there")
+    analyze_parser.add_argument("-j", "--jobs", help="number of worker processes; defaults to the number of CPUs",
+                    type=int, default=None)
+    analyze_parser.add_argument("-o", "--output", help="summary CSV; defaults to " + ANALYZE_SUMMARY_FILENAME + " in the directory",
+                    default=None)
+
+    calibrate_parser = subparsers.add_parser("calibrate", help="find the fastest step timing that still reproduces a slow reference sweep and save it as the timing profile of the controller, the rig is selected by the options before the subcommand")
+    calibrate_parser.add_argument("-t", "--tolerance", help="allowed p95 difference of the stick values to the reference sweep",
+                    type=float, default=CALIBRATE_TOLERANCE)
+    calibrate_parser.add_argument("-m", "--margins", help="factors on the measured settle time and read count, tried in order",
+                    type=float, nargs="+", default=list(CALIBRATE_MARGINS))
+
+    render_parser = subparsers.add_parser("render", help="draw result CSVs to images without a window, every sweep pair (or unpaired CSV) under the directories gets its own image")
+    render_parser.add_argument("paths", help="directories searched for result CSVs, with --compare also result CSVs",
+                    nargs="+")
+    render_parser.add_argument("-f", "--format", help="image format",
+                    choices=RENDER_FORMATS, default=RENDER_FORMATS[0])
+    render_parser.add_argument("-o", "--output", help="directory of the images, defaults to next to the CSVs; with --compare the image file",
+                    default=None)
+    render_parser.add_argument("--compare", help="draw all the result CSVs in one chart, for comparing controllers",
+                    action="store_true")
+    render_parser.add_argument("--force", help="draw the images that are newer than their CSVs too",
+                    action="store_true")
+    render_parser.add_argument("-j", "--jobs", help="number of worker processes; defaults to the number of CPUs",
+                    type=int, default=None)
+
+    library_parser = subparsers.add_parser("library", help="the local curve library (SQLite): add result CSVs, query them by their metadata or find the curves nearest to a result")
+    library_parser.add_argument("action", help="add: result CSVs or directories of them, query: list the curves, match: the curves nearest to a result CSV",
+                    choices=["add", "query", "match"])
+    library_parser.add_argument("files", help="result CSVs or directories to add, or the result CSV to match",
+                    nargs="*")
+    library_parser.add_argument("--db", help="library file",
+                    default=CURVE_LIBRARY_FILENAME)
+    library_parser.add_argument("--controller", help="add: controller name of the CSVs, query/match: name or LIKE pattern, a part of the name is enough",
+                    default=None)
+    library_parser.add_argument("--joystick_axis", help="add: axis of the CSVs (defaults to -a), query/match: only this axis",
+                    default=None)
+    library_parser.add_argument("-s", "--stick", help="add: stick height of the CSVs, a profile name (" + ", ".join(STICK_PROFILES) + ") or mm",
+                    default=None)
+    library_parser.add_argument("--since", help="query: curves created on or after this ISO date",
+                    default=None)
+    library_parser.add_argument("--until", help="query: curves created before this ISO date",
+                    default=None)
+    library_parser.add_argument("--days", help="query: curves of the last days",
+                    type=float, default=None)
+    library_parser.add_argument("-k", "--count", help="match: number of nearest curves",
+                    type=int, default=CURVE_MATCH_RESULTS)
+
+    record_parser = subparsers.add_parser("record_evdev", help="record the events of a Linux event device for --evdev replays")
+    record_parser.add_argument("device", help="event device, /dev/input/event* or /dev/input/by-id/*-event-joystick")
+    record_parser.add_argument("output", help="recording file (*" + EVDEV_RECORDING_EXTENSION + ")")
+    record_parser.add_argument("-s", "--seconds", help="recording time",
+                    type=float, default=10.0)
     return parser.parse_args()
 
+# ms since the start like pygame.time.get_ticks(), which stays 0 without the full pygame.init()
+def ticks_ms():
+    return (time.perf_counter_ns() - START_TIME_NS) // 1000000
+
+# Waiting until a perf_counter_ns deadline: sleeping while far from it, spinning for the last SCHEDULER_SPIN_NS.
+# Unlike pygame.time.wait, fractions of ms are kept and the OS sleep jitter does not add up.
+def sleep_until_ns(deadline_ns):
+    remaining_ns = deadline_ns - time.perf_counter_ns()
+    if SCHEDULER_SPIN_NS < remaining_ns:
+        time.sleep((remaining_ns - SCHEDULER_SPIN_NS) / 1000000000)
+    while time.perf_counter_ns() < deadline_ns:
+        time.sleep(0)   #lets the serial reader and sampler threads have the GIL
+
+def precise_wait_ms(ms):
+    sleep_until_ns(time.perf_counter_ns() + int(ms * 1000000))
+
+# Waiting for a deadline while pumping SDL so a JoystickSampler sees the joystick change, only the main thread pumps.
+def pump_until_ns(deadline_ns):
+    while time.perf_counter_ns() < deadline_ns:
+        pygame.event.pump()
+        sleep_until_ns(min(deadline_ns, time.perf_counter_ns() + int(SAMPLER_POLL_INTERVAL_S * 1000000000)))
+
+
+# Fixed rate steps on absolute deadlines in place of pygame.time.Clock.tick. A step that ends after its
+# deadline is a miss, the next one is a whole period later instead of catching up.
+class StepScheduler:
+    def __init__(self, rate_hz = MEASURE_FRAME_RATE):
+        self.period_ns = int(1000000000 / rate_hz)
+        self.misses = 0
+        self.ticks = 0
+        self.max_late_ns = 0
+        self._deadline_ns = time.perf_counter_ns() + self.period_ns
+
+    # Returns the ns the deadline was missed by, 0 when it was waited for
+    def tick(self):
+        self.ticks += 1
+        late_ns = time.perf_counter_ns() - self._deadline_ns
+        if 0 < late_ns:
+            self.misses += 1
+            self.max_late_ns = max(self.max_late_ns, late_ns)
+            self._deadline_ns = time.perf_counter_ns() + self.period_ns
+            return late_ns
+
+        sleep_until_ns(self._deadline_ns)
+        self._deadline_ns += self.period_ns
+        return 0
+
 def fix_stick_val(val):
     if 0 < val:
         return (math.ceil(val * 100000) / 100000 + 0.00001) / 0.99998
@@ -87,51 +521,917 @@ def fix_stick_val(val):
         return (math.floor(val * 100000) / 100000 + 0.00002) / 0.99998
     return val
 
-def measure_stats(joystick, stats, cur_ms, elapsed_time, motor_pos):
-    sum_lx = 0; sum_ly = 0; sum_rx = 0; sum_ry = 0
-    sum_lt = 0; sum_rt = 0
-
-    pygame.time.wait(DEFAULT_BEFORE_SENSE_MS)
-
-    for i in range(0, DEFAULT_REPEAT_TIMES, 1):
-        sum_lx += fix_stick_val(joystick.get_axis(0))
-        sum_ly += fix_stick_val(joystick.get_axis(1))
-        sum_rx += fix_stick_val(joystick.get_axis(2))
-        sum_ry += fix_stick_val(joystick.get_axis(3))
-        sum_lt += fix_stick_val(joystick.get_axis(4))
-        sum_rt += fix_stick_val(joystick.get_axis(5))
-
-        pygame.time.wait(DEFAULT_REPEAT_INTERVAL_MS)
-
-    lx = sum_lx / DEFAULT_REPEAT_TIMES
-    ly = sum_ly / DEFAULT_REPEAT_TIMES
-    rx = sum_rx / DEFAULT_REPEAT_TIMES
-    ry = sum_ry / DEFAULT_REPEAT_TIMES
-    lt = sum_lt / DEFAULT_REPEAT_TIMES
-    rt = sum_rt / DEFAULT_REPEAT_TIMES
-
-    stats["timestamps"].append(cur_ms)
-    stats["motor_pos"].append(motor_pos)
-    stats["elapsed_time"].append(elapsed_time)
-    stats["lx"].append(lx)
-    stats["ly"].append(ly)
-    stats["rx"].append(rx)
-    stats["ry"].append(ry)
-    stats["lt"].append(lt)
-    stats["rt"].append(rt)
+
+## Serial Motion Protocol
+# Host -> firmware: SYNC, VERSION, CMD, SEQ, int32 ARG, CHECKSUM
+# Firmware -> host: ACK_SYNC, VERSION, STATUS, SEQ, int32 POS, uint32 micros(), CHECKSUM
+# Lines without SYNC are still taken as the legacy "{pos}\n" commands.
+def protocol_checksum(data):
+    return sum(data) & 0xFF
+
+def protocol_frame(cmd, seq, arg):
+    frame = PROTOCOL_FRAME.pack(PROTOCOL_SYNC, PROTOCOL_VERSION, cmd, seq, arg)
+    return frame + bytes([protocol_checksum(frame)])
+
+def protocol_ack_frame(status, seq, pos, t_us):
+    frame = PROTOCOL_ACK_FRAME.pack(PROTOCOL_ACK_SYNC, PROTOCOL_VERSION, status, seq, pos, t_us & 0xFFFFFFFF)
+    return frame + bytes([protocol_checksum(frame)])
+
+
+class MotionLinkError(Exception):
+    pass
+
+
+# Trapezoidal profile of the travel command: steps while accelerating (and decelerating), peak speed, seconds while accelerating, seconds at the peak speed.
+# Short travels never reach FIRMWARE_TRAVEL_MAX_SPEED and turn around in the middle.
+def travel_profile(steps):
+    v0 = FIRMWARE_TRAVEL_START_SPEED
+    accel = FIRMWARE_TRAVEL_ACCEL
+    ramp_steps = min((FIRMWARE_TRAVEL_MAX_SPEED ** 2 - v0 ** 2) / (2 * accel), steps / 2)
+    peak_speed = math.sqrt(v0 ** 2 + 2 * accel * ramp_steps)
+    ramp_s = (peak_speed - v0) / accel
+    cruise_s = (steps - 2 * ramp_steps) / peak_speed
+    return ramp_steps, peak_speed, ramp_s, cruise_s
+
+def travel_time_s(steps):
+    ramp_steps, peak_speed, ramp_s, cruise_s = travel_profile(steps)
+    return 2 * ramp_s + cruise_s
+
+def travel_steps_done(t, steps):
+    ramp_steps, peak_speed, ramp_s, cruise_s = travel_profile(steps)
+    v0 = FIRMWARE_TRAVEL_START_SPEED
+    accel = FIRMWARE_TRAVEL_ACCEL
+    if t < ramp_s:
+        done = v0 * t + accel * t * t / 2
+    elif t < ramp_s + cruise_s:
+        done = ramp_steps + peak_speed * (t - ramp_s)
+    else:
+        t -= ramp_s + cruise_s
+        done = steps - ramp_steps + peak_speed * t - accel * t * t / 2
+    return min(steps, int(done))
+
+
+# Host side of the protocol. A reader thread collects acks so several commands can be in flight.
+class MotionLink:
+    def __init__(self, ser, ack_timeout_s = PROTOCOL_ACK_TIMEOUT_S, retries = PROTOCOL_RETRIES):
+        self.ser = ser
+        self.ack_timeout_s = ack_timeout_s
+        self.retries = retries
+        self.version = None
+        self.position = 0
+        self.travel_supported = True
+        self.counters = {"sent": 0, "resent": 0, "timeouts": 0, "naks": 0, "garbled": 0, "position_errors": 0}
+
+        self.stream = []        # (pos, micros(), received at) for every step of a sweep
+
+        self._seq = 0
+        self._pending = {}      # seq -> [frame, expected pos, deadline, attempts, move seconds]
+        self._acks = {}
+        self._cond = Condition()
+        self._running = True
+
+        self.ser.timeout = PROTOCOL_READ_TIMEOUT_S
+        self._reader = Thread(target=self._read_loop, daemon=True)
+        self._reader.start()
+
+    def _read_loop(self):
+        while self._running:
+            head = self.ser.read(1)
+            if not head:
+                continue
+            if head[0] != PROTOCOL_ACK_SYNC:
+                self.counters["garbled"] += 1
+                continue
+
+            frame = head + self.ser.read(PROTOCOL_ACK_FRAME_SIZE - 1)
+            if len(frame) < PROTOCOL_ACK_FRAME_SIZE or protocol_checksum(frame[:-1]) != frame[-1]:
+                self.counters["garbled"] += 1
+                continue
+
+            sync, version, status, seq, pos, t_us = PROTOCOL_ACK_FRAME.unpack(frame[:-1])
+            if status == PROTOCOL_ACK_PROGRESS:
+                self.stream.append((pos, t_us, time.perf_counter()))
+                continue
+
+            with self._cond:
+                self._acks[seq] = MotionAck(status, seq, pos, t_us, time.perf_counter())
+                self._cond.notify_all()
+
+    def _write(self, seq):
+        # The firmware works through the commands in flight one by one
+        queued_s = sum(pending[4] for pending in self._pending.values())
+        pending = self._pending[seq]
+        pending[2] = time.perf_counter() + queued_s + self.ack_timeout_s
+        pending[3] += 1
+        self.ser.write(pending[0])
+
+    # Sending a command without waiting, returns the sequence number to wait for.
+    def send(self, cmd, arg = 0, expected_pos = None, move_s = 0.0):
+        with self._cond:
+            seq = self._seq
+            self._seq = (self._seq + 1) & 0xFF
+            self._acks.pop(seq, None)
+            self._pending[seq] = [protocol_frame(cmd, seq, arg), expected_pos, 0, 0, move_s]
+            self._write(seq)
+            self.counters["sent"] += 1
+            return seq
+
+    def wait(self, seq):
+        with self._cond:
+            while True:
+                pending = self._pending[seq]
+                ack = self._acks.pop(seq, None)
+
+                if ack is not None and ack.status == PROTOCOL_ACK_ERROR:
+                    self.counters["naks"] += 1
+                    self._resend(seq)
+                    continue
+
+                if ack is not None:
+                    del self._pending[seq]
+                    if pending[1] is not None and ack.pos != pending[1]:
+                        self.counters["position_errors"] += 1
+                        print(f'\n\033[31mmotor is at {ack.pos} but {pending[1]} was requested.\033[0m')
+                    return ack
+
+                remaining = pending[2] - time.perf_counter()
+                if remaining <= 0:
+                    self.counters["timeouts"] += 1
+                    self._resend(seq)
+                    continue
+
+                self._cond.wait(remaining)
+
+    def _resend(self, seq):
+        if self.retries < self._pending[seq][3]:
+            del self._pending[seq]
+            raise MotionLinkError(f"no acknowledgement for command {seq} after {self.retries} retries")
+        self.counters["resent"] += 1
+        self._write(seq)
+
+    def is_acked(self, seq):
+        with self._cond:
+            return seq in self._acks
+
+    def move_to(self, pos):
+        seq = self.send(PROTOCOL_CMD_MOVE, pos, pos, abs(pos - self.position) * FIRMWARE_STEP_MS / 1000)
+        self.position = pos
+        return self.wait(seq)
+
+    # Positioning without measuring, the ack comes when the travel is done.
+    # Firmware without the travel command rejects it and the constant speed move is used from then on.
+    def travel_to(self, pos):
+        if self.travel_supported:
+            try:
+                ack = self.wait(self.send(PROTOCOL_CMD_TRAVEL, pos, pos, travel_time_s(abs(pos - self.position))))
+                self.position = pos
+                return ack
+            except MotionLinkError:
+                self.travel_supported = False
+                print("\n\033[31mfirmware does not know the travel command, positioning at the measuring speed.\033[0m")
+        return self.move_to(pos)
+
+    # Starting a constant speed move which streams every step, returns the sequence number to wait for.
+    def sweep_to(self, pos, step_delay_us):
+        self.wait(self.send(PROTOCOL_CMD_STEP_DELAY, step_delay_us))
+        self.stream = []
+        seq = self.send(PROTOCOL_CMD_SWEEP, pos, pos, abs(pos - self.position) * 2 * step_delay_us / 1000000)
+        self.position = pos
+        return seq
+
+    # The handshake is repeated until the firmware is booted
+    def hello(self, timeout_s = PROTOCOL_BOOT_TIMEOUT_S):
+        retries = self.retries
+        self.retries = 0
+        deadline = time.perf_counter() + timeout_s
+        try:
+            while True:
+                try:
+                    ack = self.wait(self.send(PROTOCOL_CMD_HELLO))
+                    self.version = PROTOCOL_VERSION
+                    self.position = ack.pos
+                    return ack
+                except MotionLinkError:
+                    if deadline <= time.perf_counter():
+                        return None
+        finally:
+            self.retries = retries
+
+    def stop(self):
+        self._running = False
+        self._reader.join()
+
+    def close(self):
+        self.stop()
+        self.ser.close()
+
+
+def open_motion_link(ser, protocol = DEFAULT_PROTOCOL):
+    if protocol == "legacy":
+        return ser
+
+    link = MotionLink(ser)
+    if link.hello():
+        print(f'firmware protocol version {link.version}, motor at {link.position}.')
+        return link
+
+    link.stop()
+    if protocol == "ack":
+        raise MotionLinkError("firmware did not answer the protocol handshake")
+
+    # Terminating the handshake bytes the legacy firmware takes as a line
+    ser.write("\n".encode())
+    print("firmware did not answer, using the legacy protocol.")
+    return ser
+
+
+# Moving the motor to pos (in firmware steps) and waiting until it is there.
+# travel is for positioning between measurements, with the acknowledged protocol it is the fast trapezoidal move.
+def move_motor(ser, pos, timing, moved_steps = 1, timer = None, travel = False):
+    if isinstance(ser, MotionLink):
+        ack = ser.travel_to(pos) if travel else ser.move_to(pos)
+        if timer:
+            timer.mark("move")
+        return ack
+
+    # The legacy firmware travels at the measuring speed from where it was last sent to, 0 after the reset
+    if travel:
+        moved_steps = abs(pos - getattr(ser, "last_pos", 0))
+    ser.last_pos = pos
+
+    ser.write(f"{pos}\n".encode())
+    if timer:
+        timer.mark("serial")
+
+    # Longer moves take one more firmware step time per step
+    precise_wait_ms(timing["stick_movement_ms"] + max(moved_steps - 1, 0) * FIRMWARE_STEP_MS)
+    if timer:
+        timer.mark("move")
+
+
+## Simulated Rig
+# Stand-in for serial.Serial connected to arduino.ino.
+# Moves are queued like the firmware does and take STEP_DELAY * 2 per step, travels follow travel_profile.
+# Frames can be dropped or corrupted on the way to the firmware to test the protocol.
+class SimulatedSerial:
+    def __init__(self, step_delay_us = FIRMWARE_STEP_DELAY_US, baud_rate = DEFAULT_SERIAL_BAUD_RATE, drop_rate = 0.0, corrupt_rate = 0.0, seed = None):
+        self.step_delay_us = step_delay_us
+        self.baud_rate = baud_rate
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.timeout = None
+        self.is_open = True
+        self.current_pos = 0
+
+        self._rx = bytearray()
+        self._tx = deque()      # (available time, bytes)
+        self._tx_ready = bytearray()
+        self._busy_until = 0.0
+        self._moves = deque([(0.0, 0, 0, 0.0)]) # (start time, from pos, to pos, seconds per step)
+        self._sweep_step_delay_us = step_delay_us
+        self._last_seq = -1
+        self._last_cmd = 0
+        self._last_status = 0
+        self._boot_time = time.perf_counter()
+        self._random = random.Random(seed)
+        self._cond = Condition()
+
+    def _wire_time(self, size):
+        # 10 bits per byte on the wire
+        return size * 10 / self.baud_rate
+
+    def write(self, data):
+        now = time.perf_counter()
+        with self._cond:
+            self._rx += data
+            while self._rx:
+                if self._rx[0] == PROTOCOL_SYNC:
+                    if len(self._rx) < PROTOCOL_FRAME_SIZE:
+                        break
+                    frame = bytes(self._rx[:PROTOCOL_FRAME_SIZE])
+                    del self._rx[:PROTOCOL_FRAME_SIZE]
+                    self._firmware_frame(frame, now + self._wire_time(len(frame)))
+                else:
+                    end = self._rx.find(b"\n")
+                    if end < 0:
+                        break
+                    line = bytes(self._rx[:end])
+                    del self._rx[:end + 1]
+                    self._firmware_command(line, now + self._wire_time(end + 1))
+            self._cond.notify_all()
+        return len(data)
+
+    def _firmware_command(self, line, received_at):
+        if line.strip() == b"":
+            return
+
+        # String.toInt() returns 0 for lines without a number
+        match = re.match(rb"\s*(-?\d+)", line)
+        target_pos = int(match.group(1)) if match else 0
+
+        self._start_move(target_pos, received_at)
+
+    def _firmware_frame(self, frame, received_at):
+        if self._random.random() < self.drop_rate:
+            return
+        if self._random.random() < self.corrupt_rate:
+            frame = frame[:4] + bytes([frame[4] ^ 0xFF]) + frame[5:]
+
+        sync, version, cmd, seq, arg = PROTOCOL_FRAME.unpack(frame[:-1])
+        if version != PROTOCOL_VERSION or protocol_checksum(frame[:-1]) != frame[-1]:
+            self._send_ack(PROTOCOL_ACK_ERROR, seq, max(received_at, self._busy_until))
+            return
+
+        # Resent command, the ack was lost
+        if seq == self._last_seq and cmd == self._last_cmd:
+            self._send_ack(self._last_status, seq, max(received_at, self._busy_until))
+            return
+
+        if cmd == PROTOCOL_CMD_MOVE:
+            status = PROTOCOL_ACK_DONE
+            done_at = self._start_move(arg, received_at)
+        elif cmd == PROTOCOL_CMD_STEP_DELAY:
+            status = PROTOCOL_ACK_DONE
+            done_at = max(received_at, self._busy_until)
+            self._sweep_step_delay_us = arg
+        elif cmd == PROTOCOL_CMD_SWEEP:
+            status = PROTOCOL_ACK_DONE
+            from_pos = self.current_pos
+            done_at = self._start_move(arg, received_at, self._sweep_step_delay_us)
+            start, step_s = self._moves[-1][0], self._moves[-1][3]
+            for i in range(1, abs(arg - from_pos) + 1):
+                self._send_ack(PROTOCOL_ACK_PROGRESS, seq, start + i * step_s, from_pos + (i if from_pos < arg else -i))
+        elif cmd == PROTOCOL_CMD_TRAVEL:
+            status = PROTOCOL_ACK_DONE
+            done_at = self._start_move(arg, received_at, travel = True)
+        elif cmd == PROTOCOL_CMD_HELLO:
+            status = PROTOCOL_ACK_HELLO
+            done_at = max(received_at, self._busy_until)
+        else:
+            self._send_ack(PROTOCOL_ACK_ERROR, seq, max(received_at, self._busy_until))
+            return
+
+        self._last_seq = seq
+        self._last_cmd = cmd
+        self._last_status = status
+        self._send_ack(status, seq, done_at)
+
+    def _send_ack(self, status, seq, sent_at, pos = None):
+        t_us = int((sent_at - self._boot_time) * 1000000)
+        frame = protocol_ack_frame(status, seq, self.current_pos if pos is None else pos, t_us)
+        # Frames queue up on the wire
+        available_at = sent_at + self._wire_time(len(frame))
+        if self._tx:
+            available_at = max(available_at, self._tx[-1][0] + self._wire_time(len(frame)))
+        self._tx.append((available_at, frame))
+
+    def _start_move(self, target_pos, received_at, step_delay_us = None, travel = False):
+        if step_delay_us is None:
+            step_delay_us = self.step_delay_us
+        step_s = None if travel else 2 * step_delay_us / 1000000    #None for the trapezoidal travel
+
+        start = max(received_at, self._busy_until)
+        self._moves.append((start, self.current_pos, target_pos, step_s))
+        if travel:
+            self._busy_until = start + travel_time_s(abs(target_pos - self.current_pos))
+        else:
+            self._busy_until = start + abs(target_pos - self.current_pos) * step_s
+        self.current_pos = target_pos
+
+        while len(self._moves) > 1 and self._moves[1][0] < received_at - SIM_HISTORY_S:
+            self._moves.popleft()
+
+        return self._busy_until
+
+    def _collect_tx(self, now):
+        while self._tx and self._tx[0][0] <= now:
+            self._tx_ready += self._tx.popleft()[1]
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            self._collect_tx(time.perf_counter())
+            return len(self._tx_ready)
+
+    def read(self, size = 1):
+        deadline = None if self.timeout is None else time.perf_counter() + self.timeout
+        with self._cond:
+            while self.is_open:
+                now = time.perf_counter()
+                self._collect_tx(now)
+                if size <= len(self._tx_ready) or (deadline is not None and deadline <= now):
+                    break
+
+                wait = None if deadline is None else deadline - now
+                if self._tx:
+                    wait = max(0.0, min(wait if wait is not None else math.inf, self._tx[0][0] - now))
+                self._cond.wait(wait)
+
+            data = bytes(self._tx_ready[:size])
+            del self._tx_ready[:size]
+            return data
+
+    def reset_input_buffer(self):
+        with self._cond:
+            self._tx.clear()
+            self._tx_ready.clear()
+
+    def position_at(self, t):
+        with self._cond:
+            for start, from_pos, to_pos, step_s in reversed(self._moves):
+                if start <= t:
+                    if step_s is None:
+                        steps_done = travel_steps_done(t - start, abs(to_pos - from_pos))
+                    else:
+                        steps_done = int((t - start) / step_s) if step_s else abs(to_pos - from_pos)
+                    if abs(to_pos - from_pos) <= steps_done:
+                        return to_pos
+                    return from_pos + (steps_done if from_pos < to_pos else -steps_done)
+            return self._moves[0][1]
+
+    def position_mm_at(self, t):
+        return self.position_at(t) * STEP_DISTANCE_MM / DEFAULT_NUM_STEP
+
+    def is_moving(self):
+        return time.perf_counter() < self._busy_until
+
+    def close(self):
+        with self._cond:
+            self.is_open = False
+            self._cond.notify_all()
+
+
+# Stand-in for pygame.joystick.Joystick whose stick is pushed by a SimulatedSerial.
+class VirtualJoystick:
+    def __init__(self, ser, joystick_axis = "rx", deadzone = SIM_DEADZONE, curve = SIM_CURVE, noise = SIM_NOISE, latency_ms = SIM_LATENCY_MS,
+                 center_mm = SIM_STICK_CENTER_MM, travel_mm = SIM_STICK_TRAVEL_MM, name = SIM_JOYSTICK_NAME, seed = None):
+        self.ser = ser
+        self.axis_idx = AXIS_INDEXES[joystick_axis]
+        self.deadzone = deadzone
+        self.curve = curve
+        self.noise = noise
+        self.latency_ms = latency_ms
+        self.center_mm = center_mm
+        self.travel_mm = travel_mm
+        self.name = name
+        self._random = random.Random(seed)
+
+    def get_name(self):
+        return self.name
+
+    def get_numaxes(self):
+        return len(AXIS_INDEXES)
+
+    def get_instance_id(self):
+        return -1
+
+    def stick_value(self, t):
+        return self.value_at(self.ser.position_mm_at(t))
+
+    def value_at(self, motor_mm):
+        deflection = (self.center_mm - motor_mm) / self.travel_mm
+        if self.noise:
+            deflection += self._random.gauss(0, self.noise)
+
+        magnitude = min(abs(deflection), 1.0)
+        if magnitude <= self.deadzone:
+            return 0.0
+
+        value = ((magnitude - self.deadzone) / (1.0 - self.deadzone)) ** self.curve
+        return math.copysign(value, deflection)
+
+    def get_axis(self, axis_idx):
+        if axis_idx == self.axis_idx:
+            value = self.stick_value(time.perf_counter() - self.latency_ms / 1000)
+        elif axis_idx == AXIS_INDEXES["lt"] or axis_idx == AXIS_INDEXES["rt"]:
+            value = -1.0
+        else:
+            value = 0.0
+
+        # SDL reports int16 values, pygame divides them by 32768
+        if 0 < value:
+            return round(value * 32767) / 32768
+        return round(value * 32768) / 32768
+
+
+def open_simulated_rig(joystick_axis, deadzone = SIM_DEADZONE, curve = SIM_CURVE, noise = SIM_NOISE, latency_ms = SIM_LATENCY_MS, seed = None, drop_rate = 0.0, corrupt_rate = 0.0):
+    ser = SimulatedSerial(drop_rate = drop_rate, corrupt_rate = corrupt_rate, seed = seed)
+    joystick = VirtualJoystick(ser, joystick_axis, deadzone, curve, noise, latency_ms, seed = seed)
+    return ser, joystick
+
+## Linux evdev Input
+# Reads /dev/input/event* without SDL: non-blocking bulk reads, kernel CLOCK_MONOTONIC timestamps (the clock
+# of perf_counter_ns on Linux) and values normalized from the device absinfo, so fix_stick_val is not needed.
+def evdev_ioc(direction, nr, size):
+    return (direction << 30) | (size << 16) | (ord('E') << 8) | nr
+
+def evdev_ioctl_name(length = 256):
+    return evdev_ioc(EVDEV_IOC_READ, 0x06, length)
+
+def evdev_ioctl_absinfo(code):
+    return evdev_ioc(EVDEV_IOC_READ, 0x40 + code, EVDEV_ABSINFO.size)
+
+
+# Returns (name, {code: (value, min, max, fuzz, flat, resolution)}) of the EVDEV_AXIS_CODES
+def read_evdev_device_info(fd):
+    if fcntl is None:
+        raise OSError("evdev input needs Linux")
+
+    name = fcntl.ioctl(fd, evdev_ioctl_name(), bytes(256)).split(b"\0", 1)[0].decode(errors="replace")
+    absinfo = {}
+    for code in EVDEV_AXIS_CODES.values():
+        try:
+            absinfo[code] = EVDEV_ABSINFO.unpack(fcntl.ioctl(fd, evdev_ioctl_absinfo(code), bytes(EVDEV_ABSINFO.size)))
+        except OSError:
+            pass    #the device does not have this axis
+    return name, absinfo
+
+
+class EvdevJoystick:
+    sdl_normalized = False
+
+    def __init__(self, name, absinfo, read_events, close = None):
+        self.name = name
+        self.absinfo = absinfo
+        self.values = {code: info[0] for code, info in absinfo.items()}
+        self.reports = 0
+        self.last_report_ns = 0
+        self.pending_reports = deque(maxlen=EVDEV_PENDING_REPORTS)  # (t_ns, {code: value}) for JoystickSampler
+
+        self._read_events = read_events
+        self._close = close
+        self._buffer = b""
+        self._dropped = False
+
+    @classmethod
+    def open(cls, path):
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            fcntl.ioctl(fd, EVDEV_IOCTL_CLOCKID, struct.pack("i", time.CLOCK_MONOTONIC))
+            name, absinfo = read_evdev_device_info(fd)
+        except Exception:
+            os.close(fd)
+            raise
+
+        def read_events():
+            chunks = []
+            while True:
+                try:
+                    chunk = os.read(fd, EVDEV_EVENT.size * EVDEV_READ_EVENTS)
+                except BlockingIOError:
+                    break
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return b"".join(chunks)
+
+        joystick = cls(name, absinfo, read_events, lambda: os.close(fd))
+        joystick.fd = fd
+        return joystick
+
+    # Replaying a file of record_evdev; realtime gives the events out when they are due, otherwise all at once.
+    # Timestamps are moved to the time the replay started.
+    @classmethod
+    def replay(cls, filename, realtime = True):
+        with open(filename, 'rb') as fd:
+            header = json.loads(fd.readline())
+            data = fd.read()
+        data = data[:len(data) - len(data) % EVDEV_EVENT.size]
+
+        absinfo = {int(code): tuple(info) for code, info in header["absinfo"].items()}
+        times = [sec * 1000000000 + usec * 1000 for sec, usec, *rest in EVDEV_EVENT.iter_unpack(data)]
+        start_ns = time.perf_counter_ns()
+        offset_ns = start_ns - (times[0] if times else 0)
+        position = [0]
+
+        def read_events():
+            end = len(times)
+            if realtime:
+                end = bisect.bisect_right(times, time.perf_counter_ns() - offset_ns, position[0])
+            chunk = bytearray()
+            for sec, usec, event_type, code, value in EVDEV_EVENT.iter_unpack(data[position[0] * EVDEV_EVENT.size:end * EVDEV_EVENT.size]):
+                t_ns = sec * 1000000000 + usec * 1000 + offset_ns
+                chunk += EVDEV_EVENT.pack(t_ns // 1000000000, t_ns % 1000000000 // 1000, event_type, code, value)
+            position[0] = end
+            return bytes(chunk)
+
+        return cls(header["name"], absinfo, read_events)
+
+    def poll(self):
+        data = self._buffer + self._read_events()
+        usable = len(data) - len(data) % EVDEV_EVENT.size
+        self._buffer = data[usable:]
+
+        for sec, usec, event_type, code, value in EVDEV_EVENT.iter_unpack(data[:usable]):
+            if event_type == EVDEV_EV_ABS:
+                if not self._dropped and code in self.values:
+                    self.values[code] = value
+            elif event_type == EVDEV_EV_SYN:
+                if code == EVDEV_SYN_DROPPED:
+                    # The kernel buffer overflowed, everything up to the next report is discarded
+                    self._dropped = True
+                elif code == EVDEV_SYN_REPORT:
+                    if self._dropped:
+                        self._dropped = False
+                        self.resync()
+                    self.reports += 1
+                    self.last_report_ns = sec * 1000000000 + usec * 1000
+                    self.pending_reports.append((self.last_report_ns, dict(self.values)))
+
+    def resync(self):
+        if hasattr(self, "fd"):
+            name, absinfo = read_evdev_device_info(self.fd)
+            self.values.update({code: info[0] for code, info in absinfo.items()})
+
+    def normalize(self, code, value):
+        info = self.absinfo.get(code)
+        if info is None or info[2] <= info[1]:
+            return 0.0
+        return 2.0 * (value - info[1]) / (info[2] - info[1]) - 1.0
+
+    def get_name(self):
+        return self.name
+
+    def get_axis(self, idx):
+        self.poll()
+        code = EVDEV_AXIS_CODES[EVDEV_SDL_AXES[idx]]
+        return self.normalize(code, self.values.get(code, 0))
+
+    # Reports since the last call as (t_ns, {axis: value})
+    def read_reports(self):
+        self.poll()
+        reports = []
+        while self.pending_reports:
+            t_ns, values = self.pending_reports.popleft()
+            reports.append((t_ns, {axis: self.normalize(code, values.get(code, 0)) for axis, code in EVDEV_AXIS_CODES.items()}))
+        return reports
+
+    def close(self):
+        if self._close:
+            self._close()
+            self._close = None
+
+
+# Writing the events of a device for seconds, for EvdevJoystick.replay
+def record_evdev(path, filename, seconds):
+    joystick = EvdevJoystick.open(path)
+    try:
+        with open(filename, 'wb') as fd:
+            fd.write((json.dumps({"name": joystick.name, "absinfo": joystick.absinfo}) + "\n").encode())
+
+            end_time = time.perf_counter() + seconds
+            events = 0
+            while time.perf_counter() < end_time:
+                data = joystick._read_events()
+                fd.write(data)
+                events += len(data) // EVDEV_EVENT.size
+                time.sleep(EVDEV_RECORD_INTERVAL_S)
+    finally:
+        joystick.close()
+
+    print(f"Recorded {events} events of {joystick.name} to {filename}")
+    return events
+
+
+# Joystick event devices, the by-id links are named after the controllers
+def list_evdev_joysticks():
+    return sorted(glob.glob("/dev/input/by-id/*-event-joystick"))
+
+
+def read_axis(joystick, axis):
+    if not getattr(joystick, "sdl_normalized", True):
+        return joystick.get_axis(AXIS_INDEXES[axis])
+    return fix_stick_val(joystick.get_axis(AXIS_INDEXES[axis]))
+
+# Reading all axes DEFAULT_REPEAT_TIMES times
+def sample_fixed(joystick, timing, timer = None):
+    sums = dict.fromkeys(AXIS_INDEXES, 0)
+
+    precise_wait_ms(timing["before_sense_ms"])
+    if timer:
+        timer.mark("settle")
+
+    for i in range(0, timing["repeat_times"], 1):
+        for axis in AXIS_INDEXES:
+            sums[axis] += read_axis(joystick, axis)
+
+        precise_wait_ms(timing["repeat_interval_ms"])
+
+    values = {axis: sums[axis] / timing["repeat_times"] for axis in AXIS_INDEXES}
+    return values, timing["repeat_times"], timing["before_sense_ms"]
+
+# Reading the measured axes until the running mean of the first one is within the confidence target.
+# The running stats start over while the value is still moving.
+def sample_until_converged(joystick, axes, timing, timer = None):
+    precise_wait_ms(timing["before_sense_ms"])
+    if timer:
+        timer.mark("settle")
+
+    start_time = time.perf_counter()
+    settled_time = start_time
+    samples = 0
+    n = 0; mean = 0.0; m2 = 0.0
+    sums = dict.fromkeys(axes, 0)
+
+    while True:
+        val = read_axis(joystick, axes[0])
+        samples += 1
+
+        if 1 < n:
+            threshold = max(timing["settle_threshold"], CONVERGE_RESET_SIGMA * math.sqrt(m2 / (n - 1)))
+            if threshold < abs(val - mean):
+                settled_time = time.perf_counter()
+                n = 0; mean = 0.0; m2 = 0.0
+                sums = dict.fromkeys(axes, 0)
+
+        n += 1
+        delta = val - mean
+        mean += delta / n
+        m2 += delta * (val - mean)
+
+        sums[axes[0]] += val
+        for axis in axes[1:]:
+            sums[axis] += read_axis(joystick, axis)
+
+        if max(timing["min_samples"], 2) <= n and CONVERGE_Z * math.sqrt(m2 / (n - 1) / n) <= timing["confidence"]:
+            break
+        if timing["max_samples"] <= samples:
+            break
+
+        precise_wait_ms(timing["repeat_interval_ms"])
+
+    values = dict.fromkeys(AXIS_INDEXES, float("nan"))
+    for axis in axes:
+        values[axis] = sums[axis] / n
+
+    return values, samples, timing["before_sense_ms"] + (settled_time - start_time) * 1000
+
+## Joystick Sampler
+# Wraps a joystick: a thread records the axes (read_axis) with perf_counter_ns whenever they change, into a
+# ring only written by that thread. Readers take head once and never lock. The caller pumps SDL (pump_until_ns).
+class JoystickSampler:
+    def __init__(self, joystick, capacity = SAMPLER_CAPACITY, poll_interval_s = SAMPLER_POLL_INTERVAL_S):
+        self.joystick = joystick
+        self.sdl_normalized = getattr(joystick, "sdl_normalized", True)
+        self.capacity = capacity
+        self.poll_interval_s = poll_interval_s
+        self.head = 0
+        self.polls = 0
+        self.times = array('q', [0]) * capacity
+        self.columns = {axis: array('d', [0]) * capacity for axis in AXIS_INDEXES}
+
+        self._stop_event = Event()
+        self._thread = Thread(target=self.run, daemon=True)
+
+    def get_name(self):
+        return self.joystick.get_name()
+
+    def get_axis(self, idx):
+        return self.joystick.get_axis(idx)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def run(self):
+        last_values = None
+        kernel_times = hasattr(self.joystick, "read_reports")   #EvdevJoystick reports carry their own timestamps
+        while not self._stop_event.is_set():
+            if kernel_times:
+                reports = [(t_ns, [values[axis] for axis in AXIS_INDEXES]) for t_ns, values in self.joystick.read_reports()]
+            else:
+                reports = [(time.perf_counter_ns(), [read_axis(self.joystick, axis) for axis in AXIS_INDEXES])]
+            self.polls += 1
+
+            for t_ns, values in reports:
+                if values != last_values:
+                    idx = self.head % self.capacity
+                    self.times[idx] = t_ns
+                    for axis, value in zip(AXIS_INDEXES, values):
+                        self.columns[axis][idx] = value
+                    self.head += 1
+                    last_values = values
+
+            time.sleep(self.poll_interval_s)
+
+    # First logical index in [lo, hi) recorded after t_ns
+    def _find(self, t_ns, lo, hi):
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[mid % self.capacity] <= t_ns:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Time weighted mean of every axis over [start_ns, end_ns], the value before start_ns holds until the next one.
+    # Returns (values, number of recorded changes in the window).
+    def average(self, start_ns, end_ns):
+        head = self.head
+        oldest = max(0, head - self.capacity + 1)
+        first = self._find(start_ns, oldest, head)
+        last = self._find(end_ns, first, head)
+
+        if first == oldest and last == first:
+            return {axis: read_axis(self.joystick, axis) for axis in AXIS_INDEXES}, 0
+
+        sums = dict.fromkeys(AXIS_INDEXES, 0.0)
+        for i in range(max(first - 1, oldest), last):
+            held_from = max(self.times[i % self.capacity], start_ns)
+            held_to = end_ns if i + 1 == last else self.times[(i + 1) % self.capacity]
+            for axis in AXIS_INDEXES:
+                sums[axis] += self.columns[axis][i % self.capacity] * (held_to - held_from)
+
+        duration = max(end_ns - max(start_ns, self.times[max(first - 1, oldest) % self.capacity]), 1)
+        return {axis: sums[axis] / duration for axis in AXIS_INDEXES}, last - first
+
+    # Time of the last change in [start_ns, end_ns] further than threshold from value, start_ns if none
+    def last_outside(self, axis, value, threshold, start_ns, end_ns):
+        head = self.head
+        oldest = max(0, head - self.capacity + 1)
+        first = self._find(start_ns, oldest, head)
+        last = self._find(end_ns, first, head)
+
+        for i in range(last - 1, first - 1, -1):
+            if threshold < abs(self.columns[axis][i % self.capacity] - value):
+                return self.times[i % self.capacity]
+        return start_ns
+
+    # (time, value) of the recorded changes of an axis in [start_ns, end_ns], after the value held at start_ns
+    def changes(self, axis, start_ns, end_ns):
+        head = self.head
+        oldest = max(0, head - self.capacity + 1)
+        first = self._find(start_ns, oldest, head)
+        last = self._find(end_ns, first, head)
+
+        held = [(start_ns, self.columns[axis][(first - 1) % self.capacity])] if oldest < first else []
+        return held + [(self.times[i % self.capacity], self.columns[axis][i % self.capacity]) for i in range(first, last)]
+
+    # Recorded changes per second since start_ns
+    def report_rate(self, start_ns):
+        head = self.head
+        oldest = max(0, head - self.capacity + 1)
+        elapsed_s = max(time.perf_counter_ns() - start_ns, 1) / 1000000000
+        return (head - self._find(start_ns, oldest, head)) / elapsed_s
+
+
+# Averaging what the sampler recorded over the time the fixed sampling reads.
+# settle_ms is the last time the measured axis was off the average by more than settle_threshold.
+def sample_from_stream(sampler, axes, timing, timer = None):
+    start_ns = time.perf_counter_ns()
+    pump_until_ns(start_ns + int(timing["before_sense_ms"] * 1000000))
+    if timer:
+        timer.mark("settle")
+
+    window_start_ns = time.perf_counter_ns()
+    pump_until_ns(window_start_ns + int(timing["repeat_times"] * timing["repeat_interval_ms"] * 1000000))
+    end_ns = time.perf_counter_ns()
+
+    values, samples = sampler.average(window_start_ns, end_ns)
+    settled_ns = sampler.last_outside(axes[0], values[axes[0]], timing["settle_threshold"], start_ns, end_ns)
+    return values, samples, (settled_ns - start_ns) / 1000000
+
+
+def measure_stats(joystick, stats, cur_ms, elapsed_time, motor_pos, timing = None, axes = None, timer = None):
+    if timing is None:
+        timing = gen_timing()
+
+    if isinstance(joystick, JoystickSampler) and axes:
+        values, samples, settle_ms = sample_from_stream(joystick, axes, timing, timer)
+    elif timing["sampling"] == "converge" and axes:
+        values, samples, settle_ms = sample_until_converged(joystick, axes, timing, timer)
+    else:
+        values, samples, settle_ms = sample_fixed(joystick, timing, timer)
+
+    stats.append_row({
+        "timestamps": cur_ms,
+        "elapsed_time": elapsed_time,
+        "motor_pos": motor_pos,
+        **values,
+        "samples": samples,
+        "settle_ms": settle_ms
+    })
+    if timer:
+        timer.mark("sampling")
 
     return {
         "timestamps": cur_ms,
         "elapsed_time": elapsed_time,
-        "lx": lx, "ly": ly,
-        "rx": rx, "ry": ry,
-        "lt": lt, "rt": rt
+        **values,
+        "samples": samples,
+        "settle_ms": settle_ms
     }
 
 
 def stick_move_starts(last_value, new_value):
     return last_value != new_value and ((new_value <= STICK_END_THRESHOLD and STICK_END_THRESHOLD <= last_value) or (last_value <= -STICK_END_THRESHOLD and -STICK_END_THRESHOLD <= new_value))
 
+def stick_is_pinned(value):
+    return STICK_THRESHOLD <= abs(value)
+
 def stick_move_ends(last_value, new_value):
     if (STICK_END_THRESHOLD <= last_value and STICK_END_THRESHOLD <= new_value) or (last_value <= -STICK_END_THRESHOLD and new_value <= -STICK_END_THRESHOLD):
         if math.floor(last_value * 1000) == math.floor(new_value * 1000):
@@ -141,78 +1441,137 @@ def stick_move_ends(last_value, new_value):
     return False
 
 
-def measure_main_loop(joystick, joystick_axis, ser, stats, response_curve_data, stop_event, change_event, reverse = False, reverse_from = 0):
-    clock = pygame.time.Clock()
+def measure_main_loop(joystick, joystick_axis, ser, stats, response_curve_data, stop_event, change_event, reverse = False, reverse_from = 0, output_dir = ".", adaptive = False, timing = None,
+                      stick_height_mm = None, progress = None, checkpoint = None, resume = None):
+    from tqdm import tqdm
+
+    if timing is None:
+        timing = gen_timing()
 
     move_count = reverse_from
+    commanded_count = reverse_from
     move_started = False
     no_move_count = 0
     move_start_count = 0
     move_end_count = 0
+    move_start_idx = 0
+    move_end_idx = 0
+    coarse = adaptive
+    flat_steps = 0
     direction = 0
     min_value = 1
     max_value = -1
-
-    joystick_another_axis = "ry"
-    if joystick_axis == "lx":
-        joystick_another_axis = "ly"
-    elif joystick_axis == "ly":
-        joystick_another_axis = "lx"
-    elif joystick_axis == "rx":
-        joystick_another_axis = "ry"
-    elif joystick_axis == "ry":
-        joystick_another_axis = "rx"
+    elapsed_before_ms = 0
+
+    # Resuming, the rows are only restored into an empty store (a new process)
+    if resume:
+        move_count = commanded_count = resume["move_count"]
+        move_started = resume["move_started"]
+        no_move_count = resume["no_move_count"]
+        move_start_count = resume["move_start_count"]
+        move_start_idx = resume["move_start_idx"]
+        coarse = resume["coarse"]
+        direction = resume["direction"]
+        min_value = resume["min_value"]
+        max_value = resume["max_value"]
+        elapsed_before_ms = resume["elapsed_ms"]
+
+        if len(stats) == 0:
+            rows = resume["rows"]
+            for i in range(len(rows["motor_pos"])):
+                stats.append_row({key: rows[key][i] for key in rows})
+
+    def checkpoint_state():
+        return {
+            "reverse": reverse, "reverse_from": reverse_from, "joystick_axis": joystick_axis,
+            "move_count": move_count, "move_started": move_started, "no_move_count": no_move_count,
+            "move_start_count": move_start_count, "move_start_idx": move_start_idx, "coarse": coarse,
+            "direction": direction, "min_value": min_value, "max_value": max_value,
+            "elapsed_ms": (time.perf_counter() - start_time) * 1000,
+        }
+
+    joystick_another_axis = ANOTHER_AXIS.get(joystick_axis, "ry")
+    measured_axes = (joystick_axis, joystick_another_axis)
+    timer = StepTimer(timing["frame_rate"])
+    sweep_start_ns = time.perf_counter_ns()
 
     print(f'measure start from {move_count}, reverse mode: {reverse}.')
-    ser.write(f"{move_count * DEFAULT_NUM_STEP}\n".encode())
+    move_motor(ser, move_count * DEFAULT_NUM_STEP, timing, 0, travel = True)
 
-    with tqdm(total=2.0, ncols=76, bar_format='{l_bar}{bar} | {postfix[0]}', dynamic_ncols=False, postfix=[0]) as pbar:
-        start_time = time.perf_counter()
+    with tqdm(total=2.0, ncols=76, bar_format='{l_bar}{bar} | {postfix[0]}', dynamic_ncols=False, postfix=[0], **(progress or {})) as pbar:
+        start_time = time.perf_counter() - elapsed_before_ms / 1000
+        scheduler = StepScheduler(timing["frame_rate"])
         while move_end_count == 0:
-            current_start_time = time.perf_counter()
-            cur_ms = pygame.time.get_ticks()
+            timer.start_step()
+            cur_ms = ticks_ms()
 
             quit_event = pygame.event.get(pygame.QUIT)
-            if quit_event:
+            if quit_event or stop_event.is_set():    #the window can be in the renderer process
                 stop_event.set()
+                if checkpoint:
+                    checkpoint.save(checkpoint_state(), stats)
                 return
             
             joystick_remove_event = pygame.event.get(pygame.JOYDEVICEREMOVED)
             if joystick_remove_event:
-                change_event.set()
+                # With a checkpoint the caller waits for the controller, otherwise everything starts over
+                if checkpoint:
+                    checkpoint.save(checkpoint_state(), stats)
+                    checkpoint.removed = True
+                else:
+                    change_event.set()
                 return
+            timer.mark("events")
 
             if len(stats[joystick_axis]) == 0:
-                measure_stats(joystick, stats, cur_ms, 0, 0)
+                measure_stats(joystick, stats, cur_ms, 0, move_count * STEP_DISTANCE_MM, timing, measured_axes, timer)
 
             last_value = stats[joystick_axis][-1]
+            last_count = move_count
 
             # Moving the motor
+            num_step = 1
+            if coarse and stick_is_pinned(last_value):
+                num_step = ADAPTIVE_COARSE_STEPS
+            elif adaptive and move_started and ADAPTIVE_FLAT_STEPS <= flat_steps:
+                num_step = ADAPTIVE_COARSE_STEPS
+
             if reverse:
-                move_count -= 1
+                move_count -= num_step
             else:
-                move_count += 1
-
-            ser.write(f"{move_count * DEFAULT_NUM_STEP}\n".encode())
+                move_count += num_step
 
-            pygame.time.wait(TIME_STICK_MOVEMENT_MS)
+            move_motor(ser, move_count * DEFAULT_NUM_STEP, timing, abs(move_count - commanded_count) * DEFAULT_NUM_STEP, timer)
+            commanded_count = move_count
 
 
             # Get the time from pygame.init() called in ms.
             current_time = time.perf_counter()
             elapsed_time = (current_time - start_time) * 1000
 
-            result = measure_stats(joystick, stats, cur_ms, elapsed_time, move_count * STEP_DISTANCE_MM)
+            result = measure_stats(joystick, stats, cur_ms, elapsed_time, move_count * STEP_DISTANCE_MM, timing, measured_axes, timer)
 
             # Check stats if it moves or not
             new_value = result[joystick_axis]
-            pbar.postfix[0] = "{:s}: {:05.3f}, {:s}: {:05.3f}".format(joystick_axis, new_value, joystick_another_axis, result[joystick_another_axis])
+            if not pbar.disable:    #headless
+                pbar.postfix[0] = "{:s}: {:05.3f}, {:s}: {:05.3f}, {:s}".format(joystick_axis, new_value, joystick_another_axis, result[joystick_another_axis], timer.postfix())
 
             if not move_started:
+                if 1 < num_step and stick_move_starts(last_value, new_value):
+                    # Coarse step overshot the start of movement, going back to the last pinned position
+                    stats.truncate(len(stats) - 1)
+                    move_count = last_count
+                    coarse = False
+                    scheduler.tick()
+                    timer.mark("tick")
+                    timer.end_step()
+                    continue
+
                 if stick_move_starts(last_value, new_value):
                     # MOVE STARTS
                     move_started = True
-                    move_start_count = move_count - 1
+                    move_start_count = last_count
+                    move_start_idx = len(stats[joystick_axis]) - 2
                     if new_value < last_value:
                         max_value = last_value
                         direction = -1
@@ -225,17 +1584,31 @@ def measure_main_loop(joystick, joystick_axis, ser, stats, response_curve_data,
                     no_move_count +=1
                 pbar.update(0)
             else:
+                if 1 < num_step and new_value != last_value:
+                    # Coarse step left the flat stretch, going back to its last position. The change is within
+                    # the next coarse step, fine steps up to it.
+                    stats.truncate(len(stats) - 1)
+                    move_count = last_count
+                    flat_steps = -ADAPTIVE_COARSE_STEPS
+                    scheduler.tick()
+                    timer.mark("tick")
+                    timer.end_step()
+                    continue
+                flat_steps = flat_steps + 1 if new_value == last_value else 0
+
                 if stick_move_ends(last_value, new_value):
                     # MOVE ENDS
                     no_move_count += 1
                     if direction < 0:
                         min_value = new_value
                         move_end_count = move_count
+                        move_end_idx = len(stats[joystick_axis]) - 1
                         print(f'\nmove ended at count {move_end_count}, min value is {new_value}.')
 
                     elif 0 < direction:
                         max_value = new_value
                         move_end_count = move_count
+                        move_end_idx = len(stats[joystick_axis]) - 1
                         print(f'\nmove ended at count {move_end_count}, max value is {max_value}.')
                     
                 if (direction > 0):
@@ -243,63 +1616,267 @@ def measure_main_loop(joystick, joystick_axis, ser, stats, response_curve_data,
                 elif (direction < 0):
                     pbar.update(last_value - new_value)
 
+            if checkpoint and len(timer.steps) % CHECKPOINT_INTERVAL_STEPS == 0:
+                checkpoint.save(checkpoint_state(), stats)
+
             # Wait until next measure frame
-            clock.tick(MEASURE_FRAME_RATE)
+            scheduler.tick()
+            timer.mark("tick")
+            timer.end_step()
     
-    movement_stats = stats[joystick_axis][abs(reverse_from - move_start_count): abs(reverse_from - move_end_count)]
+    if isinstance(ser, MotionLink) and (ser.counters["resent"] or ser.counters["garbled"] or ser.counters["position_errors"]):
+        print(f'\033[31mserial link errors: {ser.counters}\033[0m')
 
-    calc_response_curve(movement_stats, direction, min_value, max_value, abs(move_end_count - move_start_count) * STEP_DISTANCE_MM, joystick_axis, response_curve_data, reverse)
-    save_response_curve(response_curve_data)
+    timer.deadline_misses = scheduler.misses
+    step_histogram = timer.histograms["step"]
+    print(f'step time p50 {step_histogram.percentile(50) / 1000:.2f}ms, p99 {step_histogram.percentile(99) / 1000:.2f}ms, max {step_histogram.max / 1000:.2f}ms, {timer.overruns}/{len(timer.steps)} steps overran the {timer.frame_us / 1000:.1f}ms frame, {scheduler.misses} deadlines missed.')
+    if isinstance(joystick, JoystickSampler) and len(stats):
+        print(f'joystick changes {joystick.report_rate(sweep_start_ns):.1f}/s, settle p99 {sorted(stats["settle_ms"])[int(len(stats) * 0.99)]:.2f}ms.')
+
+    filename = finish_sweep(stats, joystick_axis, move_start_idx, move_end_idx, direction, min_value, max_value, response_curve_data, reverse, output_dir, stick_height_mm)
+    stats.result_filename = filename
+    stats.timing_filename = timer.save(filename)
 
     return move_end_count
 
 
-def calc_response_curve(movement_stats, direction, min, max, distance, joystick_axis, response_curve_data, reverse = False):
-    
-    # Distance from 0 step to center
-    def determine_center_from_zero_idx(movement_stats):
-        most_minimum_plus_center = 1
-        most_minimum_plus_center_idx = 0
-        most_minimum_minus_center = -1
-        most_minimum_minus_center_idx = 0
+# Finding the movement in recorded values the same way measure_main_loop does while sweeping.
+# Returns (start idx, end idx, direction, min value, max value) or None.
+def find_movement(values):
+    move_start_idx = None
+    direction = 0
+    min_value = 1
+    max_value = -1
+
+    for idx in range(1, len(values)):
+        last_value = values[idx - 1]
+        new_value = values[idx]
+
+        if move_start_idx is None:
+            if stick_move_starts(last_value, new_value):
+                move_start_idx = idx - 1
+                if new_value < last_value:
+                    max_value = last_value
+                    direction = -1
+                else:
+                    min_value = last_value
+                    direction = 1
+        elif stick_move_ends(last_value, new_value):
+            if direction < 0:
+                min_value = new_value
+            else:
+                max_value = new_value
+            return move_start_idx, idx, direction, min_value, max_value
+
+    return None
+
+
+def finish_sweep(stats, joystick_axis, move_start_idx, move_end_idx, direction, min_value, max_value, response_curve_data, reverse, output_dir,
+                 stick_height_mm = None, filename = None):
+    # Positions are taken from motor_pos as the steps may not be evenly spaced
+    movement_stats = stats[joystick_axis][move_start_idx:move_end_idx]
+    movement_positions = [abs(pos - stats["motor_pos"][move_start_idx]) for pos in stats["motor_pos"][move_start_idx:move_end_idx]]
+    distance = abs(stats["motor_pos"][move_end_idx] - stats["motor_pos"][move_start_idx])
+
+    calc_response_curve(movement_stats, direction, min_value, max_value, distance, joystick_axis, response_curve_data, reverse, movement_positions, stick_height_mm = stick_height_mm)
+    return save_response_curve(response_curve_data, output_dir, filename)
+
+
+def interpolate_samples(times, values, t):
+    idx = bisect.bisect_left(times, t)
+    if idx <= 0:
+        return values[0]
+    if len(times) <= idx:
+        return values[-1]
+
+    ratio = (t - times[idx - 1]) / (times[idx] - times[idx - 1])
+    return values[idx - 1] + (values[idx] - values[idx - 1]) * ratio
+
+
+# Lining up the step stream from the firmware with the host clock.
+# The smallest receive delay is taken as the transmission time of a frame.
+def align_step_stream(stream, baud_rate = DEFAULT_SERIAL_BAUD_RATE):
+    wire_s = PROTOCOL_ACK_FRAME_SIZE * 10 / baud_rate
+
+    step_times = []
+    wraps = 0
+    last_t_us = None
+    for pos, t_us, received_at in stream:
+        if last_t_us is not None and t_us < last_t_us:
+            wraps += 1  # micros() overflows after about 70 minutes
+        last_t_us = t_us
+        step_times.append((t_us + wraps * 0x100000000) / 1000000)
+
+    offset = min(received_at - step_t for (pos, t_us, received_at), step_t in zip(stream, step_times)) - wire_s
+    return [pos for pos, t_us, received_at in stream], [step_t + offset for step_t in step_times]
+
+
+def measure_continuous_loop(joystick, joystick_axis, ser, stats, response_curve_data, stop_event, change_event, reverse = False, reverse_from = 0, output_dir = ".", timing = None,
+                            sweep_range_mm = CONTINUOUS_RANGE_MM, speed_mm_s = CONTINUOUS_SPEED_MM_S, stick_height_mm = None, progress = None):
+    from tqdm import tqdm
+
+    if not isinstance(ser, MotionLink):
+        print("\033[31mcontinuous sweep needs the acknowledged serial protocol, stepping instead.\033[0m")
+        return measure_main_loop(joystick, joystick_axis, ser, stats, response_curve_data, stop_event, change_event, reverse, reverse_from, output_dir, timing = timing,
+                                 stick_height_mm = stick_height_mm, progress = progress)
+
+    if timing is None:
+        timing = gen_timing()
+
+    measured_axes = (joystick_axis, ANOTHER_AXIS.get(joystick_axis, "ry"))
+
+    step_mm = STEP_DISTANCE_MM / DEFAULT_NUM_STEP
+    step_delay_us = round(step_mm / speed_mm_s * 1000000 / 2)
+    min_step_delay_us = math.ceil(PROTOCOL_ACK_FRAME_SIZE * 10 / DEFAULT_SERIAL_BAUD_RATE * 1000000 / 2)
+    if step_delay_us < min_step_delay_us:
+        print(f"\033[31m{speed_mm_s}mm/s is too fast to stream every step, using {step_mm / (min_step_delay_us * 2) * 1000000:.1f}mm/s.\033[0m")
+        step_delay_us = min_step_delay_us
+
+    move_count = reverse_from
+    end_count = 0 if reverse else round(sweep_range_mm / STEP_DISTANCE_MM)
+
+    print(f'continuous measure from {move_count} to {end_count}, reverse mode: {reverse}.')
+    ser.travel_to(move_count * DEFAULT_NUM_STEP)
+    precise_wait_ms(timing["before_sense_ms"])
 
-        for idx, val in enumerate(movement_stats):
-            if (most_minimum_minus_center < val and val < 0):
-                most_minimum_minus_center = val
-                most_minimum_minus_center_idx = idx
-            if (0 < val and val < most_minimum_plus_center):
-                most_minimum_plus_center = val
-                most_minimum_plus_center_idx = idx
+    sample_times = []
+    sample_values = {axis: [] for axis in measured_axes}
 
-        steps_between = most_minimum_minus_center_idx - most_minimum_plus_center_idx
-        distance_between = steps_between * STEP_DISTANCE_MM
+    with tqdm(total=abs(end_count - move_count), ncols=76, bar_format='{l_bar}{bar} | {postfix[0]}', dynamic_ncols=False, postfix=[0], **(progress or {})) as pbar:
+        start_time = time.perf_counter()
+        cur_ms = ticks_ms()
+        seq = ser.sweep_to(end_count * DEFAULT_NUM_STEP, step_delay_us)
+
+        # Sampling as fast as possible until the firmware reports the end of the sweep
+        next_event_time = start_time
+        while not ser.is_acked(seq):
+            pygame.event.pump()
+
+            sample_times.append(time.perf_counter())
+            for axis in measured_axes:
+                sample_values[axis].append(read_axis(joystick, axis))
+
+            if next_event_time <= sample_times[-1]:
+                next_event_time = sample_times[-1] + CONTINUOUS_EVENT_INTERVAL_S
+
+                if pygame.event.get(pygame.QUIT) or stop_event.is_set():
+                    stop_event.set()
+                    ser.wait(seq)
+                    return
+                if pygame.event.get(pygame.JOYDEVICEREMOVED):
+                    change_event.set()
+                    ser.wait(seq)
+                    return
+
+                if not pbar.disable:
+                    pbar.postfix[0] = "{:s}: {:05.3f}, {:d} samples".format(joystick_axis, sample_values[joystick_axis][-1], len(sample_times))
+                pbar.update(len(ser.stream) - pbar.n)
+
+        ser.wait(seq)
+
+    if len(ser.stream) == 0 or len(sample_times) < 2:
+        print("\033[31mno steps were streamed from the firmware.\033[0m")
+        return None
+
+    # One stats row per motor step, the axis values interpolated at the time of the step
+    positions, step_times = align_step_stream(ser.stream)
+    last_idx = 0
+    for pos, step_time in zip(positions, step_times):
+        idx = bisect.bisect_right(sample_times, step_time)
+
+        row = {
+            "timestamps": cur_ms + round((step_time - start_time) * 1000),
+            "elapsed_time": (step_time - start_time) * 1000,
+            "motor_pos": pos / DEFAULT_NUM_STEP * STEP_DISTANCE_MM,
+            "samples": idx - last_idx,
+            "settle_ms": 0
+        }
+        for axis in AXIS_INDEXES:
+            if axis in sample_values:
+                row[axis] = interpolate_samples(sample_times, sample_values[axis], step_time)
+            else:
+                row[axis] = float("nan")
+        stats.append_row(row)
+        last_idx = idx
+
+    print(f'\n{len(sample_times)} samples over {len(positions)} steps in {(sample_times[-1] - start_time):.2f}s.')
+
+    movement = find_movement(stats[joystick_axis])
+    if movement is None:
+        print(f"\033[31mstick movement was not found between {reverse_from} and {end_count}.\033[0m")
+        return None
+
+    move_start_idx, move_end_idx, direction, min_value, max_value = movement
+    print(f'move started at {stats["motor_pos"][move_start_idx]:.3f}mm and ended at {stats["motor_pos"][move_end_idx]:.3f}mm.')
+    stats.result_filename = finish_sweep(stats, joystick_axis, move_start_idx, move_end_idx, direction, min_value, max_value, response_curve_data, reverse, output_dir, stick_height_mm)
+
+    return end_count
+
+
+# Distance from 0 step to center
+def determine_center_from_zero_idx(movement_stats, movement_positions = None):
+    def position_of(idx):
+        if movement_positions is None:
+            return idx * STEP_DISTANCE_MM
+        return movement_positions[idx]
 
-        center_distance_from_plus = (- distance_between * most_minimum_plus_center / (most_minimum_plus_center - most_minimum_minus_center))
+    most_minimum_plus_center = 1
+    most_minimum_plus_center_idx = 0
+    most_minimum_minus_center = -1
+    most_minimum_minus_center_idx = 0
 
-        center_distance = most_minimum_plus_center_idx * STEP_DISTANCE_MM - center_distance_from_plus
+    for idx, val in enumerate(movement_stats):
+        if (most_minimum_minus_center < val and val < 0):
+            most_minimum_minus_center = val
+            most_minimum_minus_center_idx = idx
+        if (0 < val and val < most_minimum_plus_center):
+            most_minimum_plus_center = val
+            most_minimum_plus_center_idx = idx
+
+    distance_between = position_of(most_minimum_minus_center_idx) - position_of(most_minimum_plus_center_idx)
+
+    center_distance_from_plus = (- distance_between * most_minimum_plus_center / (most_minimum_plus_center - most_minimum_minus_center))
+
+    center_distance = position_of(most_minimum_plus_center_idx) - center_distance_from_plus
 
-        #print(f'len: {len(movement_stats)}, min minus: {most_minimum_minus_center}({most_minimum_minus_center_idx}), plus: {most_minimum_plus_center}({most_minimum_plus_center_idx}), center_distance_from_plus: {center_distance_from_plus}, center_distance: {center_distance}')
+    #print(f'len: {len(movement_stats)}, min minus: {most_minimum_minus_center}({most_minimum_minus_center_idx}), plus: {most_minimum_plus_center}({most_minimum_plus_center_idx}), center_distance_from_plus: {center_distance_from_plus}, center_distance: {center_distance}')
 
-        return center_distance
+    return center_distance
 
 
+def calc_response_curve(movement_stats, direction, min, max, distance, joystick_axis, response_curve_data, reverse = False, movement_positions = None, vectorized = True,
+                        stick_height_mm = None, stick_radius_mm = None):
+    if stick_height_mm is None:
+        stick_height_mm = STICK_HEIGHT_MM
+    if stick_radius_mm is None:
+        stick_radius_mm = STICK_RADIUS_MM
+
+    if vectorized and np is not None:
+        return calc_response_curve_vectorized(movement_stats, direction, joystick_axis, response_curve_data, reverse, movement_positions, stick_height_mm, stick_radius_mm)
+
+    # Distance from the first sample in mm
+    def position_of(idx):
+        if movement_positions is None:
+            return idx * STEP_DISTANCE_MM
+        return movement_positions[idx]
+
     # Calculating Stick Degrees from Neutral
     def calc_degree(mm_from_zero):
         def calc_right_to_center_degree():
             dist_from_zero = abs(mm_from_zero)
 
-            theta_plus_alpha = math.asin((dist_from_zero + STICK_RADIUS_MM ) / math.sqrt(STICK_HEIGHT_MM ** 2 + STICK_RADIUS_MM ** 2))
-            alpha = math.asin(STICK_RADIUS_MM / math.sqrt(STICK_HEIGHT_MM ** 2 + STICK_RADIUS_MM ** 2))
+            theta_plus_alpha = math.asin((dist_from_zero + stick_radius_mm ) / math.sqrt(stick_height_mm ** 2 + stick_radius_mm ** 2))
+            alpha = math.asin(stick_radius_mm / math.sqrt(stick_height_mm ** 2 + stick_radius_mm ** 2))
 
             return math.degrees(theta_plus_alpha - alpha)
         
         def calc_left_to_center_degree():
             dist_from_zero = abs(mm_from_zero)
 
-            theta_plus_alpha = math.asin((dist_from_zero - STICK_RADIUS_MM ) / math.sqrt(STICK_HEIGHT_MM ** 2 + STICK_RADIUS_MM ** 2))
-            alpha = math.asin(- STICK_RADIUS_MM / math.sqrt(STICK_HEIGHT_MM ** 2 + STICK_RADIUS_MM ** 2))
+            theta_plus_alpha = math.asin((dist_from_zero - stick_radius_mm ) / math.sqrt(stick_height_mm ** 2 + stick_radius_mm ** 2))
+            alpha = math.asin(- stick_radius_mm / math.sqrt(stick_height_mm ** 2 + stick_radius_mm ** 2))
 
-            #print(f'dist_from_zero: {dist_from_zero}, theta_plus_alpha: {theta_plus_alpha}, alpha: {alpha}, degree: {theta_plus_alpha - alpha}, dist_from_zero_calc_by_theta: {STICK_HEIGHT_MM * math.sin(theta_plus_alpha - alpha) + STICK_RADIUS_MM / 2 - (STICK_RADIUS_MM / 2 * math.cos(theta_plus_alpha - alpha))}')
+            #print(f'dist_from_zero: {dist_from_zero}, theta_plus_alpha: {theta_plus_alpha}, alpha: {alpha}, degree: {theta_plus_alpha - alpha}, dist_from_zero_calc_by_theta: {stick_height_mm * math.sin(theta_plus_alpha - alpha) + stick_radius_mm / 2 - (stick_radius_mm / 2 * math.cos(theta_plus_alpha - alpha))}')
 
             return math.degrees(theta_plus_alpha - alpha)
 
@@ -328,26 +1905,25 @@ def calc_response_curve(movement_stats, direction, min, max, distance, joystick_
         distance_from_neutral_center_axis = 0
         if mm_from_zero <= 0:
             if reverse: #left to center \ -> |
-                distance_from_neutral_center_axis = ((-mm_from_zero) + STICK_RADIUS_MM * math.cos(math.radians(degree)) - STICK_RADIUS_MM)
+                distance_from_neutral_center_axis = ((-mm_from_zero) + stick_radius_mm * math.cos(math.radians(degree)) - stick_radius_mm)
             else:       #center to right | -> /
-                distance_from_neutral_center_axis = (-mm_from_zero) - STICK_RADIUS_MM * math.cos(math.radians(degree)) + STICK_RADIUS_MM
+                distance_from_neutral_center_axis = (-mm_from_zero) - stick_radius_mm * math.cos(math.radians(degree)) + stick_radius_mm
         else:
             if reverse: #right to center | <- /
-                distance_from_neutral_center_axis = - (mm_from_zero - STICK_RADIUS_MM * math.cos(math.radians(degree)) + STICK_RADIUS_MM)
+                distance_from_neutral_center_axis = - (mm_from_zero - stick_radius_mm * math.cos(math.radians(degree)) + stick_radius_mm)
             else:       #center to left \ <- |
-                distance_from_neutral_center_axis = - (mm_from_zero + STICK_RADIUS_MM * math.cos(math.radians(degree)) - STICK_RADIUS_MM)
+                distance_from_neutral_center_axis = - (mm_from_zero + stick_radius_mm * math.cos(math.radians(degree)) - stick_radius_mm)
 
         if direction > 0:
             distance_from_neutral_center_axis = - distance_from_neutral_center_axis
         
         return distance_from_neutral_center_axis
 
-    distance_to_center = determine_center_from_zero_idx(movement_stats)
+    distance_to_center = determine_center_from_zero_idx(movement_stats, movement_positions)
     print(f'distance to center from 0mm is {distance_to_center}mm')
 
     for idx, val in enumerate(movement_stats):
-        step = idx
-        step_distance = step * STEP_DISTANCE_MM
+        step_distance = position_of(idx)
 
         mm_from_zero = step_distance - distance_to_center
         
@@ -368,306 +1944,2195 @@ def calc_response_curve(movement_stats, direction, min, max, distance, joystick_
     return response_curve_data
 
 
-def save_response_curve(data):
-    dt = datetime.datetime.now()
-    filename = dt.strftime("%Y%m%d_%H%M%S_%f.csv")
+# Same as calc_response_curve with whole-array operations
+def calc_response_curve_vectorized(movement_stats, direction, joystick_axis, response_curve_data, reverse = False, movement_positions = None,
+                                   stick_height_mm = STICK_HEIGHT_MM, stick_radius_mm = STICK_RADIUS_MM):
+    values = np.asarray(movement_stats, dtype=np.float64)
+    if movement_positions is None:
+        positions = np.arange(len(values)) * STEP_DISTANCE_MM
+    else:
+        positions = np.asarray(movement_positions, dtype=np.float64)
+
+    # Distance from 0 step to center, the first of the nearest values to 0 on both sides
+    minus_mask = (-1 < values) & (values < 0)
+    plus_mask = (0 < values) & (values < 1)
+
+    most_minimum_minus_center_idx = int(np.argmax(np.where(minus_mask, values, -np.inf))) if minus_mask.any() else 0
+    most_minimum_minus_center = values[most_minimum_minus_center_idx] if minus_mask.any() else -1
+    most_minimum_plus_center_idx = int(np.argmin(np.where(plus_mask, values, np.inf))) if plus_mask.any() else 0
+    most_minimum_plus_center = values[most_minimum_plus_center_idx] if plus_mask.any() else 1
+
+    distance_between = positions[most_minimum_minus_center_idx] - positions[most_minimum_plus_center_idx]
+    center_distance_from_plus = (- distance_between * most_minimum_plus_center / (most_minimum_plus_center - most_minimum_minus_center))
+    distance_to_center = float(positions[most_minimum_plus_center_idx] - center_distance_from_plus)
+    print(f'distance to center from 0mm is {distance_to_center}mm')
+
+    mm_from_zero = positions - distance_to_center
+    dist_from_zero = np.abs(mm_from_zero)
+
+    # Calculating Stick Degrees from Neutral
+    stick_length = math.sqrt(stick_height_mm ** 2 + stick_radius_mm ** 2)
+    with np.errstate(invalid='ignore'):
+        right_to_center = np.degrees(np.arcsin((dist_from_zero + stick_radius_mm) / stick_length) - math.asin(stick_radius_mm / stick_length))
+        left_to_center = np.degrees(np.arcsin((dist_from_zero - stick_radius_mm) / stick_length) - math.asin(- stick_radius_mm / stick_length))
+
+    # center to right | -> / and right to center | <- /
+    right_mask = (mm_from_zero < 0) != reverse
+    degrees = np.where(right_mask, right_to_center, left_to_center)
+    if direction > 0:
+        degrees = - degrees
+
+    # Calculating Distance of Stick Top-Center from Neutral Center Axis
+    # Going to the center (reverse) the stick top is behind the pushed point, going out it is ahead.
+    tilt_offset = stick_radius_mm * np.cos(np.radians(degrees)) - stick_radius_mm
+    if reverse:
+        compensated_distances = - mm_from_zero + tilt_offset
+    else:
+        compensated_distances = - mm_from_zero - tilt_offset
+    if direction > 0:
+        compensated_distances = - compensated_distances
+
+    diff_degrees = np.zeros_like(values)
+    np.divide(values, degrees / LINEAR_CURVE_MAX_DEGREE, out=diff_degrees, where=(degrees != 0))
+    diff_degrees = np.where(degrees != 0, diff_degrees - 1, 0.0)
+
+    diff_distances = np.zeros_like(values)
+    np.divide(values, compensated_distances / LINEAR_CURVE_CENTER_MAX_DISTANCE, out=diff_distances, where=(compensated_distances != 0))
+    diff_distances = np.where(compensated_distances != 0, diff_distances - 1, 0.0)
+
+    response_curve_data.extend(np.column_stack([degrees, - mm_from_zero, values, diff_degrees, compensated_distances, diff_distances]).tolist())
+
+    return response_curve_data
+
+
+def save_response_curve(data, output_dir = ".", filename = None):
+    if filename is None:
+        dt = datetime.datetime.now()
+        filename = dt.strftime("%Y%m%d_%H%M%S_%f.csv")
+    filename = os.path.join(output_dir, filename)
     with open(filename, 'w') as fd:
         writer = csv.writer(fd)
         writer.writerows(data)
+    return filename
+
+
+## Step Timing
+# HDR-style histogram: values under 2**sub_bucket_bits are exact, larger ones go to log2 buckets
+# split into linear sub-buckets, so every value is kept within 1 / 2**(sub_bucket_bits - 1).
+class LatencyHistogram:
+    def __init__(self, sub_bucket_bits = LATENCY_SUB_BUCKET_BITS):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def _index(self, value):
+        shift = value.bit_length() - self.sub_bucket_bits
+        if shift <= 0:
+            return value
+        return (shift << self.sub_bucket_bits) + (value >> shift)
+
+    # Highest value counted in the bucket
+    def _value(self, index):
+        shift = index >> self.sub_bucket_bits
+        if shift == 0:
+            return index
+        return (((index & ((1 << self.sub_bucket_bits) - 1)) + 1) << shift) - 1
+
+    def record(self, value):
+        value = max(int(value), 0)
+        idx = self._index(value)
+        self.counts[idx] = self.counts.get(idx, 0) + 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        if self.count == 0:
+            return 0
+        rank = max(math.ceil(self.count * percent / 100), 1)
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if rank <= seen:
+                return min(self._value(idx), self.max)
+        return self.max
+
+    def summary(self):
+        report = {
+            "count": self.count,
+            "mean_us": self.total / self.count if self.count else 0,
+            "min_us": self.min or 0,
+            "max_us": self.max,
+        }
+        for percent in LATENCY_PERCENTILES:
+            report[f"p{percent}_us"] = self.percentile(percent)
+        return report
+
+
+# Durations of the STEP_PHASES of every step in us. A step overruns when the work before the tick
+# takes longer than the frame.
+class StepTimer:
+    def __init__(self, frame_rate = MEASURE_FRAME_RATE):
+        self.frame_us = int(1000000 / frame_rate)
+        self.histograms = {phase: LatencyHistogram() for phase in STEP_PHASES + ("step",)}
+        self.steps = []
+        self.overruns = 0
+        self.deadline_misses = 0    # from the StepScheduler
+        self._current = None
+        self._step_start = 0
+        self._last = 0
+
+    def start_step(self):
+        self._current = dict.fromkeys(STEP_PHASES, 0)
+        self._step_start = self._last = time.perf_counter_ns()
+
+    def mark(self, phase):
+        now = time.perf_counter_ns()
+        self._current[phase] += (now - self._last) // 1000
+        self._last = now
+
+    def end_step(self):
+        step = self._current
+        step["step"] = (self._last - self._step_start) // 1000
+        step["slack"] = self.frame_us - (step["step"] - step["tick"])
+        if step["slack"] < 0:
+            self.overruns += 1
+
+        for phase, histogram in self.histograms.items():
+            histogram.record(step[phase])
+        self.steps.append(step)
+
+    def postfix(self):
+        step = self.histograms["step"]
+        return "p99 {:.1f}ms, {:d} over".format(step.percentile(99) / 1000, self.overruns)
+
+    def summary(self):
+        return {
+            "frame_us": self.frame_us,
+            "steps": len(self.steps),
+            "overruns": self.overruns,
+            "deadline_misses": self.deadline_misses,
+            "max_overrun_us": max([-step["slack"] for step in self.steps if step["slack"] < 0], default=0),
+            "phases": {phase: histogram.summary() for phase, histogram in self.histograms.items()},
+        }
+
+    # Writing {result}_timing.json and {result}_timing.csv next to the result CSV
+    def save(self, result_filename):
+        base = os.path.splitext(result_filename)[0]
+        with open(base + "_timing.json", 'w') as fd:
+            json.dump(self.summary(), fd, indent=2)
+
+        keys = STEP_PHASES + ("step", "slack")
+        with open(base + "_timing.csv", 'w') as fd:
+            writer = csv.writer(fd)
+            writer.writerow([f"{key}_us" for key in keys])
+            writer.writerows([[step[key] for key in keys] for step in self.steps])
+
+        return base + "_timing.json"
+
+
+## Run Log
+# JSON lines for the headless mode, one object per event with the time it was written
+class RunLog:
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = open(filename, 'a')
+
+    def write(self, event, **fields):
+        record = {"time": datetime.datetime.now().isoformat(), "event": event}
+        record.update(fields)
+        self._fd.write(json.dumps(record) + "\n")
+        self._fd.flush()
+
+    def close(self):
+        self._fd.close()
+
+
+## Visualization
+# Largest-Triangle-Three-Buckets: keeps the points that shape the line when there are more than threshold
+def decimate_lttb(points, threshold):
+    if threshold < 3 or len(points) <= threshold:
+        return points
+
+    sampled = [points[0]]
+    bucket_size = (len(points) - 2) / (threshold - 2)
+    a = points[0]
+
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+
+        # Average of the next bucket
+        next_start = end
+        next_end = min(int((i + 2) * bucket_size) + 1, len(points))
+        next_bucket = points[next_start:next_end]
+        avg_x = sum(p[0] for p in next_bucket) / len(next_bucket)
+        avg_y = sum(p[1] for p in next_bucket) / len(next_bucket)
+
+        max_area = -1.0
+        for p in points[start:end]:
+            area = abs((a[0] - avg_x) * (p[1] - a[1]) - (a[0] - p[0]) * (avg_y - a[1]))
+            if max_area < area:
+                max_area = area
+                selected = p
+
+        sampled.append(selected)
+        a = selected
+
+    sampled.append(points[-1])
+    return sampled
+
+
+# Stands in for a pygame surface and pygame.draw to write the same drawing as SVG. GraphRenderer calls
+# SvgCanvas.line(canvas, ...) the way it calls pygame.draw.line(surface, ...).
+class SvgCanvas:
+    def __init__(self, size):
+        self.size = size
+        self.elements = []
+
+    def get_size(self):
+        return self.size
+
+    def fill(self, color):
+        self.elements = [f'<rect width="{self.size[0]}" height="{self.size[1]}" fill="{svg_color(color)}"/>']
+
+    def blit(self, source, dest):
+        if isinstance(source, SvgCanvas):
+            self.elements.append(f'<g transform="translate({dest[0]},{dest[1]})">' + "".join(source.elements) + '</g>')
+
+    def line(self, color, start_pos, end_pos, width = 1):
+        self.elements.append(f'<line x1="{start_pos[0]:.1f}" y1="{start_pos[1]:.1f}" x2="{end_pos[0]:.1f}" y2="{end_pos[1]:.1f}" stroke="{svg_color(color)}" stroke-width="{width}"/>')
+
+    def lines(self, color, closed, points, width = 1):
+        tag = "polygon" if closed else "polyline"
+        coords = " ".join(f"{x:.1f},{y:.1f}" for x, y in points)
+        self.elements.append(f'<{tag} points="{coords}" fill="none" stroke="{svg_color(color)}" stroke-width="{width}"/>')
+
+    def text(self, text, color, pos, size):
+        text = text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+        self.elements.append(f'<text x="{pos[0]}" y="{pos[1] + size}" fill="{svg_color(color)}" font-family="sans-serif" font-size="{size}">{text}</text>')
+
+    def save(self, filename):
+        with open(filename, 'w') as fd:
+            fd.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.size[0]}" height="{self.size[1]}" viewBox="0 0 {self.size[0]} {self.size[1]}">\n')
+            fd.write("\n".join(self.elements))
+            fd.write("\n</svg>\n")
+
+
+def svg_color(color):
+    return "#{:02x}{:02x}{:02x}".format(*color[:3])
+
+
+# Draws the graphs onto a surface. The grid is pre-rendered, the stats are processed incrementally
+# and the frame is only redrawn when the data changed.
+class GraphRenderer:
+    def __init__(self, screen, joystick_axis):
+        self.screen = screen
+        self.joystick_axis = joystick_axis
+        self.draw = SvgCanvas if isinstance(screen, SvgCanvas) else pygame.draw    #same calls for both targets
+        self.background = self.render_background()
+        self._series = {}
+        self._curves = {}
+        self._drawn_state = None
+
+    def render_background(self):
+        X=0; Y=1
+        if self.draw is SvgCanvas:
+            background = SvgCanvas(self.screen.get_size())
+        else:
+            background = pygame.Surface(self.screen.get_size())
+        background.fill(SCREEN_COLOR)
+
+        for top_left, bottom_right, height, lines in [
+            (GRAPH_BOX_TOP_LEFT, GRAPH_BOX_BOTTOM_RIGHT, GRAPH_BOX_HEIGHT, GRAPH_BOX_LINES),
+            (GRAPH_DIFF_BOX_TOP_LEFT, GRAPH_DIFF_BOX_BOTTOM_RIGHT, GRAPH_DIFF_BOX_HEIGHT, GRAPH_DIFF_BOX_LINES),
+        ]:
+            # Drawing Scales
+            for i in range(1, lines, 1):
+                line_x = top_left[X] + i * GRAPH_BOX_WIDTH / lines
+                self.draw.line(background, GRAPH_SUB_LINE_COLOR, (line_x, top_left[Y]), (line_x, bottom_right[Y]), 1)
+                line_y = top_left[Y] + i * height / lines
+                self.draw.line(background, GRAPH_SUB_LINE_COLOR, (top_left[X], line_y), (bottom_right[X], line_y), 1)
+
+            # Drawing Axes
+            line_x = top_left[X] + GRAPH_BOX_WIDTH / 2
+            self.draw.line(background, GRAPH_MAIN_LINE_COLOR, (line_x, top_left[Y] - GRAPH_MAIN_LINE_DELTA), (line_x, bottom_right[Y] + GRAPH_MAIN_LINE_DELTA), 2)
+            line_y = top_left[Y] + height / 2
+            self.draw.line(background, GRAPH_MAIN_LINE_COLOR, (top_left[X] - GRAPH_MAIN_LINE_DELTA, line_y), (bottom_right[X] + GRAPH_MAIN_LINE_DELTA, line_y), 2)
+
+        return background
+
+    # Stick values against the motor position, only the rows added since the last call are processed
+    def update_stats_series(self, name, st):
+        view = st.snapshot()
+        values = view[self.joystick_axis]
+        positions = view["motor_pos"]
+        truncations = getattr(st, "truncations", 0)
+
+        series = self._series.get(name)
+        if series is None or series["truncations"] != truncations or len(values) < series["processed"]:
+            series = {"processed": 1, "truncations": truncations, "moved": False, "moved_from": 0.0, "direction": 0, "max_distance": GRAPH_STATS_MIN_DISTANCE_MM, "points": []}
+            self._series[name] = series
+
+        for idx in range(series["processed"], len(values)):
+            val_before = values[idx - 1]
+            val = values[idx]
+
+            if not series["moved"]:
+                if not stick_move_starts(val_before, val):
+                    continue
+                series["moved"] = True
+                series["moved_from"] = positions[idx - 1]
+                series["direction"] = -1 if 0 < val else 1
+                series["points"].append((0.0, val_before))
+
+            distance = positions[idx] - series["moved_from"]
+            series["max_distance"] = max(series["max_distance"], distance)
+            series["points"].append((distance, val))
+
+        series["processed"] = max(series["processed"], len(values))
+        return (len(values), truncations)
+
+    def draw_stats_series(self, name, line_color):
+        X=0; Y=1
+        series = self._series[name]
+        if len(series["points"]) < 2:
+            return
+
+        scale = GRAPH_BOX_WIDTH / series["max_distance"]
+        if 0 < series["direction"]:
+            origin, scale = GRAPH_BOX_TOP_LEFT[X], scale
+        else:
+            origin, scale = GRAPH_BOX_BOTTOM_RIGHT[X], -scale
+
+        points = [(origin + scale * abs(distance), GRAPH_BOX_TOP_LEFT[Y] + GRAPH_BOX_HEIGHT - GRAPH_BOX_HEIGHT * ((val + 1.0) / 2.0)) for distance, val in series["points"]]
+        self.draw.lines(self.screen, line_color, False, decimate_lttb(points, GRAPH_BOX_WIDTH))
+
+    # Response curve and its difference to linear, projected once per result
+    def update_curve(self, name, rc_data, linear_max, graph_max, key_idx, val_idx):
+        X=0; Y=1
+        curve = self._curves.get(name)
+        if curve is not None and curve["length"] == len(rc_data):
+            return len(rc_data)
+
+        rows = rc_data[1:-1]
+        center_x = GRAPH_BOX_TOP_LEFT[X] + GRAPH_BOX_WIDTH / 2
+        curve = {
+            "length": len(rc_data),
+            "linear": [(center_x + GRAPH_BOX_WIDTH * (-linear_max) / graph_max, GRAPH_BOX_TOP_LEFT[Y] + GRAPH_BOX_HEIGHT), (center_x + GRAPH_BOX_WIDTH * linear_max / graph_max, GRAPH_BOX_TOP_LEFT[Y])],
+            "points": [(center_x + GRAPH_BOX_WIDTH * row[key_idx] / graph_max, GRAPH_BOX_TOP_LEFT[Y] + GRAPH_BOX_HEIGHT - GRAPH_BOX_HEIGHT * ((row[val_idx] + 1.0) / 2.0)) for row in rows],
+            "diffs": [],
+        }
+
+        # The difference is undefined at the center, the line is split there
+        diff_points = []
+        for row in rows:
+            key = row[key_idx]
+            if key == 0:
+                curve["diffs"].append(diff_points)
+                diff_points = []
+                continue
+            diff = row[val_idx] / (key / linear_max) - 1
+            diff_points.append((center_x + GRAPH_BOX_WIDTH * key / graph_max, GRAPH_DIFF_BOX_TOP_LEFT[Y] + GRAPH_DIFF_BOX_HEIGHT / 2 - GRAPH_DIFF_BOX_HEIGHT * diff))
+        curve["diffs"].append(diff_points)
+
+        self._curves[name] = curve
+        return len(rc_data)
+
+    def draw_curve(self, name, line_color):
+        curve = self._curves[name]
+        if 2 <= len(curve["points"]):
+            self.draw.lines(self.screen, line_color, False, decimate_lttb(curve["points"], GRAPH_BOX_WIDTH), 2)
+        for diff_points in curve["diffs"]:
+            if 2 <= len(diff_points):
+                self.draw.lines(self.screen, line_color, False, decimate_lttb(diff_points, GRAPH_BOX_WIDTH), 2)
+
+    # Each graph is (name, stats, response_curve_data, line color), returns True when the screen was redrawn
+    def render(self, graphs):
+        state = []
+        for name, st, rc_data, line_color in graphs:
+            if len(rc_data) > 2:
+                state.append(self.update_curve(name, rc_data, LINEAR_CURVE_CENTER_MAX_DISTANCE, 18.0, 4, 2))
+            else:
+                state.append(self.update_stats_series(name, st))
+
+        if state == self._drawn_state:
+            return False
+        self._drawn_state = state
+
+        self.screen.blit(self.background, (0, 0))
+
+        # The linear lines go under all the curves, they would cover the ones drawn before them
+        for name, st, rc_data, line_color in graphs:
+            if len(rc_data) > 2:
+                linear = self._curves[name]["linear"]
+                self.draw.line(self.screen, GRAPH_LINEAR_LINE_COLOR, linear[0], linear[1], 5)
+
+        for name, st, rc_data, line_color in graphs:
+            if len(rc_data) > 2:
+                self.draw_curve(name, line_color)
+            else:
+                self.draw_stats_series(name, line_color)
+
+        return True
 
 
 def visualization_main_loop(screen, stats, response_curve_data, joystick_axis, stop_event, change_event, reverse_stats = None, reverse_response_curve_data = None):
     clock = pygame.time.Clock()
-    
-    X=0; Y=1
-    GRAPH_BOX_TOP_LEFT = (100, 50)
-    GRAPH_BOX_WIDTH = 600
-    GRAPH_BOX_HEIGHT = 400
-    GRAPH_BOX_BOTTOM_RIGHT = (GRAPH_BOX_TOP_LEFT[X] + GRAPH_BOX_WIDTH, GRAPH_BOX_TOP_LEFT[Y] + GRAPH_BOX_HEIGHT)
-    GRAPH_BOX_LINES = 20
-
-    GRAPH_DIFF_BOX_TOP_LEFT = (GRAPH_BOX_TOP_LEFT[X], GRAPH_BOX_BOTTOM_RIGHT[Y] + 50)
-    GRAPH_DIFF_BOX_HEIGHT = 100
-    GRAPH_DIFF_BOX_BOTTOM_RIGHT = (GRAPH_DIFF_BOX_TOP_LEFT[X] + GRAPH_BOX_WIDTH, GRAPH_DIFF_BOX_TOP_LEFT[Y] + GRAPH_DIFF_BOX_HEIGHT)
-    GRAPH_DIFF_BOX_LINES = 10
-
-    GRAPH_MAIN_LINE_DELTA = 20
-
-    SCREEN_COLOR = (60, 60, 60)
-    GRAPH_MAIN_LINE_COLOR = (200, 200, 200)
-    GRAPH_SUB_LINE_COLOR = (150, 150, 150)
-    GRAPH_LINE_COLOR = (255, 128, 128)
-    GRAPH_LINEAR_LINE_COLOR = (150, 150, 150)
-    GRAPH_SECOND_LINE_COLOR = (128, 128, 255)
-
-    graph_box = (GRAPH_BOX_TOP_LEFT[X], GRAPH_BOX_TOP_LEFT[Y], GRAPH_BOX_WIDTH, GRAPH_BOX_HEIGHT)
-
-    def draw_stats(st_data, line_color = GRAPH_LINE_COLOR):
-        stick_moved = False
-        stick_moved_from = 0.0
-        direction = 0
-        max_distance = 14.0 #mm
-
-        for idx, val in enumerate(st_data[joystick_axis][1:-1]):
-            val_before = st_data[joystick_axis][idx - 1]
-            distance = st_data["motor_pos"][idx]
-            distance_before = st_data["motor_pos"][idx - 1]
-
-            if max_distance < (distance - stick_moved_from):
-                max_distance = distance - stick_moved_from
-
-            if not stick_moved:
-                if stick_move_starts(val_before, val):
-                    stick_moved = True
-                    stick_moved_from = distance
-                    if 0 < val:
-                        direction = -1
-                    else:
-                        direction = 1
-                else: #(val <= -1.0 or 1.0 <= val)
-                    continue
+    renderer = GraphRenderer(screen, joystick_axis)
 
-            if 0 < direction:
-                pygame.draw.line(screen, line_color,
-                    (
-                        GRAPH_BOX_TOP_LEFT[X] + abs(GRAPH_BOX_WIDTH * (distance_before - stick_moved_from) / max_distance),
-                        GRAPH_BOX_TOP_LEFT[Y] + GRAPH_BOX_HEIGHT - GRAPH_BOX_HEIGHT * ((val_before + 1.0) / 2.0)
-                    ), (
-                        GRAPH_BOX_TOP_LEFT[X] + abs(GRAPH_BOX_WIDTH * (distance - stick_moved_from) / max_distance),
-                        GRAPH_BOX_TOP_LEFT[Y] + GRAPH_BOX_HEIGHT - GRAPH_BOX_HEIGHT * ((val + 1.0) / 2.0)
-                ))
-            else:
-                pygame.draw.line(screen, line_color,
-                    (
-                        GRAPH_BOX_BOTTOM_RIGHT[X] - abs(GRAPH_BOX_WIDTH * (distance_before - stick_moved_from) / max_distance),
-                        GRAPH_BOX_TOP_LEFT[Y] + GRAPH_BOX_HEIGHT - GRAPH_BOX_HEIGHT * ((val_before + 1.0) / 2.0)
-                    ), (
-                        GRAPH_BOX_BOTTOM_RIGHT[X] - abs(GRAPH_BOX_WIDTH * (distance - stick_moved_from) / max_distance),
-                        GRAPH_BOX_TOP_LEFT[Y] + GRAPH_BOX_HEIGHT - GRAPH_BOX_HEIGHT * ((val + 1.0) / 2.0)
-                ))
-
-
-    def draw_response_curve_data(rc_data, linear_max, graph_max, key_idx, val_idx, line_color = GRAPH_LINE_COLOR):
-
-        pygame.draw.line(screen, GRAPH_LINEAR_LINE_COLOR,
-            (
-                GRAPH_BOX_TOP_LEFT[X] + GRAPH_BOX_WIDTH / 2 + GRAPH_BOX_WIDTH * (-linear_max) / graph_max,
-                GRAPH_BOX_TOP_LEFT[Y] + GRAPH_BOX_HEIGHT
-            ),(
-                GRAPH_BOX_TOP_LEFT[X] + GRAPH_BOX_WIDTH / 2 + GRAPH_BOX_WIDTH * linear_max / graph_max,
-                GRAPH_BOX_TOP_LEFT[Y]
-        ), 5)
-
-        for idx, data in enumerate(rc_data[2:-1]):
-            val = data[val_idx]
-            val_before = rc_data[idx - 1 + 2][val_idx]
-            key = data[key_idx]
-            key_before = rc_data[idx - 1 + 2][key_idx]
-
-            pygame.draw.line(screen, line_color,
-                (
-                    GRAPH_BOX_TOP_LEFT[X] + GRAPH_BOX_WIDTH / 2 + GRAPH_BOX_WIDTH * key_before / graph_max,
-                    GRAPH_BOX_TOP_LEFT[Y] + GRAPH_BOX_HEIGHT - GRAPH_BOX_HEIGHT * ((val_before + 1.0) / 2.0)
-                ), (
-                    GRAPH_BOX_TOP_LEFT[X] + GRAPH_BOX_WIDTH / 2 + GRAPH_BOX_WIDTH * key / graph_max,
-                    GRAPH_BOX_TOP_LEFT[Y] + GRAPH_BOX_HEIGHT - GRAPH_BOX_HEIGHT * ((val + 1.0) / 2.0)
-            ), 2)
-        
-            #DIFF
-            if (key != 0 and key_before != 0):
-                diff_before = val_before / (key_before / linear_max) - 1
-                diff = val / (key / linear_max) - 1
+    graphs = [("forward", stats, response_curve_data, GRAPH_LINE_COLOR)]
+    if reverse_stats is not None:
+        graphs.append(("reverse", reverse_stats, reverse_response_curve_data, GRAPH_SECOND_LINE_COLOR))
+
+    while not stop_event.is_set() and not change_event.is_set():
+        if renderer.render(graphs):
+            pygame.display.flip()
+        clock.tick(60)
+
+## Shared Memory Sample Ring
+# Header: int64 head (rows written), truncations, response curve rows, capacity
+# Then capacity rows of (motor_pos, axis value) and capacity response curve rows.
+# One writer (the measurement process) never waits on the readers; a reader copies what is
+# published and starts over when it sees a truncation or fell a whole ring behind.
+class SampleRing:
+    def __init__(self, joystick_axis, capacity = RENDER_RING_CAPACITY, name = None):
+        from multiprocessing import shared_memory
+
+        self.joystick_axis = joystick_axis
+        self.owner = name is None
+
+        if self.owner:
+            size = 8 * (RENDER_RING_HEADER + capacity * (2 + RENDER_RING_CURVE_COLUMNS))
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.header = self.shm.buf[:8 * RENDER_RING_HEADER].cast('q')
+            self.header[3] = capacity
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.header = self.shm.buf[:8 * RENDER_RING_HEADER].cast('q')
+            capacity = self.header[3]
+
+        self.capacity = capacity
+        data_end = 8 * (RENDER_RING_HEADER + capacity * 2)
+        self.rows = self.shm.buf[8 * RENDER_RING_HEADER:data_end].cast('d')
+        self.curve = self.shm.buf[data_end:data_end + 8 * capacity * RENDER_RING_CURVE_COLUMNS].cast('d')
+
+        # Reader side copies
+        self.truncations = 0
+        self.response_curve_data = gen_response_curve_data()
+        self._positions = array('d')
+        self._values = array('d')
+        self._seen_truncations = 0
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    # SampleStore listener
+    def write_row(self, sweep, flags, row):
+        head = self.header[0]
+        idx = 2 * (head % self.capacity)
+        self.rows[idx] = row["motor_pos"]
+        self.rows[idx + 1] = row[self.joystick_axis]
+        self.header[0] = head + 1
+
+    def drop_rows(self, sweep, flags, count):
+        self.header[1] += 1
+        self.header[0] = max(0, self.header[0] - count)
+
+    def restart(self, sweep):
+        self.header[1] += 1
+        self.header[0] = 0
+        self.header[2] = 0
+
+    def publish_response_curve(self, response_curve_data):
+        rows = response_curve_data[1:self.capacity + 1]
+        for i, row in enumerate(rows):
+            self.curve[i * RENDER_RING_CURVE_COLUMNS:(i + 1) * RENDER_RING_CURVE_COLUMNS] = array('d', row)
+        self.header[2] = len(rows)
+
+    # Copying the rows published since the last poll
+    def poll(self):
+        truncations = self.header[1]
+        head = self.header[0]
+
+        reset = truncations != self._seen_truncations or head < len(self._values) or self.capacity < head - len(self._values)
+        start = max(0, head - self.capacity) if reset else len(self._values)
+
+        positions = array('d')
+        values = array('d')
+        for i in range(start, head):
+            idx = 2 * (i % self.capacity)
+            positions.append(self.rows[idx])
+            values.append(self.rows[idx + 1])
+
+        # The writer truncated while copying, the rows are taken again on the next poll
+        if self.header[1] != truncations:
+            return
+
+        if reset:
+            self._seen_truncations = truncations
+            self.truncations += 1
+            self._positions = positions
+            self._values = values
+        else:
+            self._positions.extend(positions)
+            self._values.extend(values)
+
+        curve_rows = self.header[2]
+        if curve_rows != len(self.response_curve_data) - 1:
+            self.response_curve_data = gen_response_curve_data()
+            for i in range(curve_rows):
+                self.response_curve_data.append(list(self.curve[i * RENDER_RING_CURVE_COLUMNS:(i + 1) * RENDER_RING_CURVE_COLUMNS]))
+
+    def snapshot(self):
+        return {"motor_pos": self._positions, self.joystick_axis: self._values}
+
+    def close(self):
+        self.header.release()
+        self.rows.release()
+        self.curve.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+# Runs in its own process, the measurement only feeds the rings
+def visualization_process_main(ring_names, joystick_axis, stop_event, change_event):
+    pygame.display.init()
+    screen = pygame.display.set_mode(WINDOW_SIZE)
+    pygame.display.set_caption(WINDOW_CAPTION)
+    clock = pygame.time.Clock()
+    renderer = GraphRenderer(screen, joystick_axis)
+
+    rings = [SampleRing(joystick_axis, name = name) for name in ring_names]
+    colors = [GRAPH_LINE_COLOR, GRAPH_SECOND_LINE_COLOR]
 
-                pygame.draw.line(screen, line_color,
-                    (
-                        GRAPH_DIFF_BOX_TOP_LEFT[X] + GRAPH_BOX_WIDTH / 2 + GRAPH_BOX_WIDTH * key_before / graph_max,
-                        GRAPH_DIFF_BOX_TOP_LEFT[Y] + GRAPH_DIFF_BOX_HEIGHT / 2 - GRAPH_DIFF_BOX_HEIGHT * diff_before
-                    ), (
-                        GRAPH_DIFF_BOX_TOP_LEFT[X] + GRAPH_BOX_WIDTH / 2 + GRAPH_BOX_WIDTH * key / graph_max,
-                        GRAPH_DIFF_BOX_TOP_LEFT[Y] + GRAPH_DIFF_BOX_HEIGHT / 2 - GRAPH_DIFF_BOX_HEIGHT * diff
-                ), 2)
+    try:
+        while not stop_event.is_set() and not change_event.is_set():
+            if pygame.event.get(pygame.QUIT):
+                stop_event.set()
+                break
+
+            for ring in rings:
+                ring.poll()
+            graphs = [(str(i), ring, ring.response_curve_data, colors[i]) for i, ring in enumerate(rings)]
+            if renderer.render(graphs):
+                pygame.display.flip()
+            clock.tick(60)
+    finally:
+        for ring in rings:
+            ring.close()
+        pygame.quit()
+
+
+## Multi-Rig
+# "port:controller:axis[:stick]", the port is a device name, an index of the com ports or "sim"
+def parse_rig_assignment(text):
+    fields = text.split(":")
+    if len(fields) < 3 or 4 < len(fields):
+        raise ValueError(f'rig assignment must be "port:controller:axis[:stick]" but "{text}"')
+
+    port, controller, axis = fields[:3]
+    if axis not in AXIS_INDEXES:
+        raise ValueError(f"joystick axis must be one of {', '.join(AXIS_INDEXES)} but {axis}")
 
-    def draw_response_curve_data_by_center_distance(rc_data, line_color = GRAPH_LINE_COLOR):
-        draw_response_curve_data(rc_data, LINEAR_CURVE_CENTER_MAX_DISTANCE, 18.0, 4, 2, line_color)
+    return {
+        "port": port,
+        "controller": int(controller),
+        "axis": axis,
+        "stick_height_mm": stick_height_from_profile(fields[3].lower()) if len(fields) == 4 else STICK_HEIGHT_MM,
+    }
 
-    def draw_response_curve_data_by_distance(rc_data, line_color = GRAPH_LINE_COLOR):
-        draw_response_curve_data(rc_data, LINEAR_CURVE_MAX_DISTANCE, 18.0, 4, 1, line_color)
 
-    def draw_response_curve_data_by_degree(rc_data, line_color = GRAPH_LINE_COLOR):
-        draw_response_curve_data(rc_data, LINEAR_CURVE_MAX_DEGREE, 45.0, 0, 2, line_color)
+# Runs in a worker process: one rig, its own clock and output directory
+def rig_worker_main(rig_idx, rig, output_dir, options):
+    os.environ["SDL_JOYSTICK_ALLOW_BACKGROUND_EVENTS"] = "1"
+    pygame.joystick.init()
+    pygame.display.init()   #for the events
 
+    label = f"rig{rig_idx} {rig['port']}"
+    rig_dir = os.path.join(output_dir, f"rig{rig_idx}_" + re.sub(r"[^0-9A-Za-z]+", "_", rig["port"]).strip("_"))
+    os.makedirs(rig_dir, exist_ok=True)
 
-    while not stop_event.is_set() and not change_event.is_set():
-        screen.fill(SCREEN_COLOR)
-
-        ## Response Curve Graph
-        # Drawing Scales
-        for i in range(1, GRAPH_BOX_LINES, 1):
-            line_x = GRAPH_BOX_TOP_LEFT[X] + i * GRAPH_BOX_WIDTH / GRAPH_BOX_LINES
-            pygame.draw.line(screen, GRAPH_SUB_LINE_COLOR, (line_x, GRAPH_BOX_TOP_LEFT[Y]), (line_x, GRAPH_BOX_BOTTOM_RIGHT[Y]), 1)
-            line_y = GRAPH_BOX_TOP_LEFT[Y] + i * GRAPH_BOX_HEIGHT / GRAPH_BOX_LINES
-            pygame.draw.line(screen, GRAPH_SUB_LINE_COLOR, (GRAPH_BOX_TOP_LEFT[X], line_y), (GRAPH_BOX_BOTTOM_RIGHT[X], line_y), 1)
-
-        # Drawing Axes
-        line_x = GRAPH_BOX_TOP_LEFT[X] + GRAPH_BOX_WIDTH / 2
-        pygame.draw.line(screen, GRAPH_MAIN_LINE_COLOR, (line_x, GRAPH_BOX_TOP_LEFT[Y] - GRAPH_MAIN_LINE_DELTA), (line_x, GRAPH_BOX_BOTTOM_RIGHT[Y] + GRAPH_MAIN_LINE_DELTA), 2)
-        line_y = GRAPH_BOX_TOP_LEFT[Y] + GRAPH_BOX_HEIGHT / 2
-        pygame.draw.line(screen, GRAPH_MAIN_LINE_COLOR, (GRAPH_BOX_TOP_LEFT[X] - GRAPH_MAIN_LINE_DELTA, line_y), (GRAPH_BOX_BOTTOM_RIGHT[X] + GRAPH_MAIN_LINE_DELTA, line_y), 2)
-
-        ## Difference to Linear Graph
-        # Drawing Scales
-        for i in range(1, GRAPH_DIFF_BOX_LINES, 1):
-            line_x = GRAPH_DIFF_BOX_TOP_LEFT[X] + i * GRAPH_BOX_WIDTH / GRAPH_DIFF_BOX_LINES
-            pygame.draw.line(screen, GRAPH_SUB_LINE_COLOR, (line_x, GRAPH_DIFF_BOX_TOP_LEFT[Y]), (line_x, GRAPH_DIFF_BOX_BOTTOM_RIGHT[Y]), 1)
-            line_y = GRAPH_DIFF_BOX_TOP_LEFT[Y] + i * GRAPH_DIFF_BOX_HEIGHT / GRAPH_DIFF_BOX_LINES
-            pygame.draw.line(screen, GRAPH_SUB_LINE_COLOR, (GRAPH_DIFF_BOX_TOP_LEFT[X], line_y), (GRAPH_DIFF_BOX_BOTTOM_RIGHT[X], line_y), 1)
-
-        # Drawing Axes
-        line_x = GRAPH_DIFF_BOX_TOP_LEFT[X] + GRAPH_BOX_WIDTH / 2
-        pygame.draw.line(screen, GRAPH_MAIN_LINE_COLOR, (line_x, GRAPH_DIFF_BOX_TOP_LEFT[Y] - GRAPH_MAIN_LINE_DELTA), (line_x, GRAPH_DIFF_BOX_BOTTOM_RIGHT[Y] + GRAPH_MAIN_LINE_DELTA), 2)
-        line_y = GRAPH_DIFF_BOX_TOP_LEFT[Y] + GRAPH_DIFF_BOX_HEIGHT / 2
-        pygame.draw.line(screen, GRAPH_MAIN_LINE_COLOR, (GRAPH_DIFF_BOX_TOP_LEFT[X] - GRAPH_MAIN_LINE_DELTA, line_y), (GRAPH_DIFF_BOX_BOTTOM_RIGHT[X] + GRAPH_MAIN_LINE_DELTA, line_y), 2)
-
-
-        ## Drawing Graphs
-        if len(response_curve_data) > 2:
-            draw_response_curve_data_by_center_distance(response_curve_data)
+    try:
+        if rig["port"] == "sim":
+            ser, joystick = open_simulated_rig(rig["axis"], options["sim_deadzone"], options["sim_curve"], options["sim_noise"], options["sim_latency_ms"], seed = rig_idx)
         else:
-            draw_stats(stats)
+            port = rig["port"]
+            if port.isdigit():
+                from serial.tools import list_ports
+                port = list_ports.comports()[int(port)].device
+            ser = serial.Serial(port, DEFAULT_SERIAL_BAUD_RATE)
+            joystick = pygame.joystick.Joystick(rig["controller"])
 
-        if len(reverse_response_curve_data) > 2:
-            draw_response_curve_data_by_center_distance(reverse_response_curve_data, GRAPH_SECOND_LINE_COLOR)
+        try:
+            ser = open_motion_link(ser, options["protocol"])
+            timing = load_sweep_timing(joystick, options)
+            capture = None
+            if options["capture"]:
+                capture = open_raw_capture(joystick, rig["axis"], timing, rig_dir, rig["stick_height_mm"])
+
+            move_end_count = measure_sweep_pair(joystick, rig["axis"], ser, Event(), Event(),
+                                                (gen_stats((capture,), 0), gen_response_curve_data()), (gen_stats((capture,), 1, True), gen_response_curve_data()),
+                                                rig_dir, options["adaptive"], timing, options["continuous"], rig["stick_height_mm"], {"position": rig_idx, "desc": label, "leave": True})
+            if capture:
+                capture.close()
+        finally:
+            ser.close()
+    except Exception as e:
+        return {"rig": label, "output_dir": rig_dir, "error": str(e)}
+    finally:
+        pygame.quit()
+
+    return {"rig": label, "output_dir": rig_dir, "move_end_count": move_end_count, "files": sorted(os.listdir(rig_dir))}
+
+
+def run_multi_rig(rigs, output_dir, options):
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm import tqdm
+
+    context = multiprocessing.get_context("spawn")
+    lock = context.RLock()
+
+    results = []
+    with ProcessPoolExecutor(max_workers = len(rigs), mp_context = context, initializer = tqdm.set_lock, initargs = (lock,)) as executor:
+        futures = [executor.submit(rig_worker_main, idx, rig, output_dir, options) for idx, rig in enumerate(rigs)]
+        for future in futures:
+            results.append(future.result())
+
+    print("\n -- rigs -- ")
+    for result in results:
+        if "error" in result:
+            print(f"\033[31m{result['rig']}: {result['error']}\033[0m")
         else:
-            draw_stats(reverse_stats, GRAPH_SECOND_LINE_COLOR)
+            print(f"{result['rig']}: {len(result['files'])} files in {result['output_dir']}")
+    return results
+
+
+## Sweep Batch
+# Streaming mean and variance (Welford) of the stick value at each motor position over the sweeps of a batch,
+# so the memory only grows with the number of positions.
+class SweepAggregate:
+    def __init__(self):
+        self.sweeps = 0
+        self.positions = {}     # motor count -> [n, mean, M2]
+
+    def add(self, motor_positions, values):
+        self.sweeps += 1
+        for pos, val in zip(motor_positions, values):
+            acc = self.positions.setdefault(round(pos / STEP_DISTANCE_MM), [0, 0.0, 0.0])
+            acc[0] += 1
+            delta = val - acc[1]
+            acc[1] += delta / acc[0]
+            acc[2] += delta * (val - acc[1])
+
+    # (motor_pos, n, mean, std, half width of the confidence interval of the mean)
+    def rows(self, z = CONVERGE_Z):
+        rows = []
+        for count in sorted(self.positions):
+            n, mean, m2 = self.positions[count]
+            std = math.sqrt(m2 / (n - 1)) if 1 < n else 0.0
+            rows.append((count * STEP_DISTANCE_MM, n, mean, std, z * std / math.sqrt(n)))
+        return rows
+
+
+# Confidence bands of every motor position, and the response curves of the mean values
+def save_batch_result(aggregates, joystick_axis, output_dir = ".", stick_height_mm = None):
+    name = datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    filename = os.path.join(output_dir, f"{name}_batch.csv")
+    with open(filename, 'w', newline='') as fd:
+        writer = csv.writer(fd)
+        writer.writerow(BATCH_COLUMNS)
+        for sweep, aggregate in enumerate(aggregates):
+            for motor_pos, n, mean, std, half_width in aggregate.rows():
+                writer.writerow([sweep, motor_pos, n, mean, std, mean - half_width, mean + half_width])
+
+    filenames = [filename]
+    for sweep, aggregate in enumerate(aggregates):
+        rows = aggregate.rows()
+        stats = {"motor_pos": [row[0] for row in rows], joystick_axis: [row[2] for row in rows]}
+        movement = find_movement(stats[joystick_axis])
+        if movement is None:
+            continue
+        move_start_idx, move_end_idx, direction, min_value, max_value = movement
+        filenames.append(finish_sweep(stats, joystick_axis, move_start_idx, move_end_idx, direction, min_value, max_value, gen_response_curve_data(), sweep == 1, output_dir,
+                                      stick_height_mm, f"{name}_batch_mean_{sweep}.csv"))
+
+    print(f'{aggregates[0].sweeps} sweep pairs aggregated, saved to {", ".join(filenames)}')
+    return filenames
+
+
+## Endurance
+# Raw capture split into segments of at most segment_bytes or segment_s, a new one is started between sweeps
+# so every segment can be reanalyzed by itself. Only the newest keep segments stay on disk.
+class RollingCaptureWriter:
+    def __init__(self, output_dir, header, segment_bytes, segment_s, keep = ENDURANCE_KEEP_SEGMENTS):
+        self.output_dir = output_dir
+        self.header = header
+        self.segment_bytes = segment_bytes
+        self.segment_s = segment_s
+        self.keep = keep
+        self.segments = deque()
+        self.rows = 0
+        self._index = 0
+        self._writer = None
+        self._roll()
+
+    def _roll(self):
+        if self._writer:
+            self._writer.close()
+
+        filename = os.path.join(self.output_dir, datetime.datetime.now().strftime("%Y%m%d_%H%M%S_%f") + RAW_CAPTURE_EXTENSION)
+        self._writer = RawCaptureWriter(filename, dict(self.header, segment=self._index))
+        self._index += 1
+        self._started = time.monotonic()
+        self.segments.append(filename)
+        while self.keep < len(self.segments):
+            os.remove(self.segments.popleft())
+
+    @property
+    def filename(self):
+        return self._writer.filename
+
+    # The sweep index of a record is uint16
+    def write_row(self, sweep, flags, row):
+        self._writer.write_row(sweep % 65536, flags, row)
+        self.rows += 1
+
+    def drop_rows(self, sweep, flags, count):
+        self._writer.drop_rows(sweep % 65536, flags, count)
+
+    def restart(self, sweep):
+        if self.segment_bytes <= os.path.getsize(self._writer.filename) or self.segment_s <= time.monotonic() - self._started:
+            self._roll()
+
+    def close(self):
+        self._writer.close()
+
+
+# Summary of a sweep for the endurance time series, motor positions in mm from the motor's 0.
+# Returns (center, deadzone start, deadzone end, min value, max value) or None.
+def summarize_sweep(stats, joystick_axis):
+    movement = find_movement(stats[joystick_axis])
+    if movement is None:
+        return None
+
+    move_start_idx, move_end_idx, direction, min_value, max_value = movement
+    values = stats[joystick_axis][move_start_idx:move_end_idx + 1]
+    positions = stats["motor_pos"][move_start_idx:move_end_idx + 1]
+    sign = 1 if positions[0] <= positions[-1] else -1
+    center_mm = positions[0] + sign * determine_center_from_zero_idx(values, [abs(pos - positions[0]) for pos in positions])
+
+    dead = [pos for pos, val in zip(positions, values) if abs(val) <= ANALYZE_DEADZONE_VALUE]
+    deadzone = (min(dead), max(dead)) if dead else (float("nan"), float("nan"))
+    return center_mm, deadzone[0], deadzone[1], min_value, max_value
+
+
+# Sweep pairs repeated every interval_s until duration_s is over. A summary row per sweep is appended to the
+# time series CSV as it comes and only the newest per-sweep result files are kept, so the disk use stays flat
+# apart from the one row per sweep.
+class EnduranceRun:
+    def __init__(self, duration_s, interval_s = ENDURANCE_INTERVAL_S, output_dir = ".", segment_mb = ENDURANCE_SEGMENT_MB, segment_minutes = ENDURANCE_SEGMENT_MINUTES,
+                 keep_segments = ENDURANCE_KEEP_SEGMENTS, keep_results = ENDURANCE_KEEP_RESULTS):
+        self.duration_s = duration_s
+        self.interval_s = interval_s
+        self.output_dir = output_dir
+        self.segment_bytes = int(segment_mb * 1024 * 1024)
+        self.segment_s = segment_minutes * 60
+        self.keep_segments = keep_segments
+        self.keep_results = keep_results
+        self.sweeps = 0
+        self._results = deque()
+        self._start = time.monotonic()
+        self._next_start = self._start
+
+        self.filename = os.path.join(output_dir, datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + ENDURANCE_SUFFIX)
+        self._fd = open(self.filename, 'w', newline='')
+        self._writer = csv.writer(self._fd)
+        self._writer.writerow(ENDURANCE_COLUMNS)
+        self._fd.flush()
+
+    def elapsed_s(self):
+        return time.monotonic() - self._start
+
+    def open_capture(self, joystick, joystick_axis, timing, stick_height_mm = None):
+        return RollingCaptureWriter(self.output_dir, gen_capture_header(joystick, joystick_axis, timing, stick_height_mm), self.segment_bytes, self.segment_s, self.keep_segments)
+
+    # Waiting for the start of the next pair, False when the run is over or was stopped. A pair that took
+    # longer than the interval is followed right away, the missed starts are not caught up.
+    def wait_next(self, stop_event):
+        self._next_start = max(self._next_start + self.interval_s, time.monotonic())
+        if self.duration_s <= self._next_start - self._start:
+            return False
+
+        if time.monotonic() < self._next_start:
+            print(f"next endurance sweep pair in {self._next_start - time.monotonic():.0f}s.")
+        while time.monotonic() < self._next_start:
+            if pygame.display.get_init() and pygame.event.get(pygame.QUIT):
+                stop_event.set()
+            if stop_event.is_set():
+                return False
+            time.sleep(min(0.1, max(self._next_start - time.monotonic(), 0)))
+        return True
 
+    def sweep_done(self, pair, sweep, stats, joystick_axis):
+        summary = summarize_sweep(stats, joystick_axis) or (float("nan"),) * 5
+        self._writer.writerow([datetime.datetime.now().isoformat(timespec="seconds"), round(time.monotonic() - self._start, 3), pair, sweep, len(stats), *summary, stats.result_filename])
+        self._fd.flush()
+        self.sweeps += 1
 
-        pygame.display.flip()
-        clock.tick(60)
+        # The step timing CSV is next to the json
+        files = [stats.result_filename]
+        if stats.timing_filename:
+            files += [stats.timing_filename, os.path.splitext(stats.timing_filename)[0] + ".csv"]
+        self._results.append(files)
+        while self.keep_results < len(self._results):
+            for filename in self._results.popleft():
+                if filename and os.path.exists(filename):
+                    os.remove(filename)
 
+    def close(self):
+        self._fd.close()
 
-def start_main_loop(screen, joystick, joystick_axis, ser, stop_event, change_event):
-    def gen_stats():
-        stats = {}
-        for key in ["timestamps", "elapsed_time", "motor_pos", "lx", "ly", "rx", "ry", "lt", "rt"]:
-            stats[key] = []
-        return stats
 
-    def gen_response_curve_data():
-        response_curve_data = [['degrees', 'distances', 'values', 'diff_degrees', 'compensated_distances', 'diff_compensated_distances']]
-        return response_curve_data
+## Timing Calibration
+def timing_profile_filename(controller_name):
+    return os.path.join(TIMING_PROFILE_DIR, re.sub(r"[^0-9A-Za-z]+", "_", controller_name).strip("_") + ".json")
 
-    # Preparing Variables
+
+def percentile_95(values):
+    return sorted(values)[int(len(values) * 0.95)]
+
+
+# A forward fixed sampling sweep from start_count, None when it was interrupted
+def calibration_sweep(joystick, joystick_axis, ser, timing, output_dir, start_count = 0, progress = None):
     stats = gen_stats()
-    response_curve_data = gen_response_curve_data()
-    reverse_stats = gen_stats()
-    reverse_response_curve_data = gen_response_curve_data()
+    move_end_count = measure_main_loop(joystick, joystick_axis, ser, stats, gen_response_curve_data(), Event(), Event(), False, start_count, output_dir = output_dir,
+                                       timing = dict(timing, sampling = "fixed"), progress = progress)
+    if move_end_count is None:
+        return None
+    return stats
+
+
+# p95 of the differences of the stick values to the reference at the same motor positions in its movement
+def compare_sweeps(stats, reference, joystick_axis):
+    move_start_idx, move_end_idx = find_movement(reference[joystick_axis])[:2]
+    reference_values = {round(pos / STEP_DISTANCE_MM): val for pos, val in
+                        zip(reference["motor_pos"][move_start_idx:move_end_idx + 1], reference[joystick_axis][move_start_idx:move_end_idx + 1])}
+    diffs = [abs(val - reference_values[round(pos / STEP_DISTANCE_MM)]) for pos, val in zip(stats["motor_pos"], stats[joystick_axis])
+             if round(pos / STEP_DISTANCE_MM) in reference_values]
+    if len(diffs) < len(reference_values) // 2:
+        return float("inf")
+    return percentile_95(diffs)
+
+
+# Noise floor, report interval, settle time after a step, move and read times of the controller with the stick held around count
+def measure_axis_timing(joystick, joystick_axis, ser, timing, count):
+    move_motor(ser, count * DEFAULT_NUM_STEP, timing, 0, travel = True)
+
+    start_ns = time.perf_counter_ns()
+    for i in range(CALIBRATE_READS):
+        for axis in AXIS_INDEXES:
+            read_axis(joystick, axis)
+    read_ms = (time.perf_counter_ns() - start_ns) / CALIBRATE_READS / 1000000
+
+    move_times = []
+    for i in range(CALIBRATE_SETTLE_STEPS):
+        start_ns = time.perf_counter_ns()
+        move_motor(ser, (count + (i + 1) % 2) * DEFAULT_NUM_STEP, timing)
+        move_times.append((time.perf_counter_ns() - start_ns) / 1000000)
+        precise_wait_ms(timing["before_sense_ms"])
+
+    sampler = JoystickSampler(joystick)
+    sampler.start()
+    try:
+        start_ns = time.perf_counter_ns()
+        pump_until_ns(start_ns + int(CALIBRATE_HOLD_S * 1000000000))
+        changes = sampler.changes(joystick_axis, start_ns, time.perf_counter_ns())
+        values = [val for t_ns, val in changes]
+        mean = sum(values) / len(values) if values else 0.0
+        noise = math.sqrt(sum((val - mean) ** 2 for val in values) / len(values)) if 1 < len(values) else 0.0
+        intervals = sorted((b[0] - a[0]) / 1000000 for a, b in zip(changes[1:], changes[2:]))
+        report_interval_ms = intervals[len(intervals) // 2] if intervals else None
+
+        # The time from the end of a move until the value stays within the noise of where it ends up
+        threshold = max(CONVERGE_RESET_SIGMA * noise, CONVERGE_SETTLE_THRESHOLD)
+        settle_times = []
+        for i in range(CALIBRATE_SETTLE_STEPS):
+            move_motor(ser, (count + (i + 1) % 2 * CALIBRATE_SETTLE_STEP_COUNTS) * DEFAULT_NUM_STEP, timing, CALIBRATE_SETTLE_STEP_COUNTS * DEFAULT_NUM_STEP)
+            done_ns = time.perf_counter_ns()
+            pump_until_ns(done_ns + int(CALIBRATE_SETTLE_WINDOW_MS * 1000000))
+            end_ns = time.perf_counter_ns()
+
+            final = sampler.average(end_ns - int(CALIBRATE_SETTLE_TAIL_MS * 1000000), end_ns)[0][joystick_axis]
+            settled_ns = done_ns
+            for t_ns, val in sampler.changes(joystick_axis, done_ns, end_ns):
+                if threshold < abs(val - final):
+                    settled_ns = None
+                elif settled_ns is None:
+                    settled_ns = t_ns
+            settle_times.append(((settled_ns or end_ns) - done_ns) / 1000000)
+    finally:
+        sampler.stop()
 
-    # Starting Visualization Thread
-    visualization_thread = None
-    visualization_thread = Thread(target=visualization_main_loop, args=(screen, stats, response_curve_data, joystick_axis, stop_event, change_event, reverse_stats, reverse_response_curve_data))
-    visualization_thread.start()
+    return {
+        "count": count,
+        "noise": noise,
+        "report_interval_ms": report_interval_ms,
+        "settle_ms_p95": percentile_95(settle_times),
+        "settle_ms_max": max(settle_times),
+        "move_ms_p95": percentile_95(move_times),
+        "read_ms": read_ms,
+    }
 
 
-    # Starting Measurement
-    move_end_count = measure_main_loop(joystick, joystick_axis, ser, stats, response_curve_data, stop_event, change_event)
+# The reads have to get the mean within the confidence target at the measured noise, the settle time and the
+# read count are stretched by margin. The frame is the expected step time with CALIBRATE_FRAME_MARGIN of slack.
+def calibrated_timing(timing, measurements, margin):
+    repeat_times = 1
+    if measurements["noise"]:
+        repeat_times = (CONVERGE_Z * measurements["noise"] / timing["confidence"]) ** 2
+    repeat_times = min(max(math.ceil(repeat_times * margin), 1), CONVERGE_MAX_SAMPLES)
+    before_sense_ms = round(max(measurements["settle_ms_p95"] * margin, CALIBRATE_MIN_MS), 2)
+    repeat_interval_ms = round(max(measurements["report_interval_ms"] or 0, CALIBRATE_MIN_MS), 2)
+
+    step_ms = measurements["move_ms_p95"] + before_sense_ms + repeat_times * (repeat_interval_ms + measurements["read_ms"])
+    return dict(timing, frame_rate = round(1000 / (step_ms * CALIBRATE_FRAME_MARGIN), 1), before_sense_ms = before_sense_ms,
+                repeat_times = repeat_times, repeat_interval_ms = repeat_interval_ms)
+
+
+# Slow enough for any controller; the frame is shorter than the step so it does not add waits
+def reference_timing(timing, before_sense_ms):
+    repeat_interval_ms = max(timing["repeat_interval_ms"], DEFAULT_REPEAT_INTERVAL_MS)
+    return dict(timing, before_sense_ms = before_sense_ms, repeat_times = CALIBRATE_REFERENCE_REPEAT_TIMES, repeat_interval_ms = repeat_interval_ms,
+                frame_rate = 1000 / (before_sense_ms + CALIBRATE_REFERENCE_REPEAT_TIMES * repeat_interval_ms))
+
+
+def save_timing_profile(joystick, joystick_axis, ser, timing, measurements, diff, tolerance):
+    profile = {
+        "controller": joystick.get_name(),
+        "guid": joystick.get_guid() if hasattr(joystick, "get_guid") else None,
+        "joystick_axis": joystick_axis,
+        "protocol": "ack" if isinstance(ser, MotionLink) else "legacy",
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "tolerance": tolerance,
+        "reference_diff": diff,
+        "measurements": measurements,
+        "timing": {key: timing[key] for key in TIMING_OPTIONS},
+    }
 
-    if REVERSE_MODE:
-        measure_main_loop(joystick, joystick_axis, ser, reverse_stats, reverse_response_curve_data, stop_event, change_event, True, move_end_count)
+    filename = timing_profile_filename(joystick.get_name())
+    os.makedirs(TIMING_PROFILE_DIR, exist_ok=True)
+    with open(filename, 'w') as fd:
+        json.dump(profile, fd, indent=2)
+    return filename
+
+
+# Measuring the controller on the rig, then trying the timing derived from the measurements with growing margins
+# until a sweep reproduces the reference sweep within tolerance. Returns the profile file or None.
+def calibrate_timing(joystick, joystick_axis, ser, timing, tolerance = CALIBRATE_TOLERANCE, margins = CALIBRATE_MARGINS, progress = None):
+    with tempfile.TemporaryDirectory() as output_dir:
+        before_sense_ms = max(CALIBRATE_REFERENCE_BEFORE_SENSE_MS, timing["before_sense_ms"])
+        print(f'reference sweep, settle {before_sense_ms}ms, {CALIBRATE_REFERENCE_REPEAT_TIMES} reads.')
+        reference = calibration_sweep(joystick, joystick_axis, ser, reference_timing(timing, before_sense_ms), output_dir, progress = progress)
+        if reference is None:
+            return None
+
+        # Measuring half way out, the center can be in the deadzone
+        move_start_idx = find_movement(reference[joystick_axis])[0]
+        move_start_count = round(reference["motor_pos"][move_start_idx] / STEP_DISTANCE_MM)
+        half_idx = min(range(len(reference)), key=lambda idx: abs(abs(reference[joystick_axis][idx]) - 0.5))
+
+        measurements = measure_axis_timing(joystick, joystick_axis, ser, timing, round(reference["motor_pos"][half_idx] / STEP_DISTANCE_MM))
+        print(f'noise {measurements["noise"]:.5f}, report interval {measurements["report_interval_ms"] or 0:.2f}ms, settle p95 {measurements["settle_ms_p95"]:.2f}ms, '
+              f'max {measurements["settle_ms_max"]:.2f}ms, move p95 {measurements["move_ms_p95"]:.2f}ms, read {measurements["read_ms"]:.3f}ms.')
+
+        # A laggy controller was still moving in the first reference
+        if before_sense_ms < CALIBRATE_REFERENCE_SETTLE_FACTOR * measurements["settle_ms_max"]:
+            before_sense_ms = round(CALIBRATE_REFERENCE_SETTLE_FACTOR * measurements["settle_ms_max"], 2)
+            print(f'reference sweep again, settle {before_sense_ms}ms.')
+            reference = calibration_sweep(joystick, joystick_axis, ser, reference_timing(timing, before_sense_ms), output_dir, progress = progress)
+            if reference is None:
+                return None
+
+        start_count = max(move_start_count - BATCH_LEAD_IN_COUNTS, 0)
+        for margin in margins:
+            candidate = calibrated_timing(timing, measurements, margin)
+            print(f'margin {margin}: frame rate {candidate["frame_rate"]}, settle {candidate["before_sense_ms"]}ms, {candidate["repeat_times"]} reads every {candidate["repeat_interval_ms"]}ms.')
+            stats = calibration_sweep(joystick, joystick_axis, ser, candidate, output_dir, start_count, progress)
+            if stats is None:
+                return None
+
+            diff = compare_sweeps(stats, reference, joystick_axis)
+            print(f'margin {margin}: p95 difference to the reference {diff:.5f}.')
+            if diff <= tolerance:
+                filename = save_timing_profile(joystick, joystick_axis, ser, candidate, measurements, diff, tolerance)
+                print(f'timing profile saved to {filename}')
+                return filename
+
+    print(f"\033[31mno timing within the tolerance {tolerance}, the timing profile was not saved.\033[0m")
+    return None
+
+
+## Checkpoint
+# Progress of a stepped sweep: the loop state of measure_main_loop and the rows so far, written atomically
+# every CHECKPOINT_INTERVAL_STEPS steps and when the sweep is interrupted.
+class SweepCheckpoint:
+    def __init__(self, filename):
+        self.filename = filename
+        self.state = None
+        self.sweep = 0
+        self.forward_move_end_count = 0
+        self.removed = False     #the controller was removed, the caller waits for it to come back
+
+    def save(self, state, stats):
+        self.state = dict(state, sweep = self.sweep, forward_move_end_count = self.forward_move_end_count, rows = {key: list(stats[key]) for key in stats})
+
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as fd:
+            json.dump(self.state, fd)
+        os.replace(tmp_filename, self.filename)
+
+    def clear(self):
+        self.state = None
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    @classmethod
+    def load(cls, filename):
+        checkpoint = cls(filename)
+        with open(filename) as fd:
+            checkpoint.state = json.load(fd)
+        return checkpoint
+
+
+# Waiting for the removed controller (same GUID) to be attached again, None on quit or timeout
+def wait_for_reattach(guid, stop_event, timeout_s = REATTACH_TIMEOUT_S):
+    print(f"\n\033[31mcontroller removed, waiting {timeout_s:.0f}s for it to be attached again.\033[0m")
+    deadline = time.perf_counter() + timeout_s
+    while time.perf_counter() < deadline:
+        if pygame.event.get(pygame.QUIT) or stop_event.is_set():
+            stop_event.set()
+            return None
+
+        for i in range(pygame.joystick.get_count()):
+            joystick = pygame.joystick.Joystick(i)
+            if joystick.get_guid() == guid:
+                print(f"{joystick.get_name()} is back, resuming.")
+                return joystick
+
+        time.sleep(REATTACH_POLL_INTERVAL_S)
+    return None
+
+
+## Raw Capture
+# Header: RAW_CAPTURE_MAGIC, uint16 version, uint32 length of the json header (geometry, timing, controller)
+# Records: uint16 sweep, uint8 flags, then the STATS_COLUMNS of a row.
+# A record with RAW_CAPTURE_FLAG_DROP removes the last row of the sweep (adaptive backtracking).
+class RawCaptureWriter:
+    def __init__(self, filename, header):
+        self.filename = filename
+        self.rows = 0
+        self._fd = open(filename, 'wb')
+
+        header_json = json.dumps(header).encode()
+        self._fd.write(RAW_CAPTURE_MAGIC + RAW_CAPTURE_HEAD.pack(RAW_CAPTURE_VERSION, len(header_json)) + header_json)
+        self._fd.flush()
+
+    def write_row(self, sweep, flags, row):
+        self._fd.write(RAW_CAPTURE_RECORD.pack(sweep, flags, *[row[key] for key, typecode in STATS_COLUMNS]))
+        self._fd.flush()
+        self.rows += 1
+
+    def drop_rows(self, sweep, flags, count):
+        empty = [0] * len(STATS_COLUMNS)
+        for i in range(count):
+            self._fd.write(RAW_CAPTURE_RECORD.pack(sweep, flags | RAW_CAPTURE_FLAG_DROP, *empty))
+        self._fd.flush()
+
+    def restart(self, sweep):
+        pass
+
+    def close(self):
+        self._fd.close()
+
+
+# stick_height_mm is the one the sweeps are computed with, STICK_HEIGHT_MM when None
+def gen_capture_header(joystick, joystick_axis, timing, stick_height_mm = None):
+    if stick_height_mm is None:
+        stick_height_mm = STICK_HEIGHT_MM
+    return {
+        "created": datetime.datetime.now().isoformat(),
+        "controller": joystick.get_name(),
+        "joystick_axis": joystick_axis,
+        "stick_height_mm": stick_height_mm,
+        "stick_radius_mm": STICK_RADIUS_MM,
+        "step_distance_mm": STEP_DISTANCE_MM,
+        "num_step": DEFAULT_NUM_STEP,
+        "timing": timing,
+    }
+
+
+def open_raw_capture(joystick, joystick_axis, timing, output_dir = ".", stick_height_mm = None):
+    dt = datetime.datetime.now()
+    filename = os.path.join(output_dir, dt.strftime("%Y%m%d_%H%M%S_%f") + RAW_CAPTURE_EXTENSION)
+    return RawCaptureWriter(filename, gen_capture_header(joystick, joystick_axis, timing, stick_height_mm))
+
+
+# Returns the header and {sweep: (reverse, stats)}
+def read_raw_capture(filename):
+    with open(filename, 'rb') as fd:
+        if fd.read(len(RAW_CAPTURE_MAGIC)) != RAW_CAPTURE_MAGIC:
+            raise ValueError(f"{filename} is not a raw capture file")
+        version, header_length = RAW_CAPTURE_HEAD.unpack(fd.read(RAW_CAPTURE_HEAD.size))
+        if version != RAW_CAPTURE_VERSION:
+            raise ValueError(f"{filename} is version {version} but {RAW_CAPTURE_VERSION} is supported")
+        header = json.loads(fd.read(header_length))
+
+        sweeps = {}
+        while True:
+            record = fd.read(RAW_CAPTURE_RECORD.size)
+            if len(record) < RAW_CAPTURE_RECORD.size:
+                break   # the last record of an interrupted capture can be incomplete
+
+            sweep, flags, *values = RAW_CAPTURE_RECORD.unpack(record)
+            if sweep not in sweeps:
+                sweeps[sweep] = (bool(flags & RAW_CAPTURE_FLAG_REVERSE), gen_stats())
+            stats = sweeps[sweep][1]
+
+            if flags & RAW_CAPTURE_FLAG_DROP:
+                stats.truncate(len(stats) - 1)
+            else:
+                stats.append_row(dict(zip([key for key, typecode in STATS_COLUMNS], values)))
+
+    return header, sweeps
+
+
+def stick_height_from_profile(profile):
+    if profile in STICK_PROFILES:
+        return STICK_PROFILES[profile]
+    try:
+        return float(profile)
+    except ValueError:
+        raise ValueError(f"stick must be one of {', '.join(STICK_PROFILES)} or a height in mm but {profile}") from None
+
+
+# Recomputing the response curves of a raw capture, for another stick geometry if given
+def reanalyze_capture(filename, stick_height_mm = None, output_dir = None):
+    header, sweeps = read_raw_capture(filename)
+    if stick_height_mm is None:
+        stick_height_mm = header["stick_height_mm"]
+    if output_dir is None:
+        output_dir = os.path.dirname(filename)
+
+    joystick_axis = header["joystick_axis"]
+    name = os.path.splitext(os.path.basename(filename))[0]
+    print(f'{filename}: {header["controller"]}, {joystick_axis}, {len(sweeps)} sweeps, stick height {stick_height_mm}mm (captured with {header["stick_height_mm"]}mm).')
+
+    results = []
+    for sweep, (reverse, stats) in sorted(sweeps.items()):
+        movement = find_movement(stats[joystick_axis])
+        if movement is None:
+            print(f"\033[31msweep {sweep}: stick movement was not found.\033[0m")
+            continue
+
+        move_start_idx, move_end_idx, direction, min_value, max_value = movement
+        response_curve_data = gen_response_curve_data()
+        results.append(finish_sweep(stats, joystick_axis, move_start_idx, move_end_idx, direction, min_value, max_value, response_curve_data, reverse, output_dir,
+                                    stick_height_mm, f"{name}_{sweep}_{stick_height_mm}mm.csv"))
+
+    return results
+
+
+## Batch Analysis
+# Metrics of the result CSVs under a directory, computed in a process pool. The metrics are cached by the
+# sha256 of the file contents, so only new or changed files are read again.
+def file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Columns of a result CSV, None for other CSVs (step timing and so on)
+def read_result_csv(filename):
+    with open(filename, newline='') as fd:
+        reader = csv.reader(fd)
+        header = next(reader, None)
+        if header != gen_response_curve_data()[0]:
+            return None
+        rows = [[float(val) for val in row] for row in reader if row]
+    return {key: [row[i] for row in rows] for i, key in enumerate(header)}
+
+
+def calc_deadzone(columns):
+    dead = [i for i, val in enumerate(columns["values"]) if abs(val) <= ANALYZE_DEADZONE_VALUE]
+    if not dead:
+        return 0.0, 0.0
+    distances = [columns["compensated_distances"][i] for i in dead]
+    #the degrees are saved unsigned, the side is the one of the distance
+    degrees = [math.copysign(columns["degrees"][i], columns["compensated_distances"][i]) for i in dead]
+    return max(distances) - min(distances), max(degrees) - min(degrees)
+
+
+# Mean and max of the difference to linear where the stick is neither in the deadzone nor pinned, in %.
+# Taken from the magnitudes, the degrees are not signed so diff_degrees is about -2 on one half.
+def calc_linearity(columns, key, linear_max):
+    low, high = ANALYZE_LINEARITY_RANGE
+    diffs = [abs(abs(val) / (abs(x) / linear_max) - 1) for x, val in zip(columns[key], columns["values"]) if low <= abs(val) <= high and x != 0]
+    if not diffs:
+        return None, None
+    return sum(diffs) / len(diffs) * 100, max(diffs) * 100
+
+
+# Value difference at the same stick distance, the other sweep is interpolated where both moved
+def calc_hysteresis(columns, other):
+    points = sorted(zip(other["compensated_distances"], other["values"]))
+    other_distances = [distance for distance, val in points]
+    other_values = [val for distance, val in points]
+
+    diffs = []
+    for distance, val in zip(columns["compensated_distances"], columns["values"]):
+        if other_distances[0] <= distance <= other_distances[-1] and abs(val) < 1:
+            diffs.append(abs(val - interpolate_samples(other_distances, other_values, distance)))
+    if not diffs:
+        return None, None
+    return sum(diffs) / len(diffs), max(diffs)
+
+
+def analyze_result_file(filename):
+    columns = read_result_csv(filename)
+    if columns is None or not columns["values"]:
+        return None
+
+    values = columns["values"]
+    deadzone_mm, deadzone_deg = calc_deadzone(columns)
+    linearity_deg_mean, linearity_deg_max = calc_linearity(columns, "degrees", LINEAR_CURVE_MAX_DEGREE)
+    linearity_dist_mean, linearity_dist_max = calc_linearity(columns, "compensated_distances", LINEAR_CURVE_CENTER_MAX_DISTANCE)
+    return {
+        "rows": len(values),
+        "trend": 1 if values[0] < values[-1] else -1,
+        "deadzone_mm": deadzone_mm,
+        "deadzone_deg": deadzone_deg,
+        "linearity_deg_mean_pct": linearity_deg_mean,
+        "linearity_deg_max_pct": linearity_deg_max,
+        "linearity_dist_mean_pct": linearity_dist_mean,
+        "linearity_dist_max_pct": linearity_dist_max,
+    }
+
+
+def analyze_result_pair(filenames):
+    forward, reverse = (read_result_csv(filename) for filename in filenames)
+    hysteresis_mean, hysteresis_max = calc_hysteresis(forward, reverse)
+    return {"hysteresis_mean": hysteresis_mean, "hysteresis_max": hysteresis_max}
+
+
+# Result CSVs of a sweep pair are next to each other and move the stick the opposite ways
+def pair_result_files(filenames, metrics):
+    pairs = []
+    by_dir = {}
+    for filename in filenames:
+        if metrics.get(filename):
+            by_dir.setdefault(os.path.dirname(filename), []).append(filename)
+
+    for dir_filenames in by_dir.values():
+        dir_filenames.sort()
+        i = 0
+        while i + 1 < len(dir_filenames):
+            forward, reverse = dir_filenames[i], dir_filenames[i + 1]
+            if metrics[forward]["trend"] != metrics[reverse]["trend"]:
+                pairs.append((forward, reverse))
+                i += 2
+            else:
+                i += 1
+    return pairs
+
+
+def analyze_results(root, jobs = None, output = None):
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm import tqdm
+
+    cache_filename = os.path.join(root, ANALYZE_CACHE_FILENAME)
+    cache = {"version": ANALYZE_CACHE_VERSION, "files": {}, "pairs": {}}
+    if os.path.exists(cache_filename):
+        with open(cache_filename) as fd:
+            cached = json.load(fd)
+        if cached.get("version") == ANALYZE_CACHE_VERSION:
+            cache = cached
+
+    filenames = sorted(glob.glob(os.path.join(root, "**", "*.csv"), recursive=True))
+    filenames = [filename for filename in filenames if os.path.basename(filename) != ANALYZE_SUMMARY_FILENAME]
+    hashes = {filename: file_sha256(filename) for filename in filenames}
+
+    with ProcessPoolExecutor(max_workers = jobs, mp_context = multiprocessing.get_context("spawn")) as executor:
+        todo = sorted({hashes[filename]: filename for filename in filenames if hashes[filename] not in cache["files"]}.items())
+        results = executor.map(analyze_result_file, [filename for sha, filename in todo], chunksize = ANALYZE_CHUNK_SIZE)
+        for (sha, filename), result in tqdm(zip(todo, results), total=len(todo), ncols=76, desc="files"):
+            cache["files"][sha] = result
+        analyzed = len(todo)
+        metrics = {filename: cache["files"][hashes[filename]] for filename in filenames}
+
+        pairs = pair_result_files(filenames, metrics)
+        pair_keys = {pair: hashes[pair[0]] + ":" + hashes[pair[1]] for pair in pairs}
+        todo = [pair for pair in pairs if pair_keys[pair] not in cache["pairs"]]
+        results = executor.map(analyze_result_pair, todo, chunksize = ANALYZE_CHUNK_SIZE)
+        for pair, result in tqdm(zip(todo, results), total=len(todo), ncols=76, desc="pairs"):
+            cache["pairs"][pair_keys[pair]] = result
+    print(f"{len(filenames)} CSVs and {len(pairs)} sweep pairs, {analyzed} CSVs and {len(todo)} pairs were not in the cache.")
+
+    tmp_filename = cache_filename + ".tmp"
+    with open(tmp_filename, 'w') as fd:
+        json.dump(cache, fd)
+    os.replace(tmp_filename, cache_filename)
+
+    # Summary of the result CSVs, the hysteresis goes to both sweeps of a pair
+    rows = []
+    partners = {}
+    for pair in pairs:
+        partners[pair[0]] = partners[pair[1]] = pair
+    for filename in filenames:
+        if metrics[filename] is None:
+            continue
+        row = {"file": os.path.relpath(filename, root)}
+        row.update(metrics[filename])
+        row.update(cache["pairs"][pair_keys[partners[filename]]] if filename in partners else {"hysteresis_mean": None, "hysteresis_max": None})
+        rows.append(row)
+
+    if output is None:
+        output = os.path.join(root, ANALYZE_SUMMARY_FILENAME)
+    with open(output, 'w', newline='') as fd:
+        writer = csv.DictWriter(fd, fieldnames=ANALYZE_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    print_analysis_table(rows)
+    print(f"Saved the summary to {output}")
+    return rows
+
+
+def print_analysis_table(rows, columns = ANALYZE_COLUMNS):
+    def fmt(val):
+        if val is None:
+            return "-"
+        if isinstance(val, float):
+            return f"{val:.3f}"
+        return str(val)
+
+    table = [columns] + [[fmt(row[key]) for key in columns] for row in rows]
+    widths = [max(len(line[i]) for line in table) for i in range(len(columns))]
+    for line in table:
+        print("  ".join(cell.rjust(width) for cell, width in zip(line, widths)))
+
+
+## Off-screen Rendering
+# The result CSVs drawn by GraphRenderer onto a surface (PNG) or an SvgCanvas (SVG) without a window.
+# curves are (label, result CSV), a legend goes below the graphs.
+def render_result_image(curves, filename):
+    header = gen_response_curve_data()[0]
+    graphs = []
+    for label, csv_filename in curves:
+        columns = read_result_csv(csv_filename)
+        if columns is None or len(columns["values"]) < 2:
+            continue
+        rc_data = [header] + [list(row) for row in zip(*[columns[key] for key in header])]
+        graphs.append((label, None, rc_data, RENDER_COLORS[len(graphs) % len(RENDER_COLORS)]))
+    if not graphs:
+        return None
+
+    size = (WINDOW_SIZE[0], max(WINDOW_SIZE[1], RENDER_LEGEND_TOP + (len(graphs) + 1) * RENDER_LEGEND_LINE_HEIGHT))
+    canvas = SvgCanvas(size) if filename.endswith(".svg") else pygame.Surface(size)
+    GraphRenderer(canvas, "rx").render(graphs)
+
+    if not isinstance(canvas, SvgCanvas) and not pygame.font.get_init():
+        pygame.font.init()
+    for idx, (label, st, rc_data, line_color) in enumerate(graphs):
+        pos = (GRAPH_BOX_TOP_LEFT[0], RENDER_LEGEND_TOP + idx * RENDER_LEGEND_LINE_HEIGHT)
+        if isinstance(canvas, SvgCanvas):
+            canvas.text(label, line_color, pos, RENDER_LEGEND_LINE_HEIGHT - 4)
+        else:
+            canvas.blit(pygame.font.Font(None, RENDER_LEGEND_LINE_HEIGHT + 2).render(label, True, line_color), pos)
+
+    if isinstance(canvas, SvgCanvas):
+        canvas.save(filename)
+    else:
+        pygame.image.save(canvas, filename)
+    return filename
+
+
+def render_job(job):
+    filename, curves = job
+    return render_result_image(curves, filename)
+
+
+# Trend of a result CSV (1 when the values rise) from its first and last rows, None for other CSVs
+def result_csv_trend(filename):
+    with open(filename, newline='') as fd:
+        reader = csv.reader(fd)
+        if next(reader, None) != gen_response_curve_data()[0]:
+            return None
+        first = last = next(reader, None)
+        for row in reader:
+            if row:
+                last = row
+    if first is None:
+        return None
+    values_idx = gen_response_curve_data()[0].index("values")
+    return 1 if float(first[values_idx]) < float(last[values_idx]) else -1
+
+
+def find_result_csvs(paths):
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            filenames += sorted(glob.glob(os.path.join(path, "**", "*.csv"), recursive=True))
+        else:
+            filenames.append(path)
+    return [filename for filename in filenames if result_csv_trend(filename) is not None]
+
+
+def image_is_up_to_date(filename, sources):
+    return os.path.exists(filename) and max(os.path.getmtime(source) for source in sources) <= os.path.getmtime(filename)
+
+
+# A sweep pair is drawn as a forward/reverse overlay, a CSV without its pair by itself. With compare all of the
+# CSVs go in one chart. The images newer than their CSVs are skipped unless force.
+def render_results(paths, fmt = RENDER_FORMATS[0], output = None, compare = False, force = False, jobs = None):
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm import tqdm
+
+    filenames = find_result_csvs(paths)
+    if not filenames:
+        print(f"\033[31mno result CSVs in {', '.join(paths)}.\033[0m")
+        return []
+
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(filename)) for filename in filenames])
+    def label_of(filename):
+        return os.path.relpath(os.path.abspath(filename), root)
+
+    if compare:
+        image = output or f"{RENDER_COMPARISON_NAME}.{fmt}"
+        todo = [(image, [(label_of(filename), filename) for filename in filenames])]
+    else:
+        trends = {filename: {"trend": result_csv_trend(filename)} for filename in filenames}
+        pairs = pair_result_files(filenames, trends)
+        paired = {filename for pair in pairs for filename in pair}
+
+        todo = []
+        for group in pairs + [(filename,) for filename in filenames if filename not in paired]:
+            base = os.path.splitext(group[0])[0] + (RENDER_PAIR_SUFFIX if 1 < len(group) else "")
+            if output:
+                os.makedirs(output, exist_ok=True)
+                base = os.path.join(output, os.path.basename(base))
+            prefixes = ["forward: ", "reverse: "] if 1 < len(group) else [""]
+            todo.append((f"{base}.{fmt}", [(prefix + label_of(filename), filename) for prefix, filename in zip(prefixes, group)]))
+
+    skipped = 0
+    if not force:
+        skipped = len(todo)
+        todo = [job for job in todo if not image_is_up_to_date(job[0], [filename for label, filename in job[1]])]
+        skipped -= len(todo)
+
+    images = []
+    with ProcessPoolExecutor(max_workers = jobs, mp_context = multiprocessing.get_context("spawn")) as executor:
+        for image in tqdm(executor.map(render_job, todo, chunksize = RENDER_CHUNK_SIZE), total=len(todo), ncols=76, desc="images"):
+            if image:
+                images.append(image)
+    print(f"{len(images)} images drawn, {skipped} were up to date.")
+    return images
+
+
+## Curve Library
+# Response curves resampled onto fixed stick distance and degree grids, as float32 blobs in SQLite next to
+# the controller, axis, stick height and time they were measured with. The curves are found by the indexed
+# metadata or by how close they are to another curve.
+def curve_grid(limit, step):
+    count = round(limit / step)
+    return [i * step for i in range(-count, count + 1)]
+
+
+# Values at the grid points, NaN outside the measured range. The curves are turned so the values rise
+# with x, then both sweeps of a pair land on the same side.
+def resample_curve(xs, values, grid):
+    points = sorted(zip(xs, values))
+    if points[-1][1] < points[0][1]:
+        points = sorted((-x, val) for x, val in points)
+    xs = [x for x, val in points]
+    values = [val for x, val in points]
+    return array('f', [interpolate_samples(xs, values, x) if xs[0] <= x <= xs[-1] else float("nan") for x in grid])
+
+
+def open_curve_library(filename = CURVE_LIBRARY_FILENAME):
+    db = sqlite3.connect(filename)
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version == 0:
+        db.executescript(CURVE_LIBRARY_SCHEMA)
+        db.execute(f"PRAGMA user_version = {CURVE_LIBRARY_VERSION}")
+    elif version != CURVE_LIBRARY_VERSION:
+        db.close()
+        raise ValueError(f"{filename} is version {version} but {CURVE_LIBRARY_VERSION} is supported")
+    return db
+
+
+# Measuring time from the name the result CSVs are saved with, else the time of the file
+def result_csv_created(filename):
+    match = re.match(r"(\d{8}_\d{6})", os.path.basename(filename))
+    if match:
+        return datetime.datetime.strptime(match.group(1), "%Y%m%d_%H%M%S").isoformat()
+    return datetime.datetime.fromtimestamp(os.path.getmtime(filename)).isoformat(timespec="seconds")
+
+
+# Returns the id of the new curve, None when the CSV is not a result or was already in the library
+def add_curve(db, filename, controller, joystick_axis, stick_height_mm, created = None):
+    columns = read_result_csv(filename)
+    if columns is None or len(columns["values"]) < 2:
+        return None
+
+    values = columns["values"]
+    distances = resample_curve(columns["compensated_distances"], values, curve_grid(CURVE_GRID_DISTANCE_MM, CURVE_GRID_DISTANCE_STEP_MM))
+    #the degrees are saved unsigned, the side is the one of the distance
+    signed_degrees = [math.copysign(degree, distance) for degree, distance in zip(columns["degrees"], columns["compensated_distances"])]
+    degrees = resample_curve(signed_degrees, values, curve_grid(CURVE_GRID_DEGREES, CURVE_GRID_DEGREE_STEP))
+    cursor = db.execute("INSERT OR IGNORE INTO curves (sha256, source, controller, joystick_axis, stick_height_mm, created, trend, distances, degrees) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (file_sha256(filename), os.path.abspath(filename), controller, joystick_axis, stick_height_mm, created or result_csv_created(filename),
+                         1 if values[0] < values[-1] else -1, distances.tobytes(), degrees.tobytes()))
+    db.commit()
+    return cursor.lastrowid if cursor.rowcount else None
+
+
+def curve_filter(controller = None, joystick_axis = None, since = None, until = None):
+    where = []
+    params = []
+    if controller:
+        where.append("controller LIKE ?")
+        params.append(controller if "%" in controller else f"%{controller}%")
+    if joystick_axis:
+        where.append("joystick_axis = ?")
+        params.append(joystick_axis)
+    if since:
+        where.append("? <= created")
+        params.append(since)
+    if until:
+        where.append("created < ?")
+        params.append(until)
+    return (" WHERE " + " AND ".join(where) if where else ""), params
+
+
+def query_curves(db, controller = None, joystick_axis = None, since = None, until = None):
+    where, params = curve_filter(controller, joystick_axis, since, until)
+    rows = db.execute(f"SELECT {', '.join(CURVE_QUERY_COLUMNS)} FROM curves{where} ORDER BY created", params)
+    return [dict(zip(CURVE_QUERY_COLUMNS, row)) for row in rows]
+
+
+# Library curves nearest to a result CSV: RMS of the value differences on the distance grid where both were
+# measured. The CSV itself is left out when it is in the library.
+def match_curve(db, filename, controller = None, joystick_axis = None, count = CURVE_MATCH_RESULTS):
+    columns = read_result_csv(filename)
+    if columns is None or len(columns["values"]) < 2:
+        raise ValueError(f"{filename} is not a result CSV")
+    query = resample_curve(columns["compensated_distances"], columns["values"], curve_grid(CURVE_GRID_DISTANCE_MM, CURVE_GRID_DISTANCE_STEP_MM))
+
+    where, params = curve_filter(controller, joystick_axis)
+    where += (" AND " if where else " WHERE ") + "sha256 != ?"
+    params.append(file_sha256(filename))
+    rows = db.execute(f"SELECT {', '.join(CURVE_QUERY_COLUMNS)}, distances FROM curves{where}", params).fetchall()
+    if not rows:
+        return []
+
+    measured = sum(1 for val in query if not math.isnan(val))
+    if np is not None:
+        query_values = np.frombuffer(query.tobytes(), dtype=np.float32)
+        library = np.frombuffer(b"".join(row[-1] for row in rows), dtype=np.float32).reshape(len(rows), len(query_values))
+        both = ~np.isnan(library) & ~np.isnan(query_values)
+        overlap = both.sum(axis=1)
+        squares = np.where(both, library - query_values, 0.0) ** 2
+        rms = np.sqrt(squares.sum(axis=1) / np.maximum(overlap, 1))
+        rms[overlap < CURVE_MATCH_MIN_OVERLAP * measured] = np.inf
+        rms = rms.tolist()
+    else:
+        rms = []
+        for row in rows:
+            other = array('f')
+            other.frombytes(row[-1])
+            diffs = [(a - b) ** 2 for a, b in zip(other, query) if not (math.isnan(a) or math.isnan(b))]
+            rms.append(math.sqrt(sum(diffs) / len(diffs)) if diffs and CURVE_MATCH_MIN_OVERLAP * measured <= len(diffs) else float("inf"))
+
+    nearest = sorted((val, idx) for idx, val in enumerate(rms) if not math.isinf(val))[:count]
+    return [dict(zip(CURVE_QUERY_COLUMNS, rows[idx][:-1]), rms=val) for val, idx in nearest]
+
+
+def run_library_command(args):
+    db = open_curve_library(args.db)
+    try:
+        if args.action == "add":
+            stick_height_mm = stick_height_from_profile(args.stick.lower()) if args.stick else STICK_HEIGHT_MM
+            controller = args.controller or "unknown"
+            filenames = find_result_csvs(args.files)
+            added = [add_curve(db, filename, controller, args.joystick_axis or args.axis, stick_height_mm) for filename in filenames]
+            print(f"{sum(1 for curve_id in added if curve_id)} curves added to {args.db}, {sum(1 for curve_id in added if not curve_id)} were already there.")
+
+        elif args.action == "query":
+            since = args.since
+            if args.days is not None:
+                since = (datetime.datetime.now() - datetime.timedelta(days=args.days)).isoformat()
+            rows = query_curves(db, args.controller, args.joystick_axis, since, args.until)
+            print_analysis_table(rows, CURVE_QUERY_COLUMNS)
+            print(f"{len(rows)} curves.")
+
+        elif args.action == "match":
+            for filename in args.files:
+                rows = match_curve(db, filename, args.controller, args.joystick_axis, args.count)
+                print(f"\n -- {filename} -- ")
+                print_analysis_table(rows, ["rms"] + CURVE_QUERY_COLUMNS)
+                if rows:
+                    print(f"most like {rows[0]['controller']} ({rows[0]['joystick_axis']}), rms {rows[0]['rms']:.4f}")
+    finally:
+        db.close()
+
+
+## Sample Store
+# Typed columns preallocated with capacity doubling. A row is written first and then
+# published together with the columns, so readers never see a half written row.
+# stats[key] is a zero-copy memoryview of the published part of a column.
+# Rows are also passed to the listeners (RawCaptureWriter, SampleRing).
+class SampleStore:
+    def __init__(self, capacity = STATS_INITIAL_CAPACITY, listeners = (), sweep = 0, reverse = False):
+        self.typecodes = dict(STATS_COLUMNS)
+        self.listeners = [listener for listener in listeners if listener]
+        self.sweep = sweep
+        self.capture_flags = RAW_CAPTURE_FLAG_REVERSE if reverse else 0
+        self.truncations = 0    # lets readers notice rows being replaced
+        self.result_filename = None     # the CSVs written by the sweep
+        self.timing_filename = None
+        self._capacity = capacity
+        self._published = ({key: array(typecode, [0]) * capacity for key, typecode in STATS_COLUMNS}, 0)
+
+    def __len__(self):
+        return self._published[1]
+
+    def __iter__(self):
+        return iter(self.typecodes)
+
+    def keys(self):
+        return self.typecodes.keys()
+
+    def __getitem__(self, key):
+        columns, length = self._published
+        return memoryview(columns[key])[:length]
+
+    # Consistent views of all columns for readers in other threads
+    def snapshot(self):
+        columns, length = self._published
+        return {key: memoryview(column)[:length] for key, column in columns.items()}
+
+    def _grow(self):
+        columns, length = self._published
+        self._capacity *= 2
+
+        # New arrays, the views handed out keep the old ones alive
+        grown = {}
+        for key, column in columns.items():
+            grown[key] = array(column.typecode, [0]) * self._capacity
+            grown[key][:length] = column[:length]
+        self._published = (grown, length)
+
+    def append_row(self, row):
+        if self._capacity <= len(self):
+            self._grow()
+
+        columns, length = self._published
+        for key, column in columns.items():
+            column[length] = row[key]
+        self._published = (columns, length + 1)
+
+        for listener in self.listeners:
+            listener.write_row(self.sweep, self.capture_flags, row)
+
+    def truncate(self, length):
+        columns, current_length = self._published
+        self._published = (columns, min(length, current_length))
+        if length < current_length:
+            self.truncations += 1
+
+        if length < current_length:
+            for listener in self.listeners:
+                listener.drop_rows(self.sweep, self.capture_flags, current_length - length)
+
+    # Empty again for the next sweep of a batch, the capture keeps the rows under the old sweep index
+    def restart(self, sweep):
+        columns, length = self._published
+        self._published = (columns, 0)
+        self.truncations += 1
+        self.sweep = sweep
+        self.result_filename = None
+        self.timing_filename = None
+
+        for listener in self.listeners:
+            listener.restart(sweep)
+
+
+def gen_stats(listeners = (), sweep = 0, reverse = False):
+    return SampleStore(listeners = listeners, sweep = sweep, reverse = reverse)
+
+
+# The ms values can be fractional, the waits are done by sleep_until_ns
+def gen_timing(sampling = DEFAULT_SAMPLING, confidence = CONVERGE_CONFIDENCE, frame_rate = MEASURE_FRAME_RATE, before_sense_ms = DEFAULT_BEFORE_SENSE_MS, repeat_interval_ms = DEFAULT_REPEAT_INTERVAL_MS,
+               stick_movement_ms = TIME_STICK_MOVEMENT_MS):
+    return {
+        "frame_rate": frame_rate,
+        "stick_movement_ms": stick_movement_ms,
+        "before_sense_ms": before_sense_ms,
+        "repeat_times": DEFAULT_REPEAT_TIMES,
+        "repeat_interval_ms": repeat_interval_ms,
+        "sampling": sampling,
+        "confidence": confidence,
+        "min_samples": CONVERGE_MIN_SAMPLES,
+        "max_samples": CONVERGE_MAX_SAMPLES,
+        "settle_threshold": CONVERGE_SETTLE_THRESHOLD,
+    }
+
+
+# Timing of a sweep: the defaults, the timing profile of the controller over them and the options given
+# on the command line (not None in options) over both
+def load_sweep_timing(joystick, options, use_profile = True):
+    timing = gen_timing(options["sampling"], options["confidence"])
+    if use_profile and not options["no_profile"]:
+        filename = timing_profile_filename(joystick.get_name())
+        if os.path.exists(filename):
+            with open(filename) as fd:
+                profile = json.load(fd)
+            timing.update(profile["timing"])
+            print(f'timing profile {filename}: {", ".join(f"{key} {val}" for key, val in profile["timing"].items())}')
+
+    for key in TIMING_OPTIONS:
+        if options[key] is not None:
+            timing[key] = options[key]
+    return timing
+
+
+def gen_response_curve_data():
+    response_curve_data = [['degrees', 'distances', 'values', 'diff_degrees', 'compensated_distances', 'diff_compensated_distances']]
+    return response_curve_data
+
+
+# Forward sweep from start_count and the reverse one from where the movement ended, the motor is back at 0 after
+# unless home is False. sweep_done(sweep index, response curve data) is called after each sweep.
+# With a checkpoint, a removed controller is waited for and the stepped sweep resumes where it was with the
+# serial kept open. An interrupted pair homes the motor, opening the serial again resets the firmware position
+# to 0 and the resumed sweep travels back from there. resume is a SweepCheckpoint state.
+def measure_sweep_pair(joystick, joystick_axis, ser, stop_event, change_event, forward, reverse, output_dir = ".", adaptive = False, timing = None, continuous = False,
+                       stick_height_mm = None, progress = None, sweep_done = None, checkpoint = None, resume = None, start_count = 0, home = True):
+    # The continuous sweep reads as fast as it can by itself
+    sampler = None
+    if timing and timing["sampling"] == "stream" and not continuous:
+        sampler = joystick = JoystickSampler(joystick)
+        sampler.start()
+
+    base_joystick = sampler.joystick if sampler else joystick
+    guid = base_joystick.get_guid() if hasattr(base_joystick, "get_guid") else None
+
+    move_end_count = 0
+    first_sweep = 0
+    if resume:
+        first_sweep = resume["sweep"]
+        move_end_count = resume["forward_move_end_count"]
+
+    try:
+        for sweep, (stats, response_curve_data) in enumerate((forward, reverse)):
+            if sweep < first_sweep:
+                continue
+            if sweep == 1 and not (REVERSE_MODE and move_end_count):
+                break
+
+            sweep_resume = resume if sweep == first_sweep else None
+            from_count = move_end_count if sweep == 1 else start_count
+            while True:
+                if continuous:
+                    end_count = measure_continuous_loop(joystick, joystick_axis, ser, stats, response_curve_data, stop_event, change_event, sweep == 1, from_count, output_dir = output_dir, timing = timing,
+                                                        stick_height_mm = stick_height_mm, progress = progress)
+                else:
+                    if checkpoint:
+                        checkpoint.sweep = sweep
+                        checkpoint.forward_move_end_count = move_end_count
+                        checkpoint.removed = False
+                    end_count = measure_main_loop(joystick, joystick_axis, ser, stats, response_curve_data, stop_event, change_event, sweep == 1, from_count, output_dir = output_dir, adaptive = adaptive, timing = timing,
+                                                  stick_height_mm = stick_height_mm, progress = progress, checkpoint = checkpoint, resume = sweep_resume)
+
+                if not (checkpoint and checkpoint.removed):
+                    break
+
+                # Hot reattach
+                new_joystick = wait_for_reattach(guid, stop_event) if guid else None
+                if new_joystick is None:
+                    if not stop_event.is_set():
+                        change_event.set()
+                    move_motor(ser, 0, timing, 0, travel = True)
+                    return None
+                if sampler:
+                    sampler.stop()
+                    sampler = joystick = JoystickSampler(new_joystick)
+                    sampler.start()
+                else:
+                    joystick = new_joystick
+                sweep_resume = checkpoint.state
+
+            if stop_event.is_set() or change_event.is_set():
+                if checkpoint and checkpoint.state:
+                    move_motor(ser, 0, timing, 0, travel = True)
+                    return None
+                break
+
+            if sweep == 0:
+                move_end_count = end_count
+
+            if sweep_done:
+                sweep_done(sweep, response_curve_data)
+    finally:
+        if sampler:
+            sampler.stop()
+
+    if checkpoint:
+        checkpoint.clear()
 
     # Resetting Motor Position
-    ser.write("0\n".encode())
+    if home:
+        move_motor(ser, 0, timing, 0, travel = True)
+
+    return move_end_count
+
+
+# With sweeps > 1 the sweep pairs run back to back without homing or asking and the curves are aggregated.
+# With an EnduranceRun the pairs go on by its schedule and the raw capture rolls over segments.
+# With a RunLog (headless) nothing is drawn or asked and the progress goes to the log.
+def start_main_loop(screen, joystick, joystick_axis, ser, stop_event, change_event, output_dir = ".", adaptive = False, timing = None, continuous = False, capture = True, renderer = DEFAULT_RENDERER,
+                    resume = None, sweeps = 1, log = None, endurance = None, library = None):
+    # Preparing Variables
+    checkpoint = None
+    if not continuous:
+        checkpoint = SweepCheckpoint(os.path.join(output_dir, CHECKPOINT_FILENAME))
+    if capture:
+        capture = endurance.open_capture(joystick, joystick_axis, timing) if endurance else open_raw_capture(joystick, joystick_axis, timing, output_dir)
+    rings = [SampleRing(joystick_axis), SampleRing(joystick_axis)] if renderer == "process" else [None, None]
+    stats = gen_stats((capture, rings[0]), 0)
+    response_curve_data = gen_response_curve_data()
+    reverse_stats = gen_stats((capture, rings[1]), 1, True)
+    reverse_response_curve_data = gen_response_curve_data()
+
+    # Starting Visualization Thread or Process
+    visualization_thread = None
+    if renderer == "process":
+        visualization_thread = multiprocessing.get_context("spawn").Process(target=visualization_process_main, args=([ring.name for ring in rings], joystick_axis, stop_event, change_event), daemon=True)
+    elif renderer == "thread":
+        visualization_thread = Thread(target=visualization_main_loop, args=(screen, stats, response_curve_data, joystick_axis, stop_event, change_event, reverse_stats, reverse_response_curve_data))
+    if visualization_thread:
+        visualization_thread.start()
 
+    progress = None
+    if log:
+        progress = {"disable": True}
+        log.write("run_start", controller=joystick.get_name(), joystick_axis=joystick_axis, sweeps=sweeps, adaptive=adaptive, continuous=continuous, timing=timing,
+                  capture=capture.filename if capture else None)
 
-    input("Press Enter to finish.")
+
+    # Starting Measurement
+    aggregates = (SweepAggregate(), SweepAggregate())
+    def sweep_done(sweep, sweep_response_curve_data):
+        sweep_stats = (stats, reverse_stats)[sweep]
+        if rings[sweep]:
+            rings[sweep].publish_response_curve(sweep_response_curve_data)
+        if library and sweep_stats.result_filename:
+            add_curve(library, sweep_stats.result_filename, joystick.get_name(), joystick_axis, STICK_HEIGHT_MM)
+        if endurance:
+            endurance.sweep_done(pair, sweep, sweep_stats, joystick_axis)
+        elif 1 < sweeps:
+            aggregates[sweep].add(sweep_stats["motor_pos"], sweep_stats[joystick_axis])
+        if log:
+            log.write("sweep_done", pair=pair, sweep=sweep, rows=len(sweep_stats), curve_rows=len(sweep_response_curve_data) - 1,
+                      result=sweep_stats.result_filename, timing=sweep_stats.timing_filename)
+
+    start_count = 0
+    pair = 0
+    while pair < sweeps or (endurance and endurance.wait_next(stop_event)):
+        if pair:
+            if endurance:
+                elapsed_s = endurance.elapsed_s()
+                print(f"\nendurance sweep pair {pair + 1} from count {start_count}, {datetime.timedelta(seconds=round(elapsed_s))} elapsed, "
+                      f"{datetime.timedelta(seconds=round(max(endurance.duration_s - elapsed_s, 0)))} remaining.")
+            else:
+                print(f"\nsweep pair {pair + 1}/{sweeps} from count {start_count}.")
+            stats.restart(2 * pair)
+            reverse_stats.restart(2 * pair + 1)
+            del response_curve_data[1:]
+            del reverse_response_curve_data[1:]
+
+        measure_sweep_pair(joystick, joystick_axis, ser, stop_event, change_event, (stats, response_curve_data), (reverse_stats, reverse_response_curve_data),
+                           output_dir, adaptive, timing, continuous, progress = progress, sweep_done = sweep_done, checkpoint = checkpoint, resume = resume if pair == 0 else None,
+                           start_count = start_count, home = endurance is not None or pair == sweeps - 1)
+        if stop_event.is_set() or change_event.is_set():
+            break
+
+        # The next forward sweep starts a little before where the reverse one ended, the stick is pinned there too
+        if len(reverse_stats):
+            start_count = max(0, round(reverse_stats["motor_pos"][-1] / STEP_DISTANCE_MM) - BATCH_LEAD_IN_COUNTS)
+        pair += 1
+
+    if capture:
+        capture.close()
+        print(f"Saved raw capture to {capture.filename}")
+
+    if endurance:
+        print(f"{endurance.sweeps} endurance sweeps, the time series is in {endurance.filename}")
+    elif 1 < sweeps and aggregates[0].sweeps:
+        filenames = save_batch_result(aggregates, joystick_axis, output_dir)
+        if log:
+            log.write("batch_result", pairs=aggregates[0].sweeps, files=filenames)
+
+    if log:
+        status = "stopped" if stop_event.is_set() else "controller_lost" if change_event.is_set() else "done"
+        log.write("run_end", status=status, link=dict(ser.counters) if isinstance(ser, MotionLink) else None)
+    elif sweeps == 1 and not endurance:
+        input("Press Enter to finish.")
 
     if visualization_thread:
         stop_event.set()
         visualization_thread.join()
         stop_event.clear()
 
+    for ring in rings:
+        if ring:
+            ring.close()
+
 
 def main():
-    os.system('cls' if os.name == 'nt' else 'clear')
+    # Parsing Args
+    args = parse_args()
+
+    if not args.headless:
+        os.system('cls' if os.name == 'nt' else 'clear')
     os.environ["SDL_JOYSTICK_ALLOW_BACKGROUND_EVENTS"] = "1"    #get key events while the window is not focused
-    
-    stop_event = Event()
-    change_event = Event()
 
-    while True:
-        pygame.init()
+    # Commands without a rig, no SDL subsystem is needed
+    if args.command == "reanalyze":
+        stick_height_mm = None
+        if args.stick is not None:
+            try:
+                stick_height_mm = stick_height_from_profile(args.stick.lower())
+            except ValueError as e:
+                print(f"\033[31m{e}\033[0m")
+                return
+        reanalyze_capture(args.capture, stick_height_mm, args.output_dir)
+        return
+
+    if args.command == "record_evdev":
+        record_evdev(args.device, args.output, args.seconds)
+        return
 
+    if args.command == "analyze":
+        analyze_results(args.directory, args.jobs, args.output)
+        return
 
+    if args.command == "library":
         try:
-            # Parsing Args and Preparing Variables
-            args = parse_args()
+            run_library_command(args)
+        except ValueError as e:
+            print(f"\033[31m{e}\033[0m")
+        return
 
-            comports = list_ports.comports()
-            joystick_count = pygame.joystick.get_count()
+    if args.command == "render":
+        render_results(args.paths, args.format, args.output, args.compare, args.force, args.jobs)
+        return
 
-            if args.list: #list com ports and controllers
+    if args.command == "multi":
+        try:
+            rigs = [parse_rig_assignment(rig) for rig in args.rigs]
+        except ValueError as e:
+            print(f"\033[31m{e}\033[0m")
+            return
 
-                print(" -- com ports -- ")
-                for i in range(len(comports)):
-                    com_port = comports[i]
-                    print(f"{i}: {com_port.description}")
+        options = {key: getattr(args, key) for key in ("protocol", "sampling", "confidence", "no_profile", "adaptive", "continuous", "sim_deadzone", "sim_curve", "sim_noise", "sim_latency_ms") + TIMING_OPTIONS}
+        options["capture"] = not args.no_capture
+        run_multi_rig(rigs, args.output_dir, options)
+        return
 
-                print("\n -- controllers -- ")
-                if joystick_count > 0:
-                    for i in range(joystick_count):
-                        joystick = pygame.joystick.Joystick(i)
-                        print(f"{i}: {joystick.get_name()}")
-                
-                input("Press Enter to Exit.")
+    from serial.tools import list_ports
 
-                return
+    stop_event = Event()
+    change_event = Event()
 
-            com_port_idx = args.com_port
-            controller_idx = args.controller
-            joystick_axis = args.axis
+    # No window at all, joystick events still need the video subsystem
+    log = None
+    renderer = args.renderer
+    if args.headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        renderer = "none"
+        log = RunLog(args.log or datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + HEADLESS_LOG_SUFFIX)
+        print(f"headless, logging to {log.filename}")
 
+    # The renderer process sets them on its window being closed
+    if renderer == "process":
+        stop_event = multiprocessing.get_context("spawn").Event()
+        change_event = multiprocessing.get_context("spawn").Event()
 
-            # Validations 
-            if len(comports) == 0:
-                print(f"\033[31mSerial device Not Found.\033[0m")
-                time.sleep(5)
-                return
-            if len(comports) <= com_port_idx:
-                print(f"\033[31mCOM port index number must be less than {len(comports)} but {com_port_idx}.\033[0m")
-                time.sleep(5)
-                return
-            if joystick_count <= controller_idx:
-                print(f"\033[31mController index number must be less than {joystick_count} but {controller_idx}.\033[0m")
-                time.sleep(5)
-                return
-            
-            if not (joystick_axis == "lx" or joystick_axis == "ly" or joystick_axis == "rx" or joystick_axis == "ry"):
-                print("Invalid joystick axis specified. Defaulting to the right x.")
-                joystick_axis = "rx"
+    # Only the joystick subsystem for listing, the event loop needs video too. They stay up between runs.
+    pygame.joystick.init()
+
+    resume_filename = args.resume
 
+    library = open_curve_library(args.library) if args.library and args.command is None else None
 
-            # Starting Measurement
-            ser = serial.Serial(comports[com_port_idx].device, DEFAULT_SERIAL_BAUD_RATE)
+    # One endurance run over the restarts after a lost controller
+    endurance = None
+    if args.endurance and args.command is None:
+        endurance = EnduranceRun(args.endurance * 3600, args.endurance_interval_s, segment_mb = args.segment_mb, segment_minutes = args.segment_minutes, keep_segments = args.keep_segments)
+        print(f"endurance run for {args.endurance}h, the time series goes to {endurance.filename}")
 
+    try:
+        while True:
             try:
-                joystick = pygame.joystick.Joystick(controller_idx)
-                screen = pygame.display.set_mode(WINDOW_SIZE)
-                pygame.display.set_caption(WINDOW_CAPTION)
+                # Preparing Variables
+                if pygame.display.get_init():
+                    pygame.event.pump()     #picking up re-attached controllers
+
+                comports = list_ports.comports()
+                joystick_count = pygame.joystick.get_count()
+
+                if args.list: #list com ports and controllers
+
+                    print(" -- com ports -- ")
+                    for i in range(len(comports)):
+                        com_port = comports[i]
+                        print(f"{i}: {com_port.description}")
+
+                    print("\n -- controllers -- ")
+                    if joystick_count > 0:
+                        for i in range(joystick_count):
+                            joystick = pygame.joystick.Joystick(i)
+                            print(f"{i}: {joystick.get_name()}")
+
+                    if fcntl is not None:
+                        print("\n -- evdev controllers -- ")
+                        for path in list_evdev_joysticks():
+                            print(path)
+                    
+                    if not args.headless:
+                        input("Press Enter to Exit.")
+
+                    return
+
+                com_port_idx = args.com_port
+                controller_idx = args.controller
+                joystick_axis = args.axis
+
+
+                # Validations 
+                if not args.simulate:
+                    if len(comports) == 0:
+                        print(f"\033[31mSerial device Not Found.\033[0m")
+                        time.sleep(5)
+                        return
+                    if len(comports) <= com_port_idx:
+                        print(f"\033[31mCOM port index number must be less than {len(comports)} but {com_port_idx}.\033[0m")
+                        time.sleep(5)
+                        return
+                    if joystick_count <= controller_idx and not args.evdev:
+                        print(f"\033[31mController index number must be less than {joystick_count} but {controller_idx}.\033[0m")
+                        time.sleep(5)
+                        return
+                
+                if not (joystick_axis == "lx" or joystick_axis == "ly" or joystick_axis == "rx" or joystick_axis == "ry"):
+                    print("Invalid joystick axis specified. Defaulting to the right x.")
+                    joystick_axis = "rx"
 
-                start_main_loop(screen, joystick, joystick_axis, ser, stop_event, change_event)
+
+                # Starting Measurement
+                pygame.display.init()
+                if args.simulate:
+                    ser, joystick = open_simulated_rig(joystick_axis, args.sim_deadzone, args.sim_curve, args.sim_noise, args.sim_latency_ms)
+                else:
+                    ser = serial.Serial(comports[com_port_idx].device, DEFAULT_SERIAL_BAUD_RATE)
+
+                try:
+                    ser = open_motion_link(ser, args.protocol)
+                    if args.evdev:
+                        if args.evdev.endswith(EVDEV_RECORDING_EXTENSION):
+                            joystick = EvdevJoystick.replay(args.evdev)
+                        else:
+                            joystick = EvdevJoystick.open(args.evdev)
+                    elif not args.simulate:
+                        joystick = pygame.joystick.Joystick(controller_idx)
+
+                    if args.command == "calibrate":
+                        calibrate_timing(joystick, joystick_axis, ser, load_sweep_timing(joystick, vars(args), False), args.tolerance, args.margins,
+                                         {"disable": True} if args.headless else None)
+                        return
+
+                    screen = None
+                    if renderer == "thread":
+                        screen = pygame.display.set_mode(WINDOW_SIZE)
+                        pygame.display.set_caption(WINDOW_CAPTION)
+
+                    # The checkpoint is left when the controller did not come back in time or the sweep was quit
+                    resume = None
+                    if resume_filename and os.path.exists(resume_filename):
+                        resume = SweepCheckpoint.load(resume_filename).state
+                        if resume["joystick_axis"] != joystick_axis or args.continuous:
+                            print(f"\033[31mcheckpoint {resume_filename} is not for a stepped {joystick_axis} sweep, starting over.\033[0m")
+                            resume = None
+                        elif not isinstance(ser, MotionLink):
+                            print(f"\033[31mthe legacy protocol can not tell where the motor is, {resume_filename} is not resumed.\033[0m")
+                            resume = None
+                        else:
+                            print(f"resuming sweep {resume['sweep']} at count {resume['move_count']} from {resume_filename}.")
+                            # The firmware was reset by opening the serial or the motor was homed, it travels back from 0
+                            if ser.position != resume["move_count"] * DEFAULT_NUM_STEP:
+                                print(f"motor at {ser.position}, the checkpoint at {resume['move_count'] * DEFAULT_NUM_STEP}, homing before resuming.")
+                                move_motor(ser, 0, None, 0, travel = True)
+                    elif resume_filename:
+                        print(f"\033[31mcheckpoint {resume_filename} Not Found, starting over.\033[0m")
+                    resume_filename = None
+
+                    timing = load_sweep_timing(joystick, vars(args))
+                    start_main_loop(screen, joystick, joystick_axis, ser, stop_event, change_event, adaptive = args.adaptive, timing = timing, continuous = args.continuous, capture = not args.no_capture, renderer = renderer,
+                                    resume = resume, sweeps = args.sweeps, log = log, endurance = endurance, library = library)
+
+                    if isinstance(joystick, EvdevJoystick):
+                        joystick.close()
+
+                finally:
+                    ser.close()
 
             finally:
-                ser.close()
+                changed = change_event.is_set()
+                if changed and os.path.exists(CHECKPOINT_FILENAME):
+                    resume_filename = CHECKPOINT_FILENAME
+                stop_event.clear()
+                change_event.clear()
 
-        finally:
-            pygame.quit()
-            stop_event.clear()
-            change_event.clear()
+            # Unattended runs start again by themselves after the controller was lost and end when done
+            if 1 < args.sweeps or args.headless or endurance:
+                if not changed:
+                    return
+                continue
 
+            input("Press Enter to run again")
 
-        input("Press Enter to run again")
+    finally:
+        if log:
+            log.close()
+        if endurance:
+            endurance.close()
+        if library:
+            library.close()
+        pygame.quit()
 
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()    #for the renderer process in the pyinstaller build
 
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,21 @@
+import os
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import pygame
+
+import gamepad_measure as gm
+
+
+# The legacy port answers nothing, the noise has to be measured after the travel is done and not while stepping
+def test_legacy_calibration_measures_configured_noise():
+    pygame.display.init()
+    try:
+        ser, joystick = gm.open_simulated_rig("rx", noise = 0.002, seed = 1)
+        count = round((gm.SIM_STICK_CENTER_MM + gm.SIM_STICK_TRAVEL_MM / 2) / gm.STEP_DISTANCE_MM)
+        measurements = gm.measure_axis_timing(joystick, "rx", ser, gm.gen_timing(), count)
+    finally:
+        pygame.display.quit()
+
+    assert abs(measurements["noise"] - 0.002) < 0.0005
@@ -0,0 +1,28 @@
+import csv
+import math
+
+import gamepad_measure as gm
+
+
+def write_symmetric_curve(filename):
+    rows = gm.gen_response_curve_data()
+    for i in range(-40, 41):
+        distance = i * 0.1
+        degree = abs(math.degrees(math.atan(distance / gm.STICK_HEIGHT_MM)))
+        rows.append([degree, -distance, distance / 4.0, 0.0, distance, 0.0])
+    with open(filename, "w", newline='') as fd:
+        csv.writer(fd).writerows(rows)
+
+
+def test_symmetric_curve_gives_monotonic_degree_grid(tmp_path):
+    filename = str(tmp_path / "20260101_000000_000000.csv")
+    write_symmetric_curve(filename)
+    db = gm.open_curve_library(str(tmp_path / "library.db"))
+    gm.add_curve(db, filename, "test", "x", gm.STICK_HEIGHT_MM)
+    degrees = gm.array('f', db.execute("SELECT degrees FROM curves").fetchone()[0])
+    grid = gm.curve_grid(gm.CURVE_GRID_DEGREES, gm.CURVE_GRID_DEGREE_STEP)
+    measured = [(x, val) for x, val in zip(grid, degrees) if not math.isnan(val)]
+    assert measured[0][0] < 0 < measured[-1][0]
+    assert all(a[1] < b[1] for a, b in zip(measured, measured[1:]))
+    assert all(math.isclose(val, -dict(measured)[-x], abs_tol=1e-3) for x, val in measured if -x in dict(measured))
+    db.close()
@@ -0,0 +1,26 @@
+import os
+import sys
+import json
+import subprocess
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "gamepad_measure.py")
+
+
+# A whole headless run against the simulated rig has to finish both sweeps on its own
+def test_simulated_headless_run(tmp_path):
+    command = [sys.executable, SCRIPT, "--simulate", "--headless", "--log", "run_log.jsonl", "--protocol", "ack",
+               "--frame_rate", "400", "--before_sense_ms", "0.5", "--repeat_times", "2"]
+    env = dict(os.environ)
+    env.pop("SDL_VIDEODRIVER", None)    #the headless mode has to pick the dummy driver by itself
+    subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True, text=True, check=True, cwd=tmp_path, env=env, timeout=600)
+
+    with open(tmp_path / "run_log.jsonl") as fd:
+        events = [json.loads(line) for line in fd]
+    assert events[-1]["event"] == "run_end"
+    assert events[-1]["status"] == "done"
+
+    sweeps = [event for event in events if event["event"] == "sweep_done"]
+    assert len(sweeps) == 2
+    for event in sweeps:
+        assert event["result"]
+        assert os.path.exists(tmp_path / event["result"])